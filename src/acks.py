@@ -0,0 +1,150 @@
+#
+# Licensed to the Apache Software Foundation (ASF) under one
+# or more contributor license agreements.  See the NOTICE file
+# distributed with this work for additional information
+# regarding copyright ownership.  The ASF licenses this file
+# to you under the Apache License, Version 2.0 (the
+# "License"); you may not use this file except in compliance
+# with the License.  You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing,
+# software distributed under the License is distributed on an
+# "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+# KIND, either express or implied.  See the License for the
+# specific language governing permissions and limitations
+# under the License.
+#
+
+from __future__ import print_function
+import collections
+import threading
+from proton import Delivery, Endpoint, Handler
+from proton.reactor import ApplicationEvent, EventInjector
+
+"""
+Proton event handler added as a child of a receiving handler with
+auto_accept=False. ack() may be called from any thread; acknowledgements
+are queued and applied together on the reactor thread, either every
+interval seconds or as soon as batch of them are waiting, after calling
+before() when given, e.g. to flush what the messages were written to.
+queued() when given is called on the reactor thread after each wakeup,
+so the owner can notice that the acknowledgements it waits for came in.
+settled(delivery) when given is called on the reactor thread for each
+delivery once it is settled, e.g. to free its adaptive credit slot.
+Settling a run of consecutive deliveries in one pass lets proton send
+them as a single ranged disposition frame instead of one per message.
+"""
+class Acknowledger(Handler):
+    def __init__(self, interval=0.05, batch=256, before=None, queued=None, settled=None):
+        self.interval = interval
+        self.batch = batch
+        self.before = before
+        self.queued = queued
+        self.settled = settled
+        # (delivery, outcome) waiting to be applied on the reactor thread
+        self.pending = collections.deque()
+        self.lock = threading.Lock()
+        self.woken = False
+        self.timer = None
+        self.container = None
+        self.injector = EventInjector()
+        # counters of acknowledgements and of the reactor passes applying them
+        self.acked = 0
+        self.flushes = 0
+
+    def start(self, container):
+        self.container = container
+        container.selectable(self.injector)
+
+    def ack(self, delivery, outcome=Delivery.ACCEPTED):
+        # may be called from any thread
+        self.pending.append((delivery, outcome))
+        with self.lock:
+            if self.woken:
+                return
+            self.woken = True
+        self.injector.trigger(ApplicationEvent("ack_wakeup"))
+
+    def on_ack_wakeup(self, event):
+        with self.lock:
+            self.woken = False
+        if len(self.pending) >= self.batch:
+            self.flush()
+        elif self.pending and self.timer is None:
+            self.timer = self.container.schedule(self.interval, self)
+        if self.queued:
+            self.queued()
+
+    def handle(self, delivery, count=1, ack=None):
+        # an AckHandle acknowledging the delivery through ack, this acknowledger by default
+        return AckHandle(ack or self.ack, delivery, count)
+
+    def count(self):
+        # acknowledgements applied or waiting, reactor thread only
+        return self.acked + len(self.pending)
+
+    def on_timer_task(self, event):
+        self.timer = None
+        self.flush()
+
+    def flush(self):
+        # reactor thread only
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+        if not self.pending:
+            return
+        self.flushes += 1
+        if self.before:
+            self.before()
+        while self.pending:
+            delivery, outcome = self.pending.popleft()
+            if delivery.link.state & Endpoint.LOCAL_CLOSED:
+                # the link is gone, the broker redelivers the message
+                continue
+            if outcome == Delivery.MODIFIED:
+                # part of what the delivery carried was processed, it counts as an attempt
+                delivery.local.failed = True
+            delivery.update(outcome)
+            delivery.settle()
+            self.acked += 1
+            if self.settled:
+                self.settled(delivery)
+
+    def close(self):
+        # applies what is left and stops waking the reactor
+        self.flush()
+        self.injector.close()
+
+
+"""
+Ack handle given with each message to the processing step in manual ack
+mode. Calling it, from any thread, acknowledges the message; the delivery
+is acknowledged once all count messages it carried were, which is more
+than one for an envelope. modify(n) gives up the n messages that will not
+be processed, and the delivery is then settled as modified instead of
+accepted, so the broker sends it again whole.
+"""
+class AckHandle(object):
+    def __init__(self, ack, delivery, count=1):
+        self.ack = ack
+        self.delivery = delivery
+        self.count = count
+        self.outcome = Delivery.ACCEPTED
+        self.lock = threading.Lock()
+
+    def __call__(self):
+        self.done(1)
+
+    def modify(self, count):
+        self.outcome = Delivery.MODIFIED
+        self.done(count)
+
+    def done(self, count):
+        with self.lock:
+            self.count -= count
+            done = self.count == 0
+        if done:
+            self.ack(self.delivery, self.outcome)
@@ -0,0 +1,284 @@
+#!/usr/bin/env python
+#
+# Licensed to the Apache Software Foundation (ASF) under one
+# or more contributor license agreements.  See the NOTICE file
+# distributed with this work for additional information
+# regarding copyright ownership.  The ASF licenses this file
+# to you under the Apache License, Version 2.0 (the
+# "License"); you may not use this file except in compliance
+# with the License.  You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing,
+# software distributed under the License is distributed on an
+# "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+# KIND, either express or implied.  See the License for the
+# specific language governing permissions and limitations
+# under the License.
+#
+
+# asyncio facade over the Send and Recv handlers, requires python 3.7 or later
+
+import asyncio
+import collections
+import optparse
+import threading
+from proton import Message
+from proton.handlers import MessagingHandler
+from proton.reactor import ApplicationEvent, Container, EventInjector
+
+from simple_recv import Recv
+from simple_send import Send
+
+# helper function
+def get_options():
+    parser = optparse.OptionParser(usage="usage: %prog [options]",
+                               description="Sends and receives messages through the asyncio client.")
+    parser.add_option("-u", "--url", default="localhost:5672",
+                  help="amqp message broker host url (default %default)")
+    parser.add_option("-a", "--address", default="examples",
+                  help="node address messages are sent to and received from (default %default)")
+    parser.add_option("-m", "--messages", type="int", default=100,
+                  help="number of messages sent concurrently and then received (default %default)")
+    parser.add_option("-o", "--username", default=None,
+                  help="username for authentication (default %default)")
+    parser.add_option("-p", "--password", default=None,
+                  help="password for authentication (default %default)")
+    opts, args = parser.parse_args()
+    return opts
+
+def set_result(future, result):
+    if not future.done():
+        future.set_result(result)
+
+def set_exception(future, error):
+    if not future.done():
+        future.set_exception(error)
+
+
+"""
+Stands in for the start event when a handler is attached to a container
+that is already running. Send and Recv only use event.container in on_start.
+"""
+class AttachEvent(object):
+    def __init__(self, container):
+        self.container = container
+
+
+"""
+Proton event handler class
+Runs on the reactor thread and executes the calls queued by the asyncio
+side. A single wakeup event is injected for any number of queued calls.
+"""
+class Dispatcher(MessagingHandler):
+    def __init__(self):
+        super(Dispatcher, self).__init__()
+        self.injector = EventInjector()
+        self.calls = collections.deque()
+        self.lock = threading.Lock()
+        self.scheduled = False
+        self.container = None
+
+    def on_start(self, event):
+        self.container = event.container
+
+    def call(self, fn):
+        # may be called from any thread
+        with self.lock:
+            self.calls.append(fn)
+            if self.scheduled:
+                return
+            self.scheduled = True
+        self.injector.trigger(ApplicationEvent("client_call"))
+
+    def on_client_call(self, event):
+        with self.lock:
+            self.scheduled = False
+        while self.calls:
+            self.calls.popleft()(self.container)
+
+
+"""
+Send handler whose messages come from awaiting send() calls. Each send
+resolves with the broker outcome of its delivery: "accepted", "rejected"
+or "released". All sends share the one sender link of this handler.
+"""
+class AsyncSender(Send):
+    def __init__(self, client, address, QoS=1):
+        super(AsyncSender, self).__init__(client.url, address, 0, client.username, client.password, QoS)
+        self.client = client
+        self.loop = client.loop
+        # messages waiting for credit and deliveries waiting for an outcome
+        self.pending = collections.deque()
+        self.unsettled = {}
+        self.link = None
+
+    async def send(self, message):
+        future = self.loop.create_future()
+        if self.message_durability:
+            message.durable = True
+        self.client.dispatcher.call(lambda container: self.enqueue(message, future))
+        return await future
+
+    def close(self):
+        self.client.dispatcher.call(lambda container: self.link and self.link.connection.close())
+
+    def enqueue(self, message, future):
+        self.pending.append((message, future))
+        if self.link:
+            self.flush(self.link)
+
+    def on_link_opened(self, event):
+        self.link = event.link
+
+    def on_sendable(self, event):
+        self.flush(event.sender)
+
+    def flush(self, sender):
+        while sender.credit and self.pending:
+            message, future = self.pending.popleft()
+            self.unsettled[sender.send(message)] = future
+            self.sent += 1
+
+    def settle(self, event, outcome):
+        future = self.unsettled.pop(event.delivery, None)
+        if future is not None:
+            self.loop.call_soon_threadsafe(set_result, future, outcome)
+
+    def on_accepted(self, event):
+        self.confirmed += 1
+        self.settle(event, "accepted")
+
+    def on_rejected(self, event):
+        self.confirmed += 1
+        self.rejected += 1
+        self.settle(event, "rejected")
+
+    def on_released(self, event):
+        self.settle(event, "released")
+
+    def on_disconnected(self, event):
+        # outstanding sends cannot complete on this connection any more
+        error = ConnectionError("disconnected from " + self.url)
+        for future in list(self.unsettled.values()) + [f for m, f in self.pending]:
+            self.loop.call_soon_threadsafe(set_exception, future, error)
+        self.unsettled.clear()
+        self.pending.clear()
+        self.link = None
+
+
+"""
+Recv handler delivering messages to an async iterator. Credit is only
+issued as messages are taken by the iterator, so at most prefetch
+messages are buffered locally.
+"""
+class AsyncReceiver(Recv):
+    def __init__(self, client, address, prefetch=10):
+        # prefetch=0 disables automatic credit, it is issued from __anext__ instead
+        super(AsyncReceiver, self).__init__(client.url, address, 0, client.username, client.password, prefetch=0)
+        self.client = client
+        self.loop = client.loop
+        self.window = prefetch
+        self.queue = asyncio.Queue()
+        self.link = None
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        message = await self.queue.get()
+        if message is None:
+            raise StopAsyncIteration
+        self.client.dispatcher.call(lambda container: self.link and self.link.flow(1))
+        return message
+
+    def close(self):
+        self.client.dispatcher.call(lambda container: self.link and self.link.connection.close())
+
+    def on_link_opened(self, event):
+        self.link = event.link
+        self.link.flow(self.window)
+
+    def on_message(self, event):
+        self.received += 1
+        self.loop.call_soon_threadsafe(self.queue.put_nowait, event.message)
+
+    def on_disconnected(self, event):
+        self.link = None
+        self.loop.call_soon_threadsafe(self.queue.put_nowait, None)
+
+
+"""
+AsyncClient runs one proton Container on a background thread and creates
+senders and receivers whose handlers live on that reactor. Any number of
+coroutines can await sends on the same sender concurrently.
+"""
+class AsyncClient(object):
+    def __init__(self, url, username=None, password=None):
+        self.url = url
+        self.username = username
+        self.password = password
+        self.loop = None
+        self.dispatcher = Dispatcher()
+        self.handlers = []
+        self.thread = None
+
+    async def start(self):
+        self.loop = asyncio.get_running_loop()
+        container = Container(self.dispatcher)
+        container.selectable(self.dispatcher.injector)
+        self.thread = threading.Thread(target=container.run)
+        self.thread.daemon = True
+        self.thread.start()
+        return self
+
+    def attach(self, handler):
+        # runs the handler's on_start on the reactor thread to connect and attach its link
+        self.handlers.append(handler)
+        self.dispatcher.call(lambda container: handler.on_start(AttachEvent(container)))
+        return handler
+
+    def sender(self, address, QoS=1):
+        return self.attach(AsyncSender(self, address, QoS))
+
+    def receiver(self, address, prefetch=10):
+        return self.attach(AsyncReceiver(self, address, prefetch))
+
+    async def close(self):
+        for handler in self.handlers:
+            handler.close()
+        self.dispatcher.call(lambda container: self.dispatcher.injector.close())
+        await self.loop.run_in_executor(None, self.thread.join)
+
+    async def __aenter__(self):
+        return await self.start()
+
+    async def __aexit__(self, *exc):
+        await self.close()
+
+
+async def main(opts):
+    async with AsyncClient(opts.url, opts.username, opts.password) as client:
+        sender = client.sender(opts.address)
+        receiver = client.receiver(opts.address)
+        # all sends are in flight at once over the one sender link
+        outcomes = await asyncio.gather(*[sender.send(Message(id=i + 1, body="sequence" + str(i + 1)))
+                                          for i in range(opts.messages)])
+        print(outcomes.count("accepted"), "of", opts.messages, "messages accepted")
+        received = 0
+        async for message in receiver:
+            print(message.body)
+            received += 1
+            if received == opts.messages:
+                break
+        print("received all", received, "messages")
+
+
+if __name__ == "__main__":
+    # get application options
+    opts = get_options()
+
+    try:
+        asyncio.run(main(opts))
+    except KeyboardInterrupt: pass
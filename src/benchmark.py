@@ -0,0 +1,243 @@
+#!/usr/bin/env python
+#
+# Licensed to the Apache Software Foundation (ASF) under one
+# or more contributor license agreements.  See the NOTICE file
+# distributed with this work for additional information
+# regarding copyright ownership.  The ASF licenses this file
+# to you under the Apache License, Version 2.0 (the
+# "License"); you may not use this file except in compliance
+# with the License.  You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing,
+# software distributed under the License is distributed on an
+# "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+# KIND, either express or implied.  See the License for the
+# specific language governing permissions and limitations
+# under the License.
+#
+
+from __future__ import print_function, unicode_literals
+import json
+import math
+import optparse
+import platform
+import socket
+import sys
+import threading
+import time
+import proton
+from proton import Handler
+from proton.reactor import ApplicationEvent, Container, EventInjector
+
+import sinks
+from broker import Broker
+from simple_recv import Recv
+from simple_send import Send
+
+# monotonic clock shared by the sender and receiver threads
+timer = getattr(time, "perf_counter", time.time)
+
+# helper functions
+def get_options():
+    parser = optparse.OptionParser(usage="usage: %prog [options]",
+                               description="Measures throughput and latency of the Send and Recv samples against a local broker.")
+    parser.add_option("-a", "--address", default="examples",
+                  help="queue address used for the benchmark (default %default)")
+    parser.add_option("-m", "--messages", type="int", default=10000,
+                  help="number of messages to send (default %default)")
+    parser.add_option("-s", "--size", type="int", default=100,
+                  help="message body size in bytes (default %default)")
+    parser.add_option("-q", "--qos", default="non-persistent",
+                  help="message QoS, [persistent or 2] or [non-persistent or 1] (default %default)")
+    parser.add_option("-c", "--credit", type="int", default=100,
+                  help="link credit granted to the sender and receiver links (default %default)")
+    parser.add_option("-l", "--ack-latency", type="float", default=0.0,
+                  help="seconds the broker waits before accepting each message (default %default)")
+    parser.add_option("-f", "--output", default=None,
+                  help="file to write the JSON results to instead of stdout (default %default)")
+    opts, args = parser.parse_args()
+    return opts
+
+def free_port():
+    # ask the OS for an unused local port for the broker to listen on
+    s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    s.bind(("127.0.0.1", 0))
+    port = s.getsockname()[1]
+    s.close()
+    return port
+
+def percentile(ordered, p):
+    # nearest rank percentile of an already sorted list
+    if not ordered:
+        return None
+    rank = int(math.ceil(p / 100.0 * len(ordered))) - 1
+    return ordered[max(0, min(rank, len(ordered) - 1))]
+
+
+"""
+Broker event handler that can be stopped from another thread
+through an EventInjector.
+"""
+class BenchBroker(Broker):
+    def on_start(self, event):
+        super(BenchBroker, self).on_start(event)
+        self.container = event.container
+
+    def on_benchmark_stop(self, event):
+        self.container.stop()
+
+
+"""
+Proton event handler added as a child of the benchmark's Send. It wraps
+send_next() of the real handler to stamp each message id with the time
+it was sent, and notes when the last outcome arrived.
+"""
+class SendTiming(Handler):
+    def __init__(self, send):
+        self.send = send
+        # send time by message id, read by the receiver thread
+        self.sent_at = {}
+        self.started = None
+        self.finished = None
+        send_next = send.send_next
+        def timed_send_next(sender):
+            now = timer()
+            if self.started is None:
+                self.started = now
+            self.sent_at[send.first_id + send.sent] = now
+            send_next(sender)
+        send.send_next = timed_send_next
+        send.handlers.append(self)
+
+    def on_delivery(self, event):
+        # after the outcome was counted by the sender
+        if self.finished is None and self.send.confirmed == self.send.total:
+            self.finished = timer()
+
+
+"""
+Sink of the benchmark's Recv recording the end-to-end latency and size
+of every message instead of printing it.
+"""
+class LatencySink(sinks.PrintSink):
+    def __init__(self, sent_at):
+        self.sent_at = sent_at
+        self.latencies = []
+        self.bytes = 0
+        self.finished = None
+
+    def write(self, message):
+        now = timer()
+        self.latencies.append(now - self.sent_at[message.id])
+        self.bytes += len(message.body)
+        self.finished = now
+
+
+"""
+Proton event handler added as a child of the benchmark's Recv, set once
+its link is attached.
+"""
+class Attached(Handler):
+    def __init__(self):
+        self.event = threading.Event()
+
+    def on_link_remote_open(self, event):
+        self.event.set()
+
+
+def ms(seconds):
+    # None stays None when there was nothing to measure
+    return seconds * 1000.0 if seconds is not None else None
+
+
+def run_benchmark(opts, QoS):
+    url = "127.0.0.1:%d" % free_port()
+
+    # start the broker on its own reactor thread
+    broker = Container(BenchBroker(url, opts.credit, opts.ack_latency))
+    injector = EventInjector()
+    broker.selectable(injector)
+    broker_thread = threading.Thread(target=broker.run)
+    broker_thread.daemon = True
+    broker_thread.start()
+
+    # the real sample handlers are measured, stdout is kept for the JSON results
+    send = Send(url, opts.address, opts.messages, None, None, QoS, size=opts.size)
+    timing = SendTiming(send)
+    sink = LatencySink(timing.sent_at)
+    recv = Recv(url, opts.address, opts.messages, None, None, prefetch=opts.credit, sink=sink)
+    attached = Attached()
+    recv.handlers.append(attached)
+    stdout, sys.stdout = sys.stdout, sys.stderr
+    try:
+        # attach the receiver before publishing so latency excludes queueing for an absent consumer
+        recv_thread = threading.Thread(target=Container(recv).run)
+        recv_thread.daemon = True
+        recv_thread.start()
+        while not attached.event.wait(0.1):
+            if not recv_thread.is_alive():
+                raise RuntimeError("receiver could not attach to broker at " + url)
+
+        Container(send).run()
+        recv_thread.join()
+    finally:
+        sys.stdout = stdout
+
+    injector.trigger(ApplicationEvent("benchmark_stop"))
+    broker_thread.join()
+    injector.close()
+
+    elapsed = (sink.finished or timer()) - timing.started
+    latencies = sorted(sink.latencies)
+    return {
+        "config": {
+            "messages": opts.messages,
+            "size": opts.size,
+            "qos": "persistent" if QoS == 2 else "non-persistent",
+            "credit": opts.credit,
+            "ack_latency": opts.ack_latency,
+        },
+        "environment": {
+            "python": platform.python_version(),
+            "proton": ".".join(str(v) for v in proton.VERSION),
+        },
+        "results": {
+            "received": recv.received,
+            "confirmed": send.confirmed,
+            "rejected": send.rejected,
+            "elapsed_sec": elapsed,
+            "send_elapsed_sec": (timing.finished or timer()) - timing.started,
+            "msgs_per_sec": recv.received / elapsed,
+            "bytes_per_sec": sink.bytes / elapsed,
+            "latency_ms": {
+                "p50": ms(percentile(latencies, 50)),
+                "p99": ms(percentile(latencies, 99)),
+                "p99.9": ms(percentile(latencies, 99.9)),
+                "max": ms(percentile(latencies, 100)),
+            },
+        },
+    }
+
+
+if __name__ == "__main__":
+    # get application options
+    opts = get_options()
+    if opts.messages < 1:
+        raise SystemExit("--messages must be at least 1, the receiver would wait indefinitely")
+
+    # determine Quality of Service for sending messages
+    if str(opts.qos) == "persistent" or opts.qos == "2":
+        QoS = 2 # persistent
+    else:
+        QoS = 1 # non-persistent
+
+    try:
+        results = json.dumps(run_benchmark(opts, QoS), indent=2, sort_keys=True)
+        if opts.output:
+            with open(opts.output, "w") as f:
+                f.write(results + "\n")
+        else:
+            print(results)
+    except KeyboardInterrupt: pass
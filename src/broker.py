@@ -0,0 +1,347 @@
+#!/usr/bin/env python
+#
+# Licensed to the Apache Software Foundation (ASF) under one
+# or more contributor license agreements.  See the NOTICE file
+# distributed with this work for additional information
+# regarding copyright ownership.  The ASF licenses this file
+# to you under the Apache License, Version 2.0 (the
+# "License"); you may not use this file except in compliance
+# with the License.  You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing,
+# software distributed under the License is distributed on an
+# "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+# KIND, either express or implied.  See the License for the
+# specific language governing permissions and limitations
+# under the License.
+#
+
+from __future__ import print_function, unicode_literals
+import collections
+import optparse
+import time
+from proton import Delivery, Endpoint, Message, Terminus
+from proton.handlers import MessagingHandler
+from proton.reactor import Container
+
+import filters
+
+# helper function
+def get_options():
+    parser = optparse.OptionParser(usage="usage: %prog [options]",
+                               description="Local stand-in amqp broker for testing the samples.")
+    parser.add_option("-u", "--url", default="localhost:5672",
+                  help="url to listen on for amqp connections (default %default)")
+    parser.add_option("-c", "--credit", type="int", default=100,
+                  help="link credit granted to publishers (default %default)")
+    parser.add_option("-l", "--ack-latency", type="float", default=0.0,
+                  help="seconds before a published message is accepted (default %default)")
+    opts, args = parser.parse_args()
+    return opts
+
+def topic_matches(pattern, topic):
+    """
+    Solace topic matching: levels are separated by '/', '*' matches one
+    level (or the rest of a level after a prefix) and a trailing '>'
+    matches one or more further levels.
+    """
+    patterns = pattern.split("/")
+    levels = topic.split("/")
+    for i, p in enumerate(patterns):
+        if p == ">" and i == len(patterns) - 1:
+            return len(levels) > i
+        if i >= len(levels):
+            return False
+        if p.endswith("*"):
+            if not levels[i].startswith(p[:-1]):
+                return False
+        elif p != levels[i]:
+            return False
+    return len(levels) == len(patterns)
+
+def is_durable(terminus):
+    return terminus.durability != Terminus.NONDURABLE or terminus.expiry_policy == Terminus.EXPIRE_NEVER
+
+
+"""
+Queue class holds the messages stored for one amqp node address, topic
+subscription or durable topic endpoint and hands them out to the attached
+consumer links in turn. Messages stay unacknowledged until the consumer
+settles them; released or modified messages and those outstanding on a
+consumer that goes away are delivered again. A message modified with
+undeliverable-here is parked and only offered to the consumers that have
+not refused it yet.
+"""
+class Queue(object):
+    def __init__(self, durable=True):
+        # a durable queue keeps its messages while no consumer is attached
+        self.durable = durable
+        self.messages = collections.deque()
+        self.consumers = []
+        # delivery -> message sent to a consumer and not yet settled by it
+        self.unacked = {}
+        # [message, links that refused it] parked messages, the refusals of those sent again by
+        # delivery, and whether every parked message was refused by every consumer
+        self.parked = collections.deque()
+        self.refused = {}
+        self.blocked = False
+
+    def subscribe(self, consumer):
+        self.consumers.append(consumer)
+        self.blocked = False
+
+    def unsubscribe(self, consumer):
+        if consumer in self.consumers:
+            self.consumers.remove(consumer)
+        # messages the consumer did not settle go back to the head of the queue
+        for delivery in reversed([d for d in self.unacked if d.link == consumer]):
+            message = self.unacked.pop(delivery)
+            if delivery in self.refused:
+                self.park(message, self.refused.pop(delivery))
+            else:
+                self.requeue(message, True)
+        self.dispatch()
+        return len(self.consumers) == 0 and (not (self.messages or self.parked) or not self.durable)
+
+    def publish(self, message):
+        self.messages.append(message)
+        self.dispatch()
+
+    def requeue(self, message, delivered):
+        if delivered:
+            # delivery_count is changed on a copy, a fanned out message is shared by several queues
+            copy = Message()
+            copy.decode(message.encode())
+            copy.delivery_count = message.delivery_count + 1
+            message = copy
+        self.messages.appendleft(message)
+
+    def park(self, message, refused):
+        self.parked.append([message, refused])
+        self.blocked = False
+
+    def settle(self, delivery):
+        message = self.unacked.pop(delivery, None)
+        refused = self.refused.pop(delivery, set())
+        if message is None:
+            return
+        state = delivery.remote_state
+        if state == Delivery.RELEASED:
+            self.requeue(message, False)
+        elif state == Delivery.MODIFIED and delivery.remote.undeliverable:
+            self.park(message, refused | set([delivery.link]))
+        elif state == Delivery.MODIFIED:
+            self.requeue(message, delivery.remote.failed)
+        else:
+            # accepted or rejected, the message is done with
+            return
+        self.dispatch()
+
+    def dispatch(self, consumer=None):
+        if consumer:
+            consumers = [consumer]
+        else:
+            consumers = self.consumers
+        if self.parked and not self.blocked:
+            self.dispatch_parked(consumers)
+        # round robin messages over the consumers with credit
+        while self.messages:
+            progress = False
+            for c in consumers:
+                if c.credit and self.messages:
+                    message = self.messages.popleft()
+                    self.unacked[c.send(message)] = message
+                    progress = True
+            if not progress:
+                break
+
+    def dispatch_parked(self, consumers):
+        # each parked message goes to the first consumer with credit that has not refused it
+        blocked = True
+        for entry in list(self.parked):
+            message, refused = entry
+            takers = [c for c in consumers if c not in refused]
+            if takers:
+                blocked = False
+            for c in takers:
+                if c.credit:
+                    self.parked.remove(entry)
+                    delivery = c.send(message)
+                    self.unacked[delivery] = message
+                    self.refused[delivery] = refused
+                    break
+        # nothing to try again until a consumer subscribes or another message is parked
+        self.blocked = blocked and len(consumers) == len(self.consumers)
+
+
+"""
+Proton event handler class
+Accepts amqp connections and routes messages from sender links
+to the receiver links attached to the same address. Messages published
+to topic://<topic> are copied to every matching topic subscription:
+receivers on topic://<pattern> get a subscription of their own that ends
+with the link, while receivers on dsub://<pattern>, or on topic://<pattern>
+with a durable source terminus, attach to the durable topic endpoint
+named by the link name, which keeps collecting messages while detached.
+"""
+class Broker(MessagingHandler):
+    def __init__(self, url, credit=100, ack_latency=0.0):
+        # credit sets the link credit granted to each publisher link,
+        # published messages are accepted by the broker itself
+        super(Broker, self).__init__(prefetch=credit, auto_accept=False)
+
+        # url to listen on for amqp connections
+        self.url = url
+
+        # queues by amqp node address
+        self.queues = {}
+
+        # durable topic endpoints by name, and the [topic pattern, queue, selector] subscriptions
+        self.endpoints = {}
+        self.subscriptions = []
+
+        # queue of each consumer link
+        self.consumers = {}
+
+        # seconds before published messages are accepted, and the deliveries waiting for it
+        self.ack_latency = ack_latency
+        self.acks = collections.deque()
+        self.ack_timer = None
+
+    def on_start(self, event):
+        self.container = event.container
+        self.acceptor = event.container.listen(self.url)
+
+    def queue(self, address):
+        if address.startswith("queue://"):
+            address = address[len("queue://"):]
+        if address not in self.queues:
+            self.queues[address] = Queue()
+        return self.queues[address]
+
+    def subscribe(self, link, pattern, durable):
+        # a selector in the source filter picks the messages the subscription stores
+        selector = filters.source_selector(link.remote_source)
+        selector = filters.compile(selector) if selector else None
+        if durable:
+            subscription = self.endpoints.get(link.name)
+            if subscription is None:
+                subscription = self.endpoints[link.name] = [pattern, Queue(), selector]
+                self.subscriptions.append(subscription)
+            # attaching with another topic or selector moves the endpoint to them
+            subscription[0] = pattern
+            subscription[2] = selector
+        else:
+            subscription = [pattern, Queue(durable=False), selector]
+            self.subscriptions.append(subscription)
+        return subscription[1]
+
+    def on_link_opening(self, event):
+        link = event.link
+        if link.is_sender:
+            source = link.remote_source
+            if source.dynamic:
+                address = str(id(link))
+            else:
+                address = source.address
+            link.source.address = address
+            if address.startswith("dsub://"):
+                queue = self.subscribe(link, address[len("dsub://"):], True)
+            elif address.startswith("topic://"):
+                queue = self.subscribe(link, address[len("topic://"):], is_durable(source))
+            else:
+                queue = self.queue(address)
+            # echo the durability the consumer asked for
+            link.source.durability = source.durability
+            link.source.expiry_policy = source.expiry_policy
+            self.consumers[link] = queue
+            queue.subscribe(link)
+        elif link.remote_target.address:
+            link.target.address = link.remote_target.address
+
+    def unsubscribe(self, link):
+        queue = self.consumers.pop(link, None)
+        if queue is None or not queue.unsubscribe(link):
+            return
+        # drop the queue or non-durable subscription nobody uses any more
+        address = link.source.address
+        if self.queues.get(address) is queue:
+            del self.queues[address]
+        elif not queue.durable:
+            self.subscriptions = [s for s in self.subscriptions if s[1] is not queue]
+
+    def on_link_closing(self, event):
+        if event.link.is_sender:
+            self.unsubscribe(event.link)
+
+    def remove_stale_consumers(self, connection):
+        link = connection.link_head(0)
+        while link:
+            if link.is_sender:
+                self.unsubscribe(link)
+            link = link.next(0)
+
+    def on_connection_closing(self, event):
+        self.remove_stale_consumers(event.connection)
+
+    def on_disconnected(self, event):
+        self.remove_stale_consumers(event.connection)
+
+    def on_sendable(self, event):
+        queue = self.consumers.get(event.link)
+        if queue:
+            queue.dispatch(event.link)
+
+    def on_settled(self, event):
+        queue = self.consumers.get(event.link)
+        if queue:
+            queue.settle(event.delivery)
+
+    def on_accepted(self, event):
+        self.on_settled(event)
+
+    def on_rejected(self, event):
+        self.on_settled(event)
+
+    def on_released(self, event):
+        self.on_settled(event)
+
+    def on_message(self, event):
+        # an anonymous relay link names the destination in each message
+        address = event.link.target.address or event.message.address
+        if address.startswith("topic://"):
+            topic = address[len("topic://"):]
+            for pattern, queue, selector in self.subscriptions:
+                if topic_matches(pattern, topic) and (selector is None or selector(event.message)):
+                    queue.publish(event.message)
+        else:
+            self.queue(address).publish(event.message)
+        if self.ack_latency:
+            self.acks.append((time.time() + self.ack_latency, event.delivery))
+            if self.ack_timer is None:
+                self.ack_timer = self.container.schedule(self.ack_latency, self)
+        else:
+            self.accept(event.delivery)
+
+    def on_timer_task(self, event):
+        # accept the published messages whose artificial latency is up
+        self.ack_timer = None
+        now = time.time()
+        while self.acks and self.acks[0][0] <= now:
+            delivery = self.acks.popleft()[1]
+            if not delivery.link.state & Endpoint.LOCAL_CLOSED:
+                self.accept(delivery)
+        if self.acks:
+            self.ack_timer = self.container.schedule(self.acks[0][0] - now, self)
+
+
+if __name__ == "__main__":
+    # get application options
+    opts = get_options()
+
+    try:
+        # start proton event reactor
+        Container(Broker(opts.url, opts.credit, opts.ack_latency)).run()
+    except KeyboardInterrupt: pass
@@ -0,0 +1,296 @@
+#
+# Licensed to the Apache Software Foundation (ASF) under one
+# or more contributor license agreements.  See the NOTICE file
+# distributed with this work for additional information
+# regarding copyright ownership.  The ASF licenses this file
+# to you under the Apache License, Version 2.0 (the
+# "License"); you may not use this file except in compliance
+# with the License.  You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing,
+# software distributed under the License is distributed on an
+# "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+# KIND, either express or implied.  See the License for the
+# specific language governing permissions and limitations
+# under the License.
+#
+
+from __future__ import print_function
+import json
+import os
+import struct
+import time
+import zlib
+from proton import Handler
+
+from metrics import timer
+
+# checkpoint slot: generation, messages processed, wall clock time, length of the json encoded
+# last message id and ids of the batch accepted after the slot was written
+SLOT = struct.Struct(">QQdI")
+SLOT_SIZE = 64 * 1024
+CRC = struct.Struct(">I")
+
+# helper functions
+def add_options(parser):
+    parser.add_option("--catch-up", action="store_true", default=False,
+                  help="drain a backlogged endpoint at full rate: --catch-up-credit credit, accepts batched with "
+                       "the checkpoint, no printing, and stop once it is drained (default %default)")
+    parser.add_option("--catch-up-credit", type="int", default=5000,
+                  help="link credit of catch-up mode (default %default)")
+    parser.add_option("--drain-idle", type="float", default=2.0,
+                  help="seconds without a message after which catch-up mode considers the endpoint drained (default %default)")
+    parser.add_option("--checkpoint", default=None,
+                  help="file recording the processed messages, written and synced before each batch of accepts "
+                       "(default %default)")
+    parser.add_option("--report-interval", type="float", default=5.0,
+                  help="seconds between drain rate and lag reports in catch-up mode (default %default)")
+
+def from_options(opts):
+    # returns None unless catch-up mode or a checkpoint was asked for
+    if not opts.catch_up and not opts.checkpoint:
+        return None
+    checkpoint = Checkpoint(opts.checkpoint) if opts.checkpoint else None
+    if not opts.catch_up:
+        return CatchUp(checkpoint, credit=None, idle=0, report_interval=0)
+    return CatchUp(checkpoint, opts.catch_up_credit, opts.drain_idle, opts.report_interval)
+
+
+def id_key(msg_id):
+    # uuid and binary ids are compared by their text, as they come back from json
+    return msg_id if isinstance(msg_id, int) else str(msg_id)
+
+def runs(ids):
+    # consecutive integer ids are recorded as [first, last] runs
+    encoded = []
+    for msg_id in ids:
+        if not isinstance(msg_id, int):
+            encoded.append(str(msg_id))
+        elif encoded and isinstance(encoded[-1], list) and encoded[-1][1] + 1 == msg_id:
+            encoded[-1][1] = msg_id
+        else:
+            encoded.append([msg_id, msg_id])
+    return encoded
+
+def expand(encoded):
+    ids = set()
+    for run in encoded:
+        if isinstance(run, list):
+            ids.update(range(run[0], run[1] + 1))
+        else:
+            ids.add(run)
+    return ids
+
+
+"""
+Checkpoint keeps the number of messages processed over all runs, the id
+of the last one, and the ids of the batch processed since the previous
+write, in a small file. flush() writes and syncs it before the batch is
+accepted, alternating between two checksummed slots so a write torn by a
+crash leaves the previous checkpoint readable, and costs one fsync however
+many messages were processed since the last one. After a restart only the
+last batch can have been processed without its accepts reaching the
+broker, so covers() matches redelivered messages against its exact ids
+rather than assuming ids increase; each id is matched once.
+"""
+class Checkpoint(object):
+    def __init__(self, path):
+        self.path = path
+        self.generation = 0
+        self.count = 0
+        self.last_id = None
+        # ids processed since the last flush, and those of the batch written last by the previous run
+        self.batch = []
+        self.unconfirmed = set()
+        self.written = None
+        self.recover()
+        # the generations already on disk are only ever overwritten by newer ones
+        self.fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+        self.written = self.count
+        # the state found on disk, reported when resuming
+        self.resumed = (self.count, self.last_id) if self.generation else None
+
+    def recover(self):
+        if not os.path.exists(self.path):
+            return
+        with open(self.path, "rb") as f:
+            data = f.read(2 * SLOT_SIZE)
+        for start in (0, SLOT_SIZE):
+            header = data[start:start + SLOT.size]
+            if len(header) < SLOT.size:
+                continue
+            generation, count, written_at, length = SLOT.unpack(header)
+            end = start + SLOT.size + length
+            if length > SLOT_SIZE - SLOT.size - CRC.size or len(data) < end + CRC.size:
+                continue
+            if zlib.crc32(data[start:end]) & 0xffffffff != CRC.unpack(data[end:end + CRC.size])[0]:
+                continue
+            if generation > self.generation:
+                state = json.loads(data[start + SLOT.size:end].decode("utf-8"))
+                self.generation = generation
+                self.count = count
+                self.last_id = state["last"]
+                self.unconfirmed = expand(state["batch"] or [])
+
+    def advance(self, message):
+        self.count += 1
+        self.last_id = message.id
+        self.batch.append(message.id)
+
+    def covers(self, message):
+        # a redelivered message of the last batch was processed before its accept reached the broker
+        if message.delivery_count == 0 or not self.unconfirmed:
+            return False
+        key = id_key(message.id)
+        if key not in self.unconfirmed:
+            return False
+        self.unconfirmed.discard(key)
+        return True
+
+    def flush(self):
+        if self.count == self.written:
+            return
+        last_id = id_key(self.last_id) if self.last_id is not None else None
+        encoded = json.dumps({"last": last_id, "batch": runs(self.batch)}).encode("utf-8")
+        if SLOT.size + len(encoded) + CRC.size > SLOT_SIZE:
+            # a batch too long for the slot is not recorded, its redeliveries are processed again
+            encoded = json.dumps({"last": last_id, "batch": None}).encode("utf-8")
+        self.generation += 1
+        body = SLOT.pack(self.generation, self.count, time.time(), len(encoded)) + encoded
+        slot = body + CRC.pack(zlib.crc32(body) & 0xffffffff)
+        os.lseek(self.fd, (self.generation % 2) * SLOT_SIZE, os.SEEK_SET)
+        os.write(self.fd, slot)
+        getattr(os, "fdatasync", os.fsync)(self.fd)
+        self.written = self.count
+        self.batch = []
+
+    def close(self):
+        self.flush()
+        os.close(self.fd)
+
+
+"""
+Proton event handler added as a child of a DTE consumer. In catch-up mode
+it measures how fast the endpoint drains, prints the rate and the lag left
+every report_interval seconds and calls drained() on its parent once no
+message arrived for idle seconds. The backlog is the available count the
+broker reports in its flow frames, when it does, and the lag in seconds
+comes from the creation time of the messages, when they carry one.
+"""
+class CatchUp(Handler):
+    def __init__(self, checkpoint=None, credit=5000, idle=2.0, report_interval=5.0):
+        self.checkpoint = checkpoint
+        self.credit = credit
+        self.idle = idle
+        self.report_interval = report_interval
+        self.consumer = None
+        self.container = None
+
+        # drain counters, skipped counts redeliveries the checkpoint already covered
+        self.processed = 0
+        self.skipped = 0
+        self.started = None
+        self.last_arrival = None
+        self.last_report = None
+        self.reported_count = 0
+        self.backlog = None
+        self.lag = None
+        self.timer = None
+        self.done = False
+
+    def start(self, container, consumer):
+        self.container = container
+        self.consumer = consumer
+        # an endpoint without backlog counts as drained idle seconds after the start
+        self.last_arrival = timer()
+        if self.checkpoint and self.checkpoint.resumed:
+            count, last_id = self.checkpoint.resumed
+            print("resuming from checkpoint: %d messages processed, last message id %s, %d ids of the last batch "
+                  "skipped if redelivered" % (count, last_id, len(self.checkpoint.unconfirmed)))
+        if self.idle or self.report_interval:
+            self.timer = container.schedule(self.tick(), self)
+
+    def tick(self):
+        # often enough to notice both the idle time and the next report about on time
+        return min(t for t in (self.idle, self.report_interval) if t) / 2.0
+
+    def on_link_flow(self, event):
+        # brokers that do not report a backlog leave available at 0
+        if event.link.is_receiver and (event.link.available or self.backlog is not None):
+            self.backlog = event.link.available
+
+    def on_delivery(self, event):
+        if event.link.is_receiver:
+            self.last_arrival = timer()
+            if self.started is None:
+                self.started = self.last_report = self.last_arrival
+
+    def duplicate(self, message):
+        # True for a redelivered message the checkpoint shows as processed already
+        if self.checkpoint and self.checkpoint.covers(message):
+            self.skipped += 1
+            return True
+        return False
+
+    def advance(self, message):
+        self.processed += 1
+        if self.checkpoint:
+            self.checkpoint.advance(message)
+        if message.creation_time:
+            self.lag = max(0.0, time.time() - message.creation_time)
+
+    def flush(self):
+        # called before a batch of accepts is applied
+        if self.checkpoint:
+            self.checkpoint.flush()
+
+    def on_timer_task(self, event):
+        self.timer = None
+        if self.done:
+            return
+        now = timer()
+        if (self.report_interval and self.last_report is not None and now - self.last_report >= self.report_interval
+                and self.processed > self.reported_count):
+            print(self.progress(now))
+        if self.idle and self.last_arrival is not None and now - self.last_arrival >= self.idle:
+            # nothing arrived for a while, the endpoint is drained
+            self.done = True
+            self.consumer.drained()
+            return
+        self.timer = self.container.schedule(self.tick(), self)
+
+    def progress(self, now):
+        elapsed = now - self.last_report
+        rate = (self.processed - self.reported_count) / elapsed if elapsed else 0.0
+        self.last_report = now
+        self.reported_count = self.processed
+        line = "drained %d messages, %.1f msgs/sec" % (self.processed, rate)
+        if self.backlog is not None:
+            # as of the last flow frame from the broker
+            line += ", backlog %d messages" % self.backlog
+            if rate:
+                line += " (%.1f seconds to go)" % (self.backlog / rate)
+        if self.lag is not None:
+            line += ", lag %.1f seconds" % self.lag
+        return line
+
+    def close(self):
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+        self.done = True
+        if self.checkpoint:
+            self.checkpoint.close()
+
+    def report(self):
+        elapsed = self.last_arrival - self.started if self.started is not None else 0.0
+        rate = self.processed / elapsed if elapsed > 0 else 0.0
+        line = "drained %d messages in %.3f seconds (%.1f msgs/sec)" % (self.processed, elapsed, rate)
+        if self.skipped:
+            line += ", skipped %d redelivered messages covered by the checkpoint" % self.skipped
+        if self.checkpoint:
+            line += ", checkpoint at %d messages, last message id %s" % (self.checkpoint.count,
+                                                                          self.checkpoint.last_id)
+        return line
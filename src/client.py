@@ -0,0 +1,223 @@
+#
+# Licensed to the Apache Software Foundation (ASF) under one
+# or more contributor license agreements.  See the NOTICE file
+# distributed with this work for additional information
+# regarding copyright ownership.  The ASF licenses this file
+# to you under the Apache License, Version 2.0 (the
+# "License"); you may not use this file except in compliance
+# with the License.  You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing,
+# software distributed under the License is distributed on an
+# "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+# KIND, either express or implied.  See the License for the
+# specific language governing permissions and limitations
+# under the License.
+#
+
+from __future__ import print_function
+import collections
+import json
+import os
+import socket
+import tempfile
+import time
+from proton import Endpoint, Url
+
+# broker host addresses looked up by earlier runs, and for how many seconds they are reused
+RESOLVE_CACHE = os.path.join(tempfile.gettempdir(), "amqp-samples-resolve.json")
+RESOLVE_TTL = 300.0
+
+def connect(container, url=None, username=None, password=None, fast_start=False, **kwargs):
+    """
+    Establishes an amqp connection to the solace pubsub+ broker with PLAIN
+    authentication when a username is given, otherwise ANONYMOUS. Further
+    keyword arguments (urls, reconnect, handler, ...) go to Container.connect().
+    With fast_start the broker host is connected to by an address cached
+    from an earlier run, skipping the name lookup.
+    """
+    if url:
+        kwargs["url"] = url
+    if username:
+        kwargs.update(user=username, password=password, allow_insecure_mechs=True)
+    if fast_start:
+        pre_resolve(kwargs)
+    return container.connect(**kwargs)
+
+def pre_resolve(kwargs):
+    # connects to the cached address first and falls back to the urls as given on reconnect,
+    # the host name is still sent in the open frame and used for tls verification
+    urls = [kwargs.pop("url")] if "url" in kwargs else list(kwargs.pop("urls", ()))
+    hosts = set(Url(u).host for u in urls)
+    if len(hosts) == 1:
+        first = Url(urls[0])
+        address = resolve(first.host, first.port)
+        if address is not None and address != first.host:
+            kwargs.setdefault("virtual_host", first.host)
+            first.host = address
+            urls.insert(0, str(first))
+    kwargs["urls"] = urls
+
+def resolve(host, port, path=RESOLVE_CACHE, ttl=RESOLVE_TTL):
+    # returns an address of host, looked up only when the cached one expired
+    now = time.time()
+    try:
+        with open(path) as f:
+            cache = json.load(f)
+    except (IOError, OSError, ValueError):
+        cache = {}
+    entry = cache.get(host)
+    if entry and entry[1] > now:
+        return entry[0]
+    try:
+        address = socket.getaddrinfo(host, port, 0, socket.SOCK_STREAM)[0][4][0]
+    except socket.error:
+        # left to the connection attempt to report
+        return None
+    cache[host] = [address, now + ttl]
+    try:
+        tmp = "%s.%d" % (path, os.getpid())
+        with open(tmp, "w") as f:
+            json.dump(cache, f)
+        os.rename(tmp, path)
+    except (IOError, OSError):
+        pass
+    return address
+
+def closed(endpoint):
+    return endpoint is None or bool(endpoint.state & (Endpoint.LOCAL_CLOSED | Endpoint.REMOTE_CLOSED))
+
+
+"""
+ConnectionPool multiplexes sender and receiver links over a few shared
+connections (and their default session) instead of a connection per
+destination. Links are created on first use, cached by address, and
+closed again once unused for idle_timeout seconds; connections left
+without links are closed after the same idle time. With max_links the
+least recently used links without unsettled deliveries are closed to
+make room for new ones. relay() returns an anonymous sender per
+connection, for messages that carry their own address. A caller keeping
+a link returned earlier, e.g. a receiver, calls used(link) whenever it
+uses it, so it is not closed as idle.
+"""
+class ConnectionPool(object):
+    def __init__(self, container, url, username=None, password=None, connections=1,
+                 idle_timeout=60.0, handler=None, max_links=0, **kwargs):
+        self.container = container
+        self.url = url
+        self.username = username
+        self.password = password
+        # handler for connection events, link handlers are given per link
+        self.handler = handler
+        self.kwargs = kwargs
+
+        self.connections = connections
+        self.idle_timeout = idle_timeout
+        self.max_links = max_links
+
+        # open connections by slot and the time each slot was last used
+        self.conns = [None] * connections
+        self.conn_used = [0.0] * connections
+        # (role, address) -> link, least recently used first
+        self.links = collections.OrderedDict()
+        self.last_used = {}
+        self.timer = None
+        # links closed to stay within max_links
+        self.evicted = 0
+
+    def slot(self, address):
+        # the same address always maps to the same connection
+        return hash(address) % self.connections
+
+    def connection(self, address):
+        i = self.slot(address)
+        if closed(self.conns[i]):
+            self.conns[i] = connect(self.container, self.url, self.username, self.password,
+                                    handler=self.handler, **self.kwargs)
+        self.conn_used[i] = time.time()
+        return self.conns[i]
+
+    def link(self, role, address, create):
+        key = (role, address)
+        link = self.links.get(key)
+        if closed(link):
+            if self.max_links and len(self.links) >= self.max_links:
+                self.make_room()
+            link = self.links[key] = create(self.connection(address))
+        self.touch(key)
+        return link
+
+    def sender(self, address, handler=None, options=None):
+        return self.link("sender", address, lambda conn: self.container.create_sender(
+            conn, target=address, handler=handler, options=options))
+
+    def receiver(self, address, handler=None, name=None, options=None):
+        return self.link("receiver", address, lambda conn: self.container.create_receiver(
+            conn, source=address, name=name, handler=handler, options=options))
+
+    def relay(self, handler=None):
+        # anonymous sender, the broker routes each message by its address
+        return self.link("sender", None, lambda conn: self.container.create_sender(
+            conn, target=None, handler=handler))
+
+    def make_room(self):
+        # least recently used first, links still waiting for outcomes are kept
+        for key in list(self.links):
+            if len(self.links) < self.max_links:
+                return
+            link = self.links[key]
+            if closed(link) or not link.unsettled:
+                self.evict(key)
+                self.evicted += 1
+
+    def used(self, link):
+        # marks a link returned earlier as in use, so it is not closed as idle
+        if link.is_sender:
+            self.touch(("sender", link.target.address))
+        else:
+            self.touch(("receiver", link.source.address))
+
+    def touch(self, key):
+        now = time.time()
+        # move the link to the most recently used end
+        self.links[key] = self.links.pop(key)
+        self.last_used[key] = now
+        self.conn_used[self.slot(key[1])] = now
+        if self.timer is None and self.idle_timeout:
+            self.timer = self.container.schedule(self.idle_timeout, self)
+
+    def evict(self, key):
+        link = self.links.pop(key)
+        del self.last_used[key]
+        if not closed(link):
+            link.close()
+
+    def on_timer_task(self, event):
+        self.timer = None
+        now = time.time()
+        for key in list(self.links):
+            link = self.links[key]
+            if closed(link):
+                self.evict(key)
+            elif now - self.last_used[key] >= self.idle_timeout and not link.unsettled:
+                self.evict(key)
+        in_use = set(self.slot(address) for role, address in self.links)
+        for i, conn in enumerate(self.conns):
+            if conn is not None and i not in in_use and now - self.conn_used[i] >= self.idle_timeout:
+                conn.close()
+                self.conns[i] = None
+        if self.links or any(conn is not None for conn in self.conns):
+            self.timer = self.container.schedule(self.idle_timeout / 2.0, self)
+
+    def close(self):
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+        for key in list(self.links):
+            self.evict(key)
+        for i, conn in enumerate(self.conns):
+            if conn is not None:
+                conn.close()
+                self.conns[i] = None
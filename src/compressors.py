@@ -0,0 +1,219 @@
+#
+# Licensed to the Apache Software Foundation (ASF) under one
+# or more contributor license agreements.  See the NOTICE file
+# distributed with this work for additional information
+# regarding copyright ownership.  The ASF licenses this file
+# to you under the Apache License, Version 2.0 (the
+# "License"); you may not use this file except in compliance
+# with the License.  You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing,
+# software distributed under the License is distributed on an
+# "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+# KIND, either express or implied.  See the License for the
+# specific language governing permissions and limitations
+# under the License.
+#
+
+from __future__ import print_function
+import collections
+import time
+import zlib
+
+try:
+    import lz4.frame
+except ImportError:
+    lz4 = None
+
+# cpu time of this process, compression runs on the calling thread
+cpu_time = getattr(time, "process_time", time.time)
+
+# bodies collected for --train-dictionary, None when not training, and how many bytes of them are kept
+SAMPLES = None
+SAMPLE_BYTES = 16 * 1024 * 1024
+
+# helper functions
+def add_options(parser, sender=True):
+    if sender:
+        parser.add_option("-z", "--compression", default=None, choices=sorted(COMPRESSORS),
+                      help="compress message bodies with this content-encoding: %s (default %%default)"
+                           % ", ".join(sorted(COMPRESSORS)))
+        parser.add_option("--compression-threshold", type="int", default=1024,
+                      help="only compress bodies of at least this many bytes (default %default)")
+    parser.add_option("--compression-dict", default=None,
+                  help="file holding a preset dictionary, senders and receivers must use the same one (default %default)")
+    if not sender:
+        parser.add_option("--train-dictionary", default=None,
+                      help="write a preset dictionary built from the bodies of the messages received in this run "
+                           "to this file, for --compression-dict (default %default)")
+
+def from_options(opts):
+    # the compressor chosen on the command line, or None
+    global SAMPLES
+    if getattr(opts, "train_dictionary", None):
+        SAMPLES = []
+    zdict = None
+    if opts.compression_dict:
+        with open(opts.compression_dict, "rb") as f:
+            zdict = f.read()
+        # receivers need the dictionary to inflate whatever the senders compressed with it
+        COMPRESSORS["deflate"] = ZlibCompressor(zdict=zdict)
+    name = getattr(opts, "compression", None)
+    if not name:
+        return None
+    return Compression(COMPRESSORS[name], opts.compression_threshold)
+
+def train(samples, size=32 * 1024):
+    """
+    Builds a preset dictionary from sample bodies: the most frequent samples
+    are placed last, where deflate finds them at the shortest distance.
+    """
+    counts = collections.Counter(bytes(s) for s in samples)
+    data = b""
+    for sample, n in counts.most_common():
+        if len(data) + len(sample) > size:
+            break
+        data = sample + data
+    return data
+
+def sample(body):
+    # keeps the body for the dictionary while under SAMPLE_BYTES
+    global SAMPLE_BYTES
+    if SAMPLES is None or body is None or SAMPLE_BYTES <= 0:
+        return
+    if not isinstance(body, (bytes, bytearray, memoryview)):
+        body = str(body).encode("utf-8")
+    SAMPLES.append(bytes(body))
+    SAMPLE_BYTES -= len(body)
+
+def write_dictionary(opts):
+    # writes the dictionary trained on the collected bodies for --train-dictionary, at the end of a run
+    if SAMPLES is None:
+        return
+    data = train(SAMPLES)
+    with open(opts.train_dictionary, "wb") as f:
+        f.write(data)
+    print("wrote a %d byte preset dictionary from %d message bodies to %s" % (len(data), len(SAMPLES),
+                                                                           opts.train_dictionary))
+
+
+"""
+Compressors are registered by the content-encoding value that marks a
+message body compressed with them.
+"""
+class ZlibCompressor(object):
+    name = "deflate"
+
+    def __init__(self, level=6, zdict=None):
+        self.level = level
+        self.zdict = zdict
+
+    def compress(self, data):
+        if self.zdict:
+            compressor = zlib.compressobj(self.level, zlib.DEFLATED, zlib.MAX_WBITS, 9,
+                                          zlib.Z_DEFAULT_STRATEGY, self.zdict)
+        else:
+            compressor = zlib.compressobj(self.level)
+        return compressor.compress(data) + compressor.flush()
+
+    def decompress(self, data):
+        if self.zdict:
+            decompressor = zlib.decompressobj(zlib.MAX_WBITS, self.zdict)
+        else:
+            decompressor = zlib.decompressobj()
+        return decompressor.decompress(data) + decompressor.flush()
+
+class Lz4Compressor(object):
+    name = "lz4"
+
+    def compress(self, data):
+        return lz4.frame.compress(data)
+
+    def decompress(self, data):
+        return lz4.frame.decompress(data)
+
+COMPRESSORS = {"deflate": ZlibCompressor()}
+if lz4 is not None:
+    COMPRESSORS["lz4"] = Lz4Compressor()
+
+
+"""
+Counters of one compressor in one direction. ratio is compressed over
+original bytes; throughput is original bytes per second of cpu time.
+"""
+class CompressionStats(object):
+    def __init__(self):
+        self.messages = 0
+        self.skipped = 0
+        self.original = 0
+        self.compressed = 0
+        self.cpu = 0.0
+
+    def record(self, original, compressed, cpu):
+        self.messages += 1
+        self.original += original
+        self.compressed += compressed
+        self.cpu += cpu
+
+    def ratio(self):
+        return float(self.compressed) / self.original if self.original else 1.0
+
+    def throughput(self):
+        return self.original / self.cpu if self.cpu else 0.0
+
+# (content-encoding, "compress" or "decompress") -> CompressionStats
+STATS = collections.defaultdict(CompressionStats)
+
+def report():
+    lines = []
+    for (name, direction), stats in sorted(STATS.items()):
+        lines.append("%s %s: %d messages (%d below threshold), %d bytes original, %d compressed, "
+                     "ratio %.3f, cpu %.3f s, %.1f MB/s" % (name, direction, stats.messages, stats.skipped,
+                     stats.original, stats.compressed, stats.ratio(), stats.cpu,
+                     stats.throughput() / 1000000.0))
+    return "\n".join(lines)
+
+
+"""
+Compression applies one compressor to the bodies of at least threshold
+bytes; smaller bodies are sent as they are.
+"""
+class Compression(object):
+    def __init__(self, compressor, threshold=1024):
+        self.compressor = compressor
+        self.threshold = threshold
+        self.stats = STATS[(compressor.name, "compress")]
+
+    def apply(self, data):
+        # returns the body to send and its content-encoding, None when left uncompressed
+        if len(data) < self.threshold:
+            self.stats.skipped += 1
+            return data, None
+        started = cpu_time()
+        compressed = self.compressor.compress(data)
+        self.stats.record(len(data), len(compressed), cpu_time() - started)
+        if len(compressed) >= len(data):
+            # incompressible bodies go out as they are
+            return data, None
+        return compressed, self.compressor.name
+
+
+def decompress(message):
+    """
+    Replaces a compressed message body by the original bytes and clears
+    the content-encoding. Messages without a known encoding are unchanged.
+    """
+    compressor = COMPRESSORS.get(message.content_encoding)
+    if compressor is None or not isinstance(message.body, (bytes, bytearray, memoryview)):
+        sample(message.body)
+        return message
+    data = message.body
+    started = cpu_time()
+    body = compressor.decompress(data)
+    STATS[(compressor.name, "decompress")].record(len(body), len(data), cpu_time() - started)
+    message.body = body
+    message.content_encoding = None
+    sample(body)
+    return message
@@ -0,0 +1,309 @@
+#!/usr/bin/env python
+#
+# Licensed to the Apache Software Foundation (ASF) under one
+# or more contributor license agreements.  See the NOTICE file
+# distributed with this work for additional information
+# regarding copyright ownership.  The ASF licenses this file
+# to you under the Apache License, Version 2.0 (the
+# "License"); you may not use this file except in compliance
+# with the License.  You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing,
+# software distributed under the License is distributed on an
+# "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+# KIND, either express or implied.  See the License for the
+# specific language governing permissions and limitations
+# under the License.
+#
+
+from __future__ import print_function
+import collections
+import time
+from proton import Handler
+from proton.handlers import FlowController, MessagingHandler
+from proton.reactor import ApplicationEvent, Container, EventInjector
+
+import client
+import compressors
+import payload
+
+# seconds between checks of the shared count by a process that receives nothing
+CHECK_INTERVAL = 0.5
+
+# options of the single consumers that pool mode does not apply, with their defaults
+POOL_IGNORED = (("sink", "print"), ("sink_async", 0), ("selector", None), ("manual_ack", False),
+                ("adaptive_credit", False), ("dedup_window", 10000), ("batch_size", 0), ("buffer_bytes", 0.0),
+                ("train_dictionary", None))
+
+def check_pool_options(opts):
+    # pool mode processes messages with print_body, refuse options it would silently ignore
+    used = ["--" + name.replace("_", "-") for name, default in POOL_IGNORED
+            if getattr(opts, name, default) != default]
+    if used:
+        raise SystemExit("%s not supported with several links, connections, processes or workers"
+                         % ", ".join(used))
+
+def print_body(message):
+    print(payload.describe(message))
+
+def partition_key(message, key):
+    """
+    Returns the ordering key of a message: key is "subject", "group-id"
+    or "property:<name>" for an application property.
+    """
+    if key == "subject":
+        return message.subject
+    if key == "group-id":
+        return message.group_id
+    if key.startswith("property:"):
+        return (message.properties or {}).get(key[len("property:"):])
+    raise ValueError("unknown partition key " + key)
+
+"""
+Proton event handler class
+Attaches several competing receiver links to the same source, spread over
+one or more connections, and hands each message to a pool of worker threads.
+Deliveries are only settled back on the reactor thread once the worker is
+done. The claimed counter may be shared with other processes so that count
+applies to the whole pool; a process that receives nothing checks it
+every CHECK_INTERVAL seconds, so it stops once the others reached count.
+No credit is granted while the whole count is claimed, the messages still
+in flight then are released back to the broker.
+A given link name is used by every link, so each needs its own connection.
+"""
+class ConsumerPool(MessagingHandler):
+    def __init__(self, url, source, count, username, password,
+                 links=1, connections=1, workers=1, name=None, options=None,
+                 process=print_body, claimed=None, prefetch=10):
+        # link names must be unique per connection
+        if name and links > connections:
+            raise ValueError("links named %s need a connection each" % name)
+
+        # messages are accepted once processed rather than on arrival
+        super(ConsumerPool, self).__init__(prefetch=prefetch, auto_accept=False)
+
+        # amqp broker host url
+        self.url = url
+
+        # amqp source address, link name and receiver options of every link
+        self.source = source
+        self.name = name
+        self.options = options
+
+        # authentication credentials
+        self.username = username
+        self.password = password
+
+        # pool shape and the function run by the workers for each message
+        self.links = links
+        self.connections = connections
+        self.workers = workers
+        self.process = process
+
+        # messaging counters, claimed is shared by all processes of the pool
+        self.expected = count
+        if claimed is None:
+            # multiprocessing and concurrent.futures are imported where used,
+            # importing this module should not slow down the startup of single consumers
+            import multiprocessing
+            claimed = multiprocessing.Value("i", 0)
+        self.claimed = claimed
+        self.received = 0
+        self.processed = 0
+        self.failed = 0
+        self.outstanding = 0
+
+        # deliveries handed back by the workers, drained on the reactor thread
+        self.done = collections.deque()
+        self.conns = []
+        self.timer = None
+        # receiver links, and the flow controllers taken out while the count is claimed
+        self.receivers = []
+        self.stopped = []
+        self.prefetch = prefetch
+
+    def on_start(self, event):
+        from concurrent.futures import ThreadPoolExecutor
+        self.executor = ThreadPoolExecutor(self.workers)
+        # lets worker threads wake the reactor to settle their deliveries
+        self.injector = EventInjector()
+        event.container.selectable(self.injector)
+        for i in range(self.connections):
+            conn = client.connect(event.container, self.url, self.username, self.password)
+            if conn:
+                self.conns.append(conn)
+        # spread the links round robin over the connections, link names must be unique per connection
+        for i in range(self.links):
+            receiver = event.container.create_receiver(self.conns[i % len(self.conns)],
+                                            source=self.source,
+                                            name=self.name or "%s-%d" % (self.source, i),
+                                            options=self.options)
+            self.receivers.append(receiver)
+        if self.expected:
+            self.timer = event.container.schedule(CHECK_INTERVAL, self)
+
+    def on_timer_task(self, event):
+        # the other processes may have claimed the rest of the count while this one was idle
+        self.timer = None
+        self.check_credit()
+        self.check_done()
+        if self.conns:
+            self.timer = event.container.schedule(CHECK_INTERVAL, self)
+
+    def check_credit(self):
+        # stops credit while the whole count is claimed, and grants it again when a failed
+        # message handed its claim back
+        claimed = self.expected and self.claimed.value >= self.expected
+        if claimed and not self.stopped:
+            self.stopped = [h for h in self.handlers if isinstance(h, FlowController)]
+            self.handlers = [h for h in self.handlers if h not in self.stopped]
+        elif not claimed and self.stopped:
+            self.handlers.extend(self.stopped)
+            self.stopped = []
+            for receiver in self.receivers:
+                if not receiver.state & receiver.LOCAL_CLOSED:
+                    receiver.flow(max(0, self.prefetch - receiver.credit))
+
+    def claim(self):
+        # reserve one message of the global count
+        with self.claimed.get_lock():
+            if self.expected and self.claimed.value >= self.expected:
+                return False
+            self.claimed.value += 1
+            return True
+
+    def on_message(self, event):
+        compressors.decompress(event.message)
+        if not self.claim():
+            # another consumer already claimed the last message, let the broker redeliver it
+            self.release(event.delivery, delivered=False)
+            self.check_credit()
+            self.check_done()
+            return
+        self.received += 1
+        self.outstanding += 1
+        self.check_credit()
+        future = self.executor.submit(self.process, event.message)
+        future.add_done_callback(lambda f, d=event.delivery: self.completed(d, f))
+
+    def completed(self, delivery, future):
+        # called on a worker thread, so only queue the result and wake the reactor
+        self.done.append((delivery, future.exception()))
+        self.injector.trigger(ApplicationEvent("processed"))
+
+    def on_processed(self, event):
+        while self.done:
+            delivery, error = self.done.popleft()
+            self.outstanding -= 1
+            if error is None:
+                self.accept(delivery)
+                self.processed += 1
+            else:
+                print("processing failed:", error)
+                # hand the message and its claim back so it can be processed again
+                self.release(delivery)
+                with self.claimed.get_lock():
+                    self.claimed.value -= 1
+                self.failed += 1
+        self.check_credit()
+        self.check_done()
+
+    def check_done(self):
+        if self.expected and self.claimed.value >= self.expected and self.outstanding == 0 and self.conns:
+            for conn in self.conns:
+                conn.close()
+            self.conns = []
+            if self.timer is not None:
+                self.timer.cancel()
+                self.timer = None
+            self.executor.shutdown(wait=False)
+            self.injector.close()
+
+    # the on_transport_error event catches socket and authentication failures
+    def on_transport_error(self, event):
+        print("Transport error:", event.transport.condition)
+        MessagingHandler.on_transport_error(self, event)
+
+"""
+Proton event handler added as a child of a receiving handler. Messages
+are processed by one single threaded worker per partition, chosen by the
+hash of the message key, so messages with the same key are processed one
+at a time in arrival order while different keys run in parallel. Results
+are handed back to the reactor thread, where completed(delivery, error)
+of the owning handler settles the delivery.
+"""
+class PartitionedWorkers(Handler):
+    def __init__(self, workers, key, completed, process=print_body):
+        self.key = key
+        self.completed = completed
+        self.process = process
+        from concurrent.futures import ThreadPoolExecutor
+        self.executors = [ThreadPoolExecutor(1) for i in range(workers)]
+        # deliveries handed back by the workers, drained on the reactor thread
+        self.done = collections.deque()
+        self.outstanding = 0
+        self.injector = EventInjector()
+
+    def start(self, container):
+        container.selectable(self.injector)
+
+    def submit(self, delivery, message):
+        # messages without the key all share one partition, so they stay ordered too
+        executor = self.executors[hash(partition_key(message, self.key)) % len(self.executors)]
+        self.outstanding += 1
+        future = executor.submit(self.process, message)
+        future.add_done_callback(lambda f, d=delivery: self.finished(d, f))
+
+    def finished(self, delivery, future):
+        # called on a worker thread, so only queue the result and wake the reactor
+        self.done.append((delivery, future.exception()))
+        self.injector.trigger(ApplicationEvent("partition_processed"))
+
+    def on_partition_processed(self, event):
+        while self.done:
+            delivery, error = self.done.popleft()
+            self.outstanding -= 1
+            self.completed(delivery, error)
+
+    def close(self):
+        for executor in self.executors:
+            executor.shutdown(wait=False)
+        self.injector.close()
+
+def pool_worker(results, url, source, count, username, password, links, connections,
+                workers, name, options, claimed, prefetch):
+    pool = ConsumerPool(url, source, count, username, password, links, connections, workers,
+                        name, options, claimed=claimed, prefetch=prefetch)
+    Container(pool).run()
+    results.put({"received": pool.received, "processed": pool.processed, "failed": pool.failed})
+
+def run_pool(url, source, count, username, password, links=1, connections=1, processes=1,
+             workers=1, name=None, options=None, prefetch=10):
+    """
+    Runs a ConsumerPool in each of processes worker processes, all claiming
+    from one shared counter, and returns the summed counts.
+    """
+    import multiprocessing
+    claimed = multiprocessing.Value("i", 0)
+    results = multiprocessing.Queue()
+    args = (results, url, source, count, username, password, links, connections,
+            workers, name, options, claimed, prefetch)
+    started = time.time()
+    if processes > 1:
+        procs = [multiprocessing.Process(target=pool_worker, args=args) for p in range(processes)]
+        for p in procs:
+            p.start()
+        counts = [results.get() for p in procs]
+        for p in procs:
+            p.join()
+    else:
+        pool_worker(*args)
+        counts = [results.get()]
+    elapsed = time.time() - started
+
+    summary = dict((k, sum(c[k] for c in counts)) for k in ("received", "processed", "failed"))
+    summary["elapsed"] = elapsed
+    summary["throughput"] = summary["processed"] / elapsed if elapsed else 0.0
+    return summary
@@ -0,0 +1,200 @@
+#
+# Licensed to the Apache Software Foundation (ASF) under one
+# or more contributor license agreements.  See the NOTICE file
+# distributed with this work for additional information
+# regarding copyright ownership.  The ASF licenses this file
+# to you under the Apache License, Version 2.0 (the
+# "License"); you may not use this file except in compliance
+# with the License.  You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing,
+# software distributed under the License is distributed on an
+# "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+# KIND, either express or implied.  See the License for the
+# specific language governing permissions and limitations
+# under the License.
+#
+
+from __future__ import print_function
+from proton import Endpoint, Handler
+
+from metrics import timer
+
+# helper functions
+def add_options(parser):
+    parser.add_option("--adaptive-credit", action="store_true", default=False,
+                  help="size the link credit from the processing rate, buffered messages and --memory-budget "
+                       "instead of a fixed --prefetch (default %default)")
+    parser.add_option("--max-credit", type="int", default=1000,
+                  help="largest credit window of adaptive credit (default %default)")
+    parser.add_option("--memory-budget", type="float", default=64.0,
+                  help="megabytes of received but unprocessed messages adaptive credit allows (default %default)")
+    parser.add_option("--max-delay", type="float", default=1.0,
+                  help="seconds of processing adaptive credit allows to wait in the local buffer (default %default)")
+
+def from_options(opts, initial=10):
+    # returns None when the fixed prefetch window is used
+    if not opts.adaptive_credit:
+        return None
+    return AdaptiveCredit(initial=initial, maximum=opts.max_credit,
+                          memory_budget=int(opts.memory_budget * 1024 * 1024), max_delay=opts.max_delay)
+
+
+"""
+Proton event handler replacing the fixed prefetch window of a receiving
+handler created with prefetch=0. It is inserted as the first child
+handler, so it sees each delivery before the message is decoded, and the
+receiving handler calls processed() on the reactor thread once it is done
+with a delivery: when it is settled, after the processing step, the sink
+flush and the ack path, not when the message is handed out.
+
+The backlog is every message received but not processed yet: those
+proton holds on the link and has not handed to the application
+(link.queued) plus those in the processing step, sink or ack path. The
+window of credit plus backlog is sized AIMD style: it grows by increase
+after each window of messages that found nothing else waiting on the
+link, meaning the consumer keeps up and only waits on the network, and
+it is halved when the backlog exceeds max_delay seconds of processing at
+the measured rate or memory_budget bytes. The window never exceeds the number of
+messages of the average size that fit the memory budget.
+"""
+class AdaptiveCredit(Handler):
+    def __init__(self, initial=10, minimum=1, maximum=1000, increase=None, decrease=0.5,
+                 memory_budget=64 * 1024 * 1024, max_delay=1.0, interval=0.25):
+        self.window = initial
+        self.minimum = minimum
+        self.maximum = maximum
+        self.increase = increase or max(1, initial)
+        self.decrease = decrease
+        self.memory_budget = memory_budget
+        self.max_delay = max_delay
+        # seconds between rate measurements and between decreases
+        self.interval = interval
+
+        # delivery -> encoded size, of messages handed to the application but not processed yet
+        self.sizes = {}
+        self.buffered_bytes = 0
+        self.average_size = None
+
+        # processing rate in messages per second, None until measured
+        self.rate = None
+        self.count = 0
+        self.measured = None
+        self.decreased = None
+
+        # messages that arrived to an empty buffer since the last increase
+        self.idle = 0
+
+        # counters reported at the end
+        self.increases = 0
+        self.decreases = 0
+        self.peak_window = initial
+        self.peak_buffered = 0
+        self.peak_bytes = 0
+
+        # set once no more credit is to be granted
+        self.stopped = False
+
+    def on_link_local_open(self, event):
+        self.flow(event.link)
+
+    def on_link_remote_open(self, event):
+        self.flow(event.link)
+
+    def on_link_flow(self, event):
+        self.flow(event.link)
+
+    def on_delivery(self, event):
+        dlv = event.delivery
+        if not dlv.link.is_receiver or dlv.partial or dlv in self.sizes or not dlv.readable:
+            return
+        # the encoded message is still pending on the delivery at this point
+        size = dlv.pending
+        self.sizes[dlv] = size
+        self.buffered_bytes += size
+        self.average_size = size if self.average_size is None else 0.9 * self.average_size + 0.1 * size
+        queued = self.queued(dlv.link)
+        backlog = len(self.sizes) + queued
+        # the messages proton holds are assumed to be of the average size
+        buffered_bytes = self.buffered_bytes + int(queued * self.average_size)
+        self.peak_buffered = max(self.peak_buffered, backlog)
+        self.peak_bytes = max(self.peak_bytes, buffered_bytes)
+        if self.overloaded(backlog, buffered_bytes):
+            self.idle = 0
+            self.shrink()
+        elif queued == 0:
+            # nothing arrived while the application was busy with the previous messages, the
+            # consumer keeps up: one increase per window, like tcp congestion avoidance
+            self.idle += 1
+            if self.idle >= self.window:
+                self.idle = 0
+                self.increases += 1
+                self.resize(self.window + self.increase)
+        self.flow(dlv.link)
+
+    def processed(self, delivery):
+        # reactor thread only: frees the buffer slot of a delivery
+        size = self.sizes.pop(delivery, None)
+        if size is None:
+            return
+        self.buffered_bytes -= size
+        now = timer()
+        if self.measured is None:
+            self.measured = now
+        self.count += 1
+        elapsed = now - self.measured
+        if elapsed >= self.interval:
+            rate = self.count / elapsed
+            self.rate = rate if self.rate is None else 0.5 * self.rate + 0.5 * rate
+            self.count = 0
+            self.measured = now
+        self.flow(delivery.link)
+
+    def queued(self, link):
+        # messages proton holds but has not handed to the application yet, the
+        # delivery being dispatched is still queued on the link and already in sizes
+        queued = link.queued
+        if link.current in self.sizes:
+            queued -= 1
+        return queued
+
+    def overloaded(self, backlog, buffered_bytes):
+        if buffered_bytes > self.memory_budget:
+            return True
+        return self.rate is not None and backlog > self.rate * self.max_delay
+
+    def stop(self):
+        # e.g. once the expected count arrived, credit already granted is left to run out
+        self.stopped = True
+
+    def shrink(self):
+        # at most one multiplicative decrease per interval, the buffer needs time to drain
+        now = timer()
+        if self.decreased is not None and now - self.decreased < self.interval:
+            return
+        self.decreased = now
+        self.decreases += 1
+        self.resize(int(self.window * self.decrease))
+
+    def resize(self, window):
+        limit = self.maximum
+        if self.average_size:
+            limit = min(limit, int(self.memory_budget / self.average_size))
+        self.window = max(self.minimum, min(window, limit))
+        self.peak_window = max(self.peak_window, self.window)
+
+    def flow(self, link):
+        if self.stopped or not link.is_receiver or link.drain_mode or link.state & Endpoint.LOCAL_CLOSED:
+            return
+        # credit already granted is left to run out when the window shrinks
+        delta = self.window - link.credit - len(self.sizes) - self.queued(link)
+        if delta > 0:
+            link.flow(delta)
+
+    def report(self):
+        rate = "%.1f msgs/sec" % self.rate if self.rate is not None else "not measured"
+        return ("credit window %d (peak %d), %d increases, %d decreases, processing rate %s, "
+                "peak backlog %d messages %d bytes" % (self.window, self.peak_window, self.increases,
+                self.decreases, rate, self.peak_buffered, self.peak_bytes))
@@ -20,12 +20,23 @@
 
 
 from __future__ import print_function, unicode_literals
+import collections
 import optparse
 import proton
-from proton import Message
-from proton.handlers import MessagingHandler
+from proton import Delivery, Message
+from proton.handlers import FlowController, MessagingHandler
 from proton.reactor import Container
 
+import catchup
+import client
+import compressors
+import credit
+import filters
+import metrics
+import sinks
+from acks import Acknowledger, AckHandle
+from consumer_pool import PartitionedWorkers, check_pool_options, run_pool
+
 import logging
 
 # Helper Functions
@@ -45,6 +56,25 @@ def get_options():
         help="username for authentication (default %default)")
     parser.add_option("-p", "--password", default=None,
         help="password for authentication (default %default)")
+    parser.add_option("-l", "--links", type="int", default=1,
+        help="number of competing receiver links in each process, each on its own connection (default %default)")
+    parser.add_option("-P", "--processes", type="int", default=1,
+        help="number of consumer processes sharing the --messages count (default %default)")
+    parser.add_option("-W", "--workers", type="int", default=1,
+        help="number of worker threads processing messages in each process (default %default)")
+    parser.add_option("-M", "--manual-ack", action="store_true", default=False,
+        help="acknowledge messages after processing, applied in coalesced batches (default %default)")
+    parser.add_option("--ack-interval", type="float", default=0.05,
+        help="seconds between applying queued acknowledgements in manual ack mode (default %default)")
+    parser.add_option("-k", "--partition-key", default=None,
+        help="process in order per key with --workers threads on one link: subject, group-id or property:<name> (default %default)")
+
+    catchup.add_options(parser)
+    compressors.add_options(parser, sender=False)
+    credit.add_options(parser)
+    sinks.add_options(parser)
+    filters.add_options(parser)
+    metrics.add_options(parser)
 
     (options, args) = parser.parse_args()
     return options
@@ -54,11 +84,26 @@ def get_options():
 DTEConsumer class is a proton event handler
 This class establishes a connection and revceiver link
 attached to solace Durable Topic Endpoint
+Each message is handed to process(message, ack), which writes it to the
+sink by default; in manual ack mode ack is a handle to call, from any
+thread, once the message is processed, otherwise it is None.
 """
 class DTEConsumer(MessagingHandler):
 
-    def __init__(self, url, dte_name, address, count, username, password):
-        super(DTEConsumer, self).__init__()
+    def __init__(self, url, dte_name, address, count, username, password, workers=1, partition_key=None,
+                 manual_ack=False, ack_interval=0.05, credit=None, sink=None, selector=None, selector_side="both",
+                 catch_up=None, process=None):
+        # where received messages are written, print() by default
+        self.sink = sink or sinks.PrintSink()
+        # a buffering sink is flushed before its messages are accepted, so acks are batched,
+        # and so are they with a checkpoint, which is synced before each batch
+        manual_ack = manual_ack or self.sink.flush_on_settle or catch_up is not None
+        prefetch = catch_up.credit if catch_up and catch_up.credit else 10
+
+        # with a partition key or manual acks messages are accepted once processed,
+        # adaptive credit replaces the default prefetch window
+        super(DTEConsumer, self).__init__(prefetch=0 if credit else prefetch,
+                                          auto_accept=partition_key is None and not manual_ack)
         
         # amqp broker host url
         self.url = url
@@ -73,65 +118,268 @@ class DTEConsumer(MessagingHandler):
         self.username = username
         self.password = password
         
-        # messaging counters
+        # processing step of each message, handed an ack handle in manual ack mode
+        self.process = process or self.write
+
+        # messaging counters, a count of 0 receives until stopped;
+        # handed counts the deliveries given an ack handle
         self.expected = count
         self.received = 0
+        self.processed = 0
+        self.handed = 0
+        self.finished = False
+        self.credit_stopped = False
 
-    def on_start(self, event):
-        # select anonymous or plain authentication
-        if self.username:
-            # establish amqp connection to solace pubsub+ broker with plain authentication
-            conn = event.container.connect(url=self.url,
-                                           user=self.username,
-                                           password=self.password,
-                                           allow_insecure_mechs=True)
+        # per key ordered worker threads, None processes messages on the reactor thread
+        self.partitions = None
+        if partition_key:
+            self.partitions = PartitionedWorkers(workers, partition_key, self.completed, process=self.sink.write)
+            self.handlers.append(self.partitions)
+
+        # catch-up mode and checkpoint, None consumes --messages and keeps no record
+        self.catch_up = catch_up
+        self.receiver = None
+        # messages acknowledged by the processing step, recorded in the checkpoint before their accepts
+        self.advanced = collections.deque()
+        if catch_up:
+            self.handlers.append(catch_up)
+
+        # applies acknowledgements made with ack() in batches, None when messages are auto accepted
+        self.acks = None
+        if manual_ack:
+            # a batch of up to half the catch-up window shares one checkpoint sync
+            batch = max(256, prefetch // 2)
+            self.acks = Acknowledger(ack_interval, batch, before=self.before_ack, queued=self.check_done)
+            self.handlers.append(self.acks)
+
+        # adaptive credit window, None keeps the fixed prefetch window
+        self.credit = credit
+        if credit:
+            # first, so it sees each delivery before the message is read
+            self.handlers.insert(0, credit)
+            if self.acks:
+                # a delivery is processed once its acknowledgement is applied
+                self.acks.settled = credit.processed
+
+        # a selector evaluated on the headers, before the body is decoded
+        self.selector = filters.receiver_options(selector, selector_side)
+        self.filter = None
+        if selector and selector_side in ("client", "both"):
+            self.filter = filters.install(self, selector)
+
+    def before_ack(self):
+        # what was processed reaches the sink's file and the checkpoint before it is accepted
+        self.sink.flush()
+        if self.catch_up:
+            while self.advanced:
+                self.catch_up.advance(self.advanced.popleft())
+            self.catch_up.flush()
+
+    def ack(self, delivery, outcome=Delivery.ACCEPTED):
+        # acknowledges a delivery, from any thread in manual ack mode
+        if self.acks:
+            self.acks.ack(delivery, outcome)
         else:
-            # establish amqp connection to solace pubsub+ broker with anonymous authentication
-            conn = event.container.connect(url=self.url)
+            self.settle(delivery, outcome)
+
+    def on_start(self, event):
+        if self.partitions:
+            self.partitions.start(event.container)
+        if self.acks:
+            self.acks.start(event.container)
+        if self.catch_up:
+            self.catch_up.start(event.container, self)
+        # establish amqp connection to solace pubsub+ broker with plain or anonymous authentication
+        conn = client.connect(event.container, self.url, self.username, self.password, handler=self)
         # attach amqp receiver link to a solace Durable Topic Endpoint
         # name=self.dte_name sets the Link name to the subscription name
         # self.topic_address sets the topic and indicates the durability of the topic endpoint 
         if conn:
-            event.container.create_receiver(conn, source=self.topic_address, name=self.dte_name)
+            self.receiver = event.container.create_receiver(conn, source=self.topic_address, name=self.dte_name,
+                                                            options=self.selector)
     
     def on_message(self, event):
-        if self.received < self.expected:
-            print(event.message.body)
+        compressors.decompress(event.message)
+        if self.partitions:
+            if not self.expected or self.received < self.expected:
+                self.received += 1
+                self.partitions.submit(event.delivery, event.message)
+                if self.received == self.expected:
+                    self.stop_credit()
+            else:
+                # let the broker keep the messages still in flight beyond the expected count
+                self.release(event.delivery, delivered=False)
+            return
+        if not self.expected or self.received < self.expected:
             self.received += 1
-            if self.received == self.expected:
-                print('Received all messages')
-                event.receiver.close()
-                event.connection.close()
+            ack = None
+            if self.acks:
+                ack = AckHandle(self.ack, event.delivery)
+                self.handed += 1
+            if self.catch_up and self.catch_up.duplicate(event.message):
+                # a redelivery covered by the checkpoint was processed by an earlier run
+                # that stopped before its accept went out
+                ack()
+            else:
+                self.process(event.message, self.checkpointed(event.message, ack))
+            if self.credit and not self.acks:
+                # auto accept mode: the message was processed in this call
+                self.credit.processed(event.delivery)
+            self.check_done()
+
+    def write(self, message, ack=None):
+        # the default processing step
+        self.sink.write(message)
+        if ack:
+            ack()
+
+    def checkpointed(self, message, ack):
+        # with a checkpoint the message is recorded once the processing step acknowledges it
+        if not self.catch_up:
+            return ack
+        def done():
+            self.advanced.append(message)
+            ack()
+        return done
+
+    def check_done(self):
+        # reactor thread, once the expected count was received and acknowledged
+        if self.finished or self.partitions or not self.expected or self.received < self.expected:
+            return
+        if self.acks and self.acks.count() < self.handed:
+            # the processing step has not acknowledged the last messages yet
+            return
+        self.finish(self.receiver)
+        print('Received all messages')
+
+    def finish(self, receiver):
+        self.finished = True
+        if self.acks:
+            self.acks.close()
+        self.sink.close()
+        if self.catch_up:
+            self.catch_up.close()
+        receiver.close()
+        receiver.connection.close()
+
+    def drained(self):
+        # called by catch-up mode once no message came for a while
+        self.finish(self.receiver)
     
+    def on_filtered(self, event):
+        # the delivery was settled without decoding the body
+        if self.credit:
+            self.credit.processed(event.delivery)
+
+    def stop_credit(self):
+        # the expected count is being processed, messages released while credit is
+        # topped up would come straight back, so no more credit is granted
+        if self.credit:
+            self.credit.stop()
+        self.handlers = [h for h in self.handlers if not isinstance(h, FlowController) and h is not self.credit]
+        self.credit_stopped = True
+
+    def completed(self, delivery, error):
+        # called on the reactor thread once a worker is done with the message
+        if self.credit and not self.acks:
+            # without manual acks the delivery is settled below, with them once the ack is applied
+            self.credit.processed(delivery)
+        if error is not None:
+            print("processing failed:", error)
+            # the broker delivers the message again
+            self.release(delivery)
+            self.received -= 1
+            if self.credit_stopped:
+                # just enough credit for it to come back
+                delivery.link.flow(1)
+            return
+        self.ack(delivery)
+        self.processed += 1
+        if self.processed == self.expected:
+            if self.acks:
+                self.acks.close()
+            self.sink.close()
+            print('Received all messages')
+            delivery.link.close()
+            delivery.link.connection.close()
+            self.partitions.close()
+
     def on_transport_error(self, event):
         print("transport failure for borker:", self.url)
         MessagingHandler.on_transport_error(self, event)
 
 
-# get application options
-options = get_options()
-"""
-To consume from a DTE over amqp a subscription name
-and a topic are required.
+if __name__ == "__main__":
+    # get application options
+    options = get_options()
+    # loads the preset dictionary used to inflate compressed bodies
+    compressors.from_options(options)
+    """
+    To consume from a DTE over amqp a subscription name
+    and a topic are required.
 
-To achieve this the following must be done:
+    To achieve this the following must be done:
 
-1) Set the amqp address to 'dsub://<topic_name>'. 
-   The prefix 'dsub://' indicates the topic endpoint to bind to is a durable topic endpoint.
+    1) Set the amqp address to 'dsub://<topic_name>'. 
+       The prefix 'dsub://' indicates the topic endpoint to bind to is a durable topic endpoint.
 
-2) Set the amqp Link name to the subscription name.
-"""
-# add the 'dsub://' prefix to the given topic 
-amqp_address = 'dsub://' + options.topic
-
-try:
-    print("waiting to receive", options.messages,"messages")
-    # start the proton Container event loop with the DTEConsumer event handler
-    Container(DTEConsumer(options.url, 
-                          options.dte_name, 
-                          amqp_address, 
-                          options.messages, 
-                          options.username, 
-                          options.password)
-    ).run()
-except KeyboardInterrupt: pass
+    2) Set the amqp Link name to the subscription name.
+    """
+    # add the 'dsub://' prefix to the given topic 
+    amqp_address = 'dsub://' + options.topic
+
+    if options.partition_key and (options.links > 1 or options.processes > 1):
+        raise SystemExit("--partition-key is only supported with a single link and process")
+    if (options.catch_up or options.checkpoint) and (options.partition_key or options.links > 1 or
+                                                     options.processes > 1 or options.workers > 1):
+        raise SystemExit("--catch-up and --checkpoint are only supported with a single link and no workers")
+    if options.catch_up:
+        # drains until the endpoint is empty, and printing each message would set the pace
+        options.messages = 0
+        if options.sink == "print":
+            options.sink = "null"
+
+    if not options.partition_key and (options.links > 1 or options.processes > 1 or options.workers > 1):
+        check_pool_options(options)
+        # the link name is the subscription name, so each link needs its own connection
+        try:
+            print("waiting to receive", options.messages,"messages")
+            summary = run_pool(options.url, amqp_address, options.messages, options.username, options.password,
+                               links=options.links, connections=options.links, processes=options.processes,
+                               workers=options.workers, name=options.dte_name)
+            print("processed", summary["processed"], "messages, failed", summary["failed"],
+                  "in %.3f seconds (%.1f msgs/sec)" % (summary["elapsed"], summary["throughput"]))
+        except KeyboardInterrupt: pass
+    else:
+        try:
+            if options.catch_up:
+                print("draining", options.dte_name)
+            else:
+                print("waiting to receive", options.messages,"messages")
+            # start the proton Container event loop with the DTEConsumer event handler
+            handler = DTEConsumer(options.url, 
+                                  options.dte_name, 
+                                  amqp_address, 
+                                  options.messages, 
+                                  options.username, 
+                                  options.password,
+                                  options.workers,
+                                  options.partition_key,
+                                  options.manual_ack,
+                                  options.ack_interval,
+                                  credit.from_options(options),
+                                  sinks.from_options(options),
+                                  options.selector,
+                                  options.selector_side,
+                                  catchup.from_options(options))
+            Container(metrics.instrument(handler, metrics.from_options(options))).run()
+            if handler.catch_up:
+                print(handler.catch_up.report())
+            if handler.credit:
+                print(handler.credit.report())
+            if handler.filter:
+                print("selector passed", handler.filter.matched, "messages and filtered out", handler.filter.dropped)
+            if compressors.STATS:
+                print(compressors.report())
+            compressors.write_dictionary(options)
+        except KeyboardInterrupt: pass
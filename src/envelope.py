@@ -0,0 +1,92 @@
+#
+# Licensed to the Apache Software Foundation (ASF) under one
+# or more contributor license agreements.  See the NOTICE file
+# distributed with this work for additional information
+# regarding copyright ownership.  The ASF licenses this file
+# to you under the Apache License, Version 2.0 (the
+# "License"); you may not use this file except in compliance
+# with the License.  You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing,
+# software distributed under the License is distributed on an
+# "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+# KIND, either express or implied.  See the License for the
+# specific language governing permissions and limitations
+# under the License.
+#
+
+from __future__ import print_function
+import struct
+import time
+from proton import Message
+
+import payload
+
+# content type of a delivery carrying several length prefixed amqp messages
+ENVELOPE = "application/x-amqp-envelope"
+
+LENGTH = struct.Struct(">I")
+
+# helper functions
+def is_envelope(message):
+    return message.content_type == ENVELOPE
+
+def unpack(message):
+    """
+    Yields the logical messages of an envelope. Each one is decoded from
+    a slice of the body, so the body itself is not copied.
+    """
+    data = payload.view(message.body)
+    pos = 0
+    while pos + LENGTH.size <= len(data):
+        length, = LENGTH.unpack_from(data, pos)
+        pos += LENGTH.size
+        inner = Message()
+        inner.decode(data[pos:pos + length])
+        pos += length
+        yield inner
+
+
+"""
+Envelope collects encoded messages until max_count messages or max_bytes
+bytes are packed, or the first one has waited linger seconds, and then
+sends them as the body of a single delivery. It records the ids of the
+packed messages, so the outcome of the delivery can be applied to each.
+"""
+class Envelope(object):
+    def __init__(self, max_count=100, max_bytes=64 * 1024, linger=0.01, durable=False):
+        self.max_count = max_count
+        self.max_bytes = max_bytes
+        self.linger = linger
+        self.prefix = bytes(Message(content_type=ENVELOPE, durable=durable).encode())
+        self.clear()
+
+    def clear(self):
+        self.ids = []
+        self.parts = []
+        self.size = 0
+        self.started = None
+
+    def add(self, msg_id, data):
+        if self.started is None:
+            self.started = time.time()
+        self.ids.append(msg_id)
+        self.parts.append(LENGTH.pack(len(data)))
+        self.parts.append(data)
+        self.size += LENGTH.size + len(data)
+
+    def full(self):
+        return len(self.ids) >= self.max_count or self.size >= self.max_bytes or \
+            (self.started is not None and time.time() - self.started >= self.linger)
+
+    def send(self, sender, tag=None):
+        # returns the delivery and the ids of the messages it carries
+        dlv = sender.delivery(tag or sender.delivery_tag())
+        # one joined write is cheaper than a stream call per small message
+        sender.stream(self.prefix + payload.data_section(self.size) + b"".join(self.parts))
+        sender.advance()
+        ids = self.ids
+        self.clear()
+        return dlv, ids
@@ -0,0 +1,458 @@
+#
+# Licensed to the Apache Software Foundation (ASF) under one
+# or more contributor license agreements.  See the NOTICE file
+# distributed with this work for additional information
+# regarding copyright ownership.  The ASF licenses this file
+# to you under the Apache License, Version 2.0 (the
+# "License"); you may not use this file except in compliance
+# with the License.  You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing,
+# software distributed under the License is distributed on an
+# "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+# KIND, either express or implied.  See the License for the
+# specific language governing permissions and limitations
+# under the License.
+#
+
+from __future__ import print_function
+import re
+import struct
+from proton import Delivery, Endpoint, Message
+from proton.handlers import IncomingMessageHandler, Reject, Release
+from proton.reactor import Selector
+
+# helper functions
+def add_options(parser):
+    parser.add_option("--selector", default=None,
+                  help="JMS style message selector on headers and application properties, "
+                       "e.g. \"region = 'EU' AND qty > 10\" (default %default)")
+    parser.add_option("--selector-side", default="both", choices=["client", "broker", "both"],
+                  help="evaluate the selector in the client, send it to the broker as a source filter, "
+                       "or both (default %default)")
+
+def receiver_options(selector, side="both"):
+    # the source filter carrying the selector to the broker, or None
+    if selector and side in ("broker", "both"):
+        return Selector(selector)
+    return None
+
+def source_selector(source):
+    # the selector string of a remote source terminus filter, or None
+    source.filter.rewind()
+    if not source.filter.next():
+        return None
+    value = source.filter.get_object()
+    if not isinstance(value, dict):
+        return None
+    for described in value.values():
+        if getattr(described, "descriptor", None) == "apache.org:selector-filter:string":
+            return described.value
+    return None
+
+
+# sections of an encoded message are described types: 0x00, then a small
+# ulong (0x53 code) or ulong (0x80 + 8 bytes) descriptor, then the value
+BODY_SECTIONS = (0x75, 0x76, 0x77)
+
+SIZE32 = struct.Struct(">I")
+
+# fixed width amqp encodings, by constructor
+FIXED = {0x40: 0, 0x41: 0, 0x42: 0, 0x43: 0, 0x44: 0, 0x45: 0,
+         0x50: 1, 0x51: 1, 0x52: 1, 0x53: 1, 0x54: 1, 0x55: 1, 0x56: 1,
+         0x60: 2, 0x61: 2, 0x70: 4, 0x71: 4, 0x72: 4, 0x73: 4, 0x74: 4,
+         0x80: 8, 0x81: 8, 0x82: 8, 0x83: 8, 0x84: 8, 0x94: 16, 0x98: 16}
+
+def body_offset(data):
+    """
+    Returns the offset of the first body section of an encoded message,
+    len(data) when it has none, or None when a section is encoded in a
+    way this scanner does not follow. Only constructors and sizes are
+    read, nothing is decoded.
+    """
+    pos = 0
+    end = len(data)
+    while pos < end:
+        if data[pos] != 0x00:
+            return None
+        if data[pos + 1] == 0x53:
+            code = data[pos + 2]
+            value = pos + 3
+        elif data[pos + 1] == 0x80:
+            code = struct.unpack_from(">Q", data, pos + 2)[0]
+            value = pos + 10
+        else:
+            return None
+        if code in BODY_SECTIONS:
+            return pos
+        constructor = data[value]
+        if constructor in FIXED:
+            pos = value + 1 + FIXED[constructor]
+        elif constructor >> 4 in (0xa, 0xc, 0xe):
+            pos = value + 2 + data[value + 1]
+        elif constructor >> 4 in (0xb, 0xd, 0xf):
+            pos = value + 5 + SIZE32.unpack_from(data, value + 1)[0]
+        else:
+            return None
+    return end
+
+def decode_headers(data):
+    """
+    Decodes the header, annotation and property sections of an encoded
+    message. Returns the message and the offset of its body, or None
+    when the body has been decoded already.
+    """
+    message = Message()
+    offset = body_offset(data)
+    if offset is None:
+        message.decode(data)
+        return message, None
+    view = memoryview(data)
+    message.decode(view[:offset])
+    return message, offset
+
+def decode_body(message, data, offset):
+    if offset is None or offset >= len(data):
+        return message
+    body = Message()
+    body.decode(memoryview(data)[offset:])
+    message.body = body.body
+    return message
+
+
+"""
+A compiled JMS style selector. Identifiers name application properties or
+the JMSMessageID, JMSCorrelationID, JMSPriority, JMSType (the subject) and
+JMSDeliveryMode headers. Supported are comparisons, arithmetic, AND, OR,
+NOT, [NOT] BETWEEN, [NOT] IN, [NOT] LIKE with ESCAPE and IS [NOT] NULL,
+evaluated with the three valued logic of SQL: a missing property is
+unknown, and only a selector that is true selects a message.
+"""
+class Compiled(object):
+    TOKENS = re.compile(r"""\s*(?:
+        (?P<number>\d+\.\d*(?:[eE][-+]?\d+)?|\.\d+(?:[eE][-+]?\d+)?|\d+(?:[eE][-+]?\d+)?)|
+        (?P<string>'(?:[^']|'')*')|
+        (?P<name>[A-Za-z_$][A-Za-z0-9_$.]*)|
+        (?P<op><>|<=|>=|[=<>+\-*/(),]))""", re.X)
+
+    KEYWORDS = ("AND", "OR", "NOT", "BETWEEN", "IN", "LIKE", "ESCAPE", "IS", "NULL", "TRUE", "FALSE")
+
+    HEADERS = {
+        "JMSMessageID": lambda m: m.id,
+        "JMSCorrelationID": lambda m: m.correlation_id,
+        "JMSPriority": lambda m: m.priority,
+        "JMSType": lambda m: m.subject,
+        "JMSDeliveryMode": lambda m: "PERSISTENT" if m.durable else "NON_PERSISTENT",
+    }
+
+    def __init__(self, text):
+        self.text = text
+        self.tokens = self.tokenize(text)
+        self.pos = 0
+        self.evaluate = self.disjunction()
+        if self.pos != len(self.tokens):
+            raise ValueError("unexpected %r in selector %r" % (self.tokens[self.pos][1], text))
+
+    def __call__(self, message):
+        return self.evaluate(message) is True
+
+    def tokenize(self, text):
+        tokens = []
+        pos = 0
+        text = text.rstrip()
+        while pos < len(text):
+            match = self.TOKENS.match(text, pos)
+            if not match:
+                raise ValueError("invalid selector %r at %d" % (text, pos))
+            pos = match.end()
+            kind = match.lastgroup
+            value = match.group(kind)
+            if kind == "name" and value.upper() in self.KEYWORDS:
+                kind, value = "keyword", value.upper()
+            tokens.append((kind, value))
+        return tokens
+
+    # parser helpers
+    def peek(self, *values):
+        if self.pos < len(self.tokens) and self.tokens[self.pos][1] in values \
+                and self.tokens[self.pos][0] in ("keyword", "op"):
+            return self.tokens[self.pos][1]
+        return None
+
+    def accept(self, *values):
+        value = self.peek(*values)
+        if value:
+            self.pos += 1
+        return value
+
+    def expect(self, value):
+        if not self.accept(value):
+            raise ValueError("expected %s in selector %r" % (value, self.text))
+
+    # grammar, lowest precedence first
+    def disjunction(self):
+        left = self.conjunction()
+        while self.accept("OR"):
+            left = self.either(left, self.conjunction())
+        return left
+
+    def conjunction(self):
+        left = self.negation()
+        while self.accept("AND"):
+            left = self.both(left, self.negation())
+        return left
+
+    def negation(self):
+        if self.accept("NOT"):
+            operand = self.negation()
+            def negate(m):
+                value = operand(m)
+                return None if value is None else not value
+            return negate
+        return self.comparison()
+
+    def comparison(self):
+        left = self.additive()
+        op = self.accept("=", "<>", "<", ">", "<=", ">=")
+        if op:
+            return self.compare(op, left, self.additive())
+        if self.accept("IS"):
+            negated = self.accept("NOT")
+            self.expect("NULL")
+            return lambda m: (left(m) is None) != bool(negated)
+        negated = self.accept("NOT")
+        if self.accept("BETWEEN"):
+            low = self.additive()
+            self.expect("AND")
+            high = self.additive()
+            test = self.both(self.compare(">=", left, low), self.compare("<=", left, high))
+        elif self.accept("IN"):
+            self.expect("(")
+            values = [self.literal()]
+            while self.accept(","):
+                values.append(self.literal())
+            self.expect(")")
+            values = set(values)
+            test = lambda m: None if left(m) is None else left(m) in values
+        elif self.accept("LIKE"):
+            pattern = self.literal()
+            escape = self.literal() if self.accept("ESCAPE") else None
+            regex = self.like(pattern, escape)
+            test = lambda m: None if left(m) is None else regex.match(str(left(m))) is not None
+        elif negated:
+            raise ValueError("expected BETWEEN, IN or LIKE after NOT in selector %r" % self.text)
+        else:
+            return left
+        if not negated:
+            return test
+        def negate(m):
+            value = test(m)
+            return None if value is None else not value
+        return negate
+
+    def additive(self):
+        left = self.multiplicative()
+        op = self.accept("+", "-")
+        while op:
+            left = self.arithmetic(op, left, self.multiplicative())
+            op = self.accept("+", "-")
+        return left
+
+    def multiplicative(self):
+        left = self.unary()
+        op = self.accept("*", "/")
+        while op:
+            left = self.arithmetic(op, left, self.unary())
+            op = self.accept("*", "/")
+        return left
+
+    def unary(self):
+        if self.accept("-"):
+            operand = self.unary()
+            return lambda m: None if operand(m) is None else -operand(m)
+        self.accept("+")
+        return self.primary()
+
+    def primary(self):
+        if self.accept("("):
+            inner = self.disjunction()
+            self.expect(")")
+            return inner
+        if self.pos >= len(self.tokens):
+            raise ValueError("unexpected end of selector %r" % self.text)
+        kind, value = self.tokens[self.pos]
+        if kind == "name":
+            self.pos += 1
+            header = self.HEADERS.get(value)
+            if header:
+                return header
+            return lambda m: (m.properties or {}).get(value)
+        constant = self.literal()
+        return lambda m: constant
+
+    def literal(self):
+        if self.pos >= len(self.tokens):
+            raise ValueError("unexpected end of selector %r" % self.text)
+        kind, value = self.tokens[self.pos]
+        self.pos += 1
+        if kind == "number":
+            return float(value) if any(c in value for c in ".eE") else int(value)
+        if kind == "string":
+            return value[1:-1].replace("''", "'")
+        if kind == "keyword" and value in ("TRUE", "FALSE"):
+            return value == "TRUE"
+        raise ValueError("unexpected %r in selector %r" % (value, self.text))
+
+    # combinators
+    def either(self, left, right):
+        def test(m):
+            a = left(m)
+            if a is True:
+                return True
+            b = right(m)
+            if b is True:
+                return True
+            return None if a is None or b is None else False
+        return test
+
+    def both(self, left, right):
+        def test(m):
+            a = left(m)
+            if a is False:
+                return False
+            b = right(m)
+            if b is False:
+                return False
+            return None if a is None or b is None else True
+        return test
+
+    def compare(self, op, left, right):
+        def test(m):
+            a, b = left(m), right(m)
+            if a is None or b is None:
+                return None
+            try:
+                if op == "=":
+                    return a == b
+                if op == "<>":
+                    return a != b
+                if op == "<":
+                    return a < b
+                if op == ">":
+                    return a > b
+                if op == "<=":
+                    return a <= b
+                return a >= b
+            except TypeError:
+                # values of different types are unknown rather than an error
+                return None
+        return test
+
+    def arithmetic(self, op, left, right):
+        def value(m):
+            a, b = left(m), right(m)
+            if a is None or b is None:
+                return None
+            try:
+                if op == "+":
+                    return a + b
+                if op == "-":
+                    return a - b
+                if op == "*":
+                    return a * b
+                return a / b
+            except (TypeError, ZeroDivisionError):
+                return None
+        return value
+
+    def like(self, pattern, escape=None):
+        regex = []
+        i = 0
+        while i < len(pattern):
+            c = pattern[i]
+            if escape and c == escape and i + 1 < len(pattern):
+                i += 1
+                regex.append(re.escape(pattern[i]))
+            elif c == "%":
+                regex.append(".*")
+            elif c == "_":
+                regex.append(".")
+            else:
+                regex.append(re.escape(c))
+            i += 1
+        return re.compile("".join(regex) + r"\Z", re.S)
+
+def compile(text):
+    return Compiled(text)
+
+
+"""
+Replacement for the IncomingMessageHandler of a MessagingHandler. It
+decodes the header and property sections of each message first and only
+decodes the body when the selector accepts the message. Filtered
+deliveries are settled with the filtered outcome and reported to the
+receiving handler's on_filtered(event) instead of on_message. The default,
+modified with undeliverable-here, leaves the message on the broker for
+other consumers but not this link; released would have it sent straight
+back, and accepted consumes it, which only suits a subscription of its own.
+"""
+class SelectiveMessageHandler(IncomingMessageHandler):
+    def __init__(self, selector, auto_accept=True, delegate=None, filtered=Delivery.MODIFIED):
+        super(SelectiveMessageHandler, self).__init__(auto_accept, delegate)
+        self.selector = selector
+        self.filtered = filtered
+        # messages passed and filtered out by the selector
+        self.matched = 0
+        self.dropped = 0
+
+    def on_delivery(self, event):
+        dlv = event.delivery
+        if not dlv.link.is_receiver or dlv.aborted or not dlv.readable or dlv.partial:
+            return IncomingMessageHandler.on_delivery(self, event)
+        data = dlv.link.recv(dlv.pending)
+        dlv.link.advance()
+        message, offset = decode_headers(data)
+        if event.link.state & Endpoint.LOCAL_CLOSED:
+            if self.auto_accept:
+                dlv.update(Delivery.RELEASED)
+                dlv.settle()
+            return
+        if not self.selector(message):
+            self.dropped += 1
+            if self.filtered == Delivery.MODIFIED:
+                dlv.local.undeliverable = True
+            dlv.update(self.filtered)
+            dlv.settle()
+            if self.delegate is not None and hasattr(self.delegate, "on_filtered"):
+                self.delegate.on_filtered(event)
+            return
+        self.matched += 1
+        event.message = decode_body(message, data, offset)
+        try:
+            self.on_message(event)
+            if self.auto_accept:
+                dlv.update(Delivery.ACCEPTED)
+                dlv.settle()
+        except Reject:
+            dlv.update(Delivery.REJECTED)
+            dlv.settle()
+        except Release:
+            dlv.update(Delivery.MODIFIED)
+            dlv.settle()
+
+def install(handler, selector, filtered=Delivery.MODIFIED):
+    """
+    Swaps the message handler of a MessagingHandler for one evaluating the
+    selector, a selector string or a callable taking the header decoded
+    message. Returns the new handler, whose counters report the outcome.
+    """
+    if not callable(selector):
+        selector = compile(selector)
+    for i, child in enumerate(handler.handlers):
+        if isinstance(child, IncomingMessageHandler):
+            selective = SelectiveMessageHandler(selector, child.auto_accept, child.delegate, filtered)
+            handler.handlers[i] = selective
+            return selective
+    raise ValueError("handler has no incoming message handler")
@@ -0,0 +1,205 @@
+#
+# Licensed to the Apache Software Foundation (ASF) under one
+# or more contributor license agreements.  See the NOTICE file
+# distributed with this work for additional information
+# regarding copyright ownership.  The ASF licenses this file
+# to you under the Apache License, Version 2.0 (the
+# "License"); you may not use this file except in compliance
+# with the License.  You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing,
+# software distributed under the License is distributed on an
+# "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+# KIND, either express or implied.  See the License for the
+# specific language governing permissions and limitations
+# under the License.
+#
+
+from __future__ import print_function
+import collections
+import mmap
+import os
+import struct
+import threading
+
+# record header: type, message id, payload length
+HEADER = struct.Struct(">cqI")
+
+# an encoded message, the settlement marker of a message and the highest message id written
+MESSAGE = b"M"
+SETTLED = b"S"
+HIGH_WATER = b"H"
+
+"""
+EncodedMessage sends already encoded message bytes. It can be passed
+to Sender.send() in place of a proton Message.
+"""
+class EncodedMessage(object):
+    def __init__(self, data):
+        self.data = data
+
+    def send(self, sender, tag=None):
+        dlv = sender.delivery(tag or sender.delivery_tag())
+        sender.stream(self.data)
+        sender.advance()
+        return dlv
+
+"""
+PublishJournal is an append-only file of encoded outgoing messages and
+their settlement markers. Only the offsets of unsettled messages are kept
+in memory, the message bytes are read back through a memory map when they
+have to be sent again. Once enough settled records have built up, the live
+records are copied to a new file on a background thread and swapped in.
+"""
+class PublishJournal(object):
+    def __init__(self, path, compact_bytes=64 * 1024 * 1024):
+        self.path = path
+        self.compact_bytes = compact_bytes
+        self.lock = threading.Lock()
+
+        # message id -> (payload offset, payload length) of unsettled messages
+        self.offsets = collections.OrderedDict()
+        self.last_id = None
+        self.settled_bytes = 0
+        self.compactor = None
+        self.map = None
+
+        self.recover()
+        self.file = open(self.path, "ab")
+        self.end = self.file.tell()
+
+    def recover(self):
+        # rebuild the unsettled offsets from an existing journal
+        if not os.path.exists(self.path) or os.path.getsize(self.path) == 0:
+            return
+        with open(self.path, "r+b") as f:
+            data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            pos = 0
+            try:
+                while pos + HEADER.size <= len(data):
+                    kind, msg_id, length = HEADER.unpack_from(data, pos)
+                    if pos + HEADER.size + length > len(data):
+                        break
+                    if kind == MESSAGE:
+                        self.offsets[msg_id] = (pos + HEADER.size, length)
+                        self.last_id = msg_id if self.last_id is None else max(self.last_id, msg_id)
+                    elif kind == SETTLED:
+                        self.offsets.pop(msg_id, None)
+                    elif kind == HIGH_WATER:
+                        self.last_id = msg_id if self.last_id is None else max(self.last_id, msg_id)
+                    pos += HEADER.size + length
+            finally:
+                data.close()
+            # drop a record torn by a crash while it was written
+            f.truncate(pos)
+
+    def unsettled(self):
+        with self.lock:
+            return list(self.offsets)
+
+    def append(self, msg_id, data):
+        with self.lock:
+            self.file.write(HEADER.pack(MESSAGE, msg_id, len(data)))
+            self.file.write(data)
+            self.offsets[msg_id] = (self.end + HEADER.size, len(data))
+            self.end += HEADER.size + len(data)
+            self.last_id = msg_id if self.last_id is None else max(self.last_id, msg_id)
+
+    def settle(self, msg_id):
+        with self.lock:
+            entry = self.offsets.pop(msg_id, None)
+            if entry is None:
+                return
+            self.file.write(HEADER.pack(SETTLED, msg_id, 0))
+            self.end += HEADER.size
+            self.settled_bytes += 2 * HEADER.size + entry[1]
+        if self.settled_bytes >= self.compact_bytes and self.compactor is None:
+            self.compactor = threading.Thread(target=self.compact)
+            self.compactor.daemon = True
+            self.compactor.start()
+
+    def read(self, msg_id):
+        with self.lock:
+            offset, length = self.offsets[msg_id]
+            if self.map is None or len(self.map) < offset + length:
+                # the journal grew since it was last mapped
+                self.file.flush()
+                if self.map is not None:
+                    self.map.close()
+                # the append handle is write only, so map through a read handle
+                with open(self.path, "rb") as f:
+                    self.map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            return self.map[offset:offset + length]
+
+    def flush(self, sync=False):
+        with self.lock:
+            self.file.flush()
+            if sync:
+                os.fsync(self.file.fileno())
+
+    def compact(self):
+        tmp = self.path + ".compact"
+        with self.lock:
+            self.file.flush()
+            live = list(self.offsets.items())
+            last_id = self.last_id
+            end = self.end
+        # copy the live records without holding the lock, appends carry on meanwhile
+        offsets = {}
+        with open(self.path, "rb") as src, open(tmp, "wb") as dst:
+            data = mmap.mmap(src.fileno(), 0, access=mmap.ACCESS_READ) if end else None
+            dst.write(HEADER.pack(HIGH_WATER, last_id or 0, 0))
+            pos = HEADER.size
+            for msg_id, (offset, length) in live:
+                dst.write(HEADER.pack(MESSAGE, msg_id, length))
+                dst.write(data[offset:offset + length])
+                offsets[msg_id] = (pos + HEADER.size, length)
+                pos += HEADER.size + length
+            with self.lock:
+                # append the records written since the snapshot and swap the files
+                self.file.flush()
+                if self.end > end:
+                    src.seek(end)
+                    dst.write(src.read(self.end - end))
+                shift = pos - end
+                for msg_id, (offset, length) in list(self.offsets.items()):
+                    self.offsets[msg_id] = offsets.get(msg_id, (offset + shift, length))
+                dst.flush()
+                os.fsync(dst.fileno())
+                if data is not None:
+                    data.close()
+                if self.map is not None:
+                    self.map.close()
+                    self.map = None
+                self.file.close()
+                os.rename(tmp, self.path)
+                self.file = open(self.path, "ab")
+                self.end = self.file.tell()
+                self.settled_bytes = 0
+                self.compactor = None
+
+    def reset(self):
+        # called once every message is settled, the next run starts a new journal
+        if self.compactor is not None:
+            self.compactor.join()
+        with self.lock:
+            if self.map is not None:
+                self.map.close()
+                self.map = None
+            self.file.close()
+            self.file = open(self.path, "wb")
+            self.offsets.clear()
+            self.last_id = None
+            self.end = 0
+            self.settled_bytes = 0
+
+    def close(self):
+        if self.compactor is not None:
+            self.compactor.join()
+        with self.lock:
+            if self.map is not None:
+                self.map.close()
+                self.map = None
+            self.file.close()
@@ -0,0 +1,359 @@
+#
+# Licensed to the Apache Software Foundation (ASF) under one
+# or more contributor license agreements.  See the NOTICE file
+# distributed with this work for additional information
+# regarding copyright ownership.  The ASF licenses this file
+# to you under the Apache License, Version 2.0 (the
+# "License"); you may not use this file except in compliance
+# with the License.  You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing,
+# software distributed under the License is distributed on an
+# "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+# KIND, either express or implied.  See the License for the
+# specific language governing permissions and limitations
+# under the License.
+#
+
+from __future__ import print_function
+import atexit
+import json
+import os
+import threading
+import time
+from proton import Delivery
+from proton import Handler
+
+# monotonic clock for durations
+timer = getattr(time, "perf_counter", time.time)
+
+QUANTILES = (0.5, 0.9, 0.99, 0.999)
+
+# helper functions
+def add_options(parser):
+    parser.add_option("--metrics-port", type="int", default=None,
+                  help="serve Prometheus text metrics over http on this port (default %default)")
+    parser.add_option("--metrics-file", default=None,
+                  help="periodically write metrics as JSON to this file (default %default)")
+    parser.add_option("--metrics-interval", type="float", default=10.0,
+                  help="seconds between JSON metrics dumps (default %default)")
+
+def from_options(opts):
+    # returns None when no metrics output was requested
+    if opts.metrics_port is None and opts.metrics_file is None:
+        return None
+    metrics = Metrics()
+    if opts.metrics_port is not None:
+        metrics.serve(opts.metrics_port)
+    if opts.metrics_file is not None:
+        metrics.dump_periodically(opts.metrics_file, opts.metrics_interval)
+    return metrics
+
+
+"""
+Histogram with HDR-style log-linear buckets. Each power of two range is
+split into the same number of sub-buckets, so memory is fixed and the
+relative error of a recorded value is bounded (about 3% with 5 sub bits).
+Values are recorded as integers, the callers use microseconds.
+"""
+class Histogram(object):
+    def __init__(self, sub_bits=5, max_bits=40):
+        self.sub_bits = sub_bits
+        self.half = 1 << (sub_bits - 1)
+        self.counts = [0] * ((max_bits - sub_bits + 2) * self.half)
+        self.count = 0
+        self.total = 0
+        self.max = 0
+
+    def index(self, value):
+        if value < (1 << self.sub_bits):
+            return value
+        shift = value.bit_length() - self.sub_bits
+        return (shift + 1) * self.half + (value >> shift) - self.half
+
+    def value_at(self, index):
+        # highest value that falls in the bucket
+        if index < (1 << self.sub_bits):
+            return index
+        shift = index // self.half - 1
+        mantissa = index - shift * self.half
+        return ((mantissa + 1) << shift) - 1
+
+    def record(self, value):
+        value = max(0, int(value))
+        index = min(self.index(value), len(self.counts) - 1)
+        self.counts[index] += 1
+        self.count += 1
+        self.total += value
+        self.max = max(self.max, value)
+
+    def percentile(self, q):
+        if not self.count:
+            return 0
+        rank = max(1, int(round(q * self.count)))
+        seen = 0
+        for index, n in enumerate(self.counts):
+            seen += n
+            if seen >= rank:
+                return min(self.value_at(index), self.max)
+        return self.max
+
+
+"""
+Counters and gauges of one sender or receiver link.
+"""
+class LinkStats(object):
+    def __init__(self, name, address, role):
+        self.name = name
+        self.address = address
+        self.role = role
+        self.sent = 0
+        self.received = 0
+        self.accepted = 0
+        self.rejected = 0
+        self.released = 0
+        self.unsettled = 0
+        self.starved = 0.0
+        self.starved_since = None
+        self.ack_latency = Histogram()
+        # send time of each delivery waiting for an outcome
+        self.pending = {}
+
+    def to_dict(self):
+        return {
+            "address": self.address,
+            "role": self.role,
+            "sent": self.sent,
+            "received": self.received,
+            "accepted": self.accepted,
+            "rejected": self.rejected,
+            "released": self.released,
+            "unsettled": self.unsettled,
+            "credit_starved_seconds": self.starved,
+            "ack_latency_us": dict(("p%g" % (q * 100), self.ack_latency.percentile(q)) for q in QUANTILES),
+        }
+
+
+"""
+Metrics registry shared by the handlers of a process. Updates happen on the
+reactor thread, rendering from the http and dump threads, under one lock.
+"""
+class Metrics(object):
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.links = {}
+        self.callbacks = {}
+        self.started = time.time()
+        self.last_dump = None
+
+    def link(self, link):
+        stats = self.links.get(link.name)
+        if stats is None:
+            if link.is_sender:
+                stats = LinkStats(link.name, link.target.address, "sender")
+            else:
+                stats = LinkStats(link.name, link.source.address, "receiver")
+            with self.lock:
+                self.links[link.name] = stats
+        return stats
+
+    def sent(self, delivery):
+        # called by the sending handlers for every delivery they create
+        now = timer()
+        link = delivery.link
+        stats = self.link(link)
+        with self.lock:
+            stats.sent += 1
+            stats.pending[delivery] = now
+            stats.unsettled = link.unsettled
+            if link.credit == 0 and stats.starved_since is None:
+                stats.starved_since = now
+
+    def callback(self, name, duration):
+        with self.lock:
+            histogram = self.callbacks.get(name)
+            if histogram is None:
+                histogram = self.callbacks[name] = Histogram()
+            histogram.record(duration * 1000000)
+
+    def to_dict(self):
+        with self.lock:
+            return {
+                "uptime_seconds": time.time() - self.started,
+                "links": dict((name, stats.to_dict()) for name, stats in self.links.items()),
+                "callbacks_us": dict((name, {
+                    "count": h.count,
+                    "sum": h.total,
+                    "p50": h.percentile(0.5),
+                    "p99": h.percentile(0.99),
+                    "max": h.max,
+                }) for name, h in self.callbacks.items()),
+            }
+
+    def to_prometheus(self):
+        lines = []
+        def metric(name, kind, help, samples):
+            lines.append("# HELP %s %s" % (name, help))
+            lines.append("# TYPE %s %s" % (name, kind))
+            for labels, value in samples:
+                label = ",".join('%s="%s"' % (k, str(v).replace('"', '\\"')) for k, v in labels)
+                lines.append("%s{%s} %s" % (name, label, repr(float(value))))
+        with self.lock:
+            links = sorted(self.links.values(), key=lambda s: s.name)
+            def per_link(attr):
+                return [((("link", s.name), ("address", s.address), ("role", s.role)), getattr(s, attr))
+                        for s in links]
+            metric("amqp_link_sent_total", "counter", "Deliveries sent on the link.", per_link("sent"))
+            metric("amqp_link_received_total", "counter", "Messages received on the link.", per_link("received"))
+            metric("amqp_link_accepted_total", "counter", "Deliveries accepted by the peer.", per_link("accepted"))
+            metric("amqp_link_rejected_total", "counter", "Deliveries rejected by the peer.", per_link("rejected"))
+            metric("amqp_link_released_total", "counter", "Deliveries released or modified by the peer.",
+                   per_link("released"))
+            metric("amqp_link_unsettled", "gauge", "Deliveries awaiting settlement.", per_link("unsettled"))
+            metric("amqp_link_credit_starved_seconds_total", "counter",
+                   "Time a sender had no link credit.", per_link("starved"))
+            samples = []
+            for s in links:
+                labels = (("link", s.name), ("address", s.address), ("role", s.role))
+                for q in QUANTILES:
+                    samples.append((labels + (("quantile", q),), s.ack_latency.percentile(q) / 1000000.0))
+            metric("amqp_link_ack_latency_seconds", "summary", "Time from send to the peer's outcome.", samples)
+            samples = []
+            for name in sorted(self.callbacks):
+                h = self.callbacks[name]
+                for q in QUANTILES:
+                    samples.append(((("callback", name), ("quantile", q)), h.percentile(q) / 1000000.0))
+            metric("amqp_callback_duration_seconds", "summary", "Duration of reactor callbacks.", samples)
+        return "\n".join(lines) + "\n"
+
+    def serve(self, port):
+        # imported here, http.server takes longer to import than the rest of the sample
+        try:
+            from http.server import BaseHTTPRequestHandler, HTTPServer
+        except ImportError:
+            from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+        metrics = self
+        class MetricsRequestHandler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                body = metrics.to_prometheus().encode("utf-8")
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+        server = HTTPServer(("", port), MetricsRequestHandler)
+        thread = threading.Thread(target=server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        return server
+
+    def dump(self, path):
+        data = self.to_dict()
+        now = time.time()
+        # per second rates since the previous dump
+        if self.last_dump is not None:
+            last_time, last_links = self.last_dump
+            for name, stats in data["links"].items():
+                previous = last_links.get(name, {})
+                for key in ("sent", "received"):
+                    stats[key + "_per_sec"] = (stats[key] - previous.get(key, 0)) / (now - last_time)
+        self.last_dump = (now, data["links"])
+        tmp = path + ".tmp"
+        with open(tmp, "w") as f:
+            json.dump(data, f, indent=2, sort_keys=True)
+        os.rename(tmp, path)
+
+    def dump_periodically(self, path, interval):
+        def run():
+            while True:
+                time.sleep(interval)
+                self.dump(path)
+        thread = threading.Thread(target=run)
+        thread.daemon = True
+        thread.start()
+        # the final counters are written when the program ends
+        atexit.register(self.dump, path)
+
+
+"""
+Proton event handler added as a child of an instrumented handler. It sees
+the same link and delivery events and records outcomes, ack latency,
+received messages and credit starvation.
+"""
+class MetricsHandler(Handler):
+    def __init__(self, metrics):
+        self.metrics = metrics
+
+    def on_link_flow(self, event):
+        link = event.link
+        if link.is_sender and link.credit:
+            stats = self.metrics.link(link)
+            with self.metrics.lock:
+                if stats.starved_since is not None:
+                    stats.starved += timer() - stats.starved_since
+                    stats.starved_since = None
+
+    def on_link_remote_close(self, event):
+        stats = self.metrics.links.get(event.link.name)
+        if stats is not None:
+            # a closing link is not waiting for credit
+            with self.metrics.lock:
+                stats.starved_since = None
+
+    def on_delivery(self, event):
+        delivery = event.delivery
+        link = delivery.link
+        stats = self.metrics.link(link)
+        with self.metrics.lock:
+            if link.is_receiver:
+                if not delivery.partial:
+                    stats.received += 1
+            elif delivery.updated:
+                sent_at = stats.pending.pop(delivery, None)
+                if sent_at is not None:
+                    stats.ack_latency.record((timer() - sent_at) * 1000000)
+                state = delivery.remote_state
+                if state == Delivery.ACCEPTED:
+                    stats.accepted += 1
+                elif state == Delivery.REJECTED:
+                    stats.rejected += 1
+                elif state == Delivery.RELEASED or state == Delivery.MODIFIED:
+                    stats.released += 1
+            stats.unsettled = link.unsettled
+
+    def on_disconnected(self, event):
+        # deliveries of a lost connection will never get an outcome
+        with self.metrics.lock:
+            for stats in self.metrics.links.values():
+                stats.pending.clear()
+
+
+def timed(metrics, name, callback):
+    def wrapper(*args):
+        started = timer()
+        try:
+            return callback(*args)
+        finally:
+            metrics.callback(name, timer() - started)
+    return wrapper
+
+def instrument(handler, metrics):
+    """
+    Records the metrics of a proton MessagingHandler: its on_* callbacks are
+    timed and a MetricsHandler is added to its child handlers. The handler
+    reports its own deliveries through handler.metrics.sent(delivery).
+    Returns the handler unchanged when metrics is None.
+    """
+    if metrics is None:
+        return handler
+    handler.metrics = metrics
+    for name in dir(handler):
+        if name.startswith("on_") and name != "on_unhandled" and callable(getattr(handler, name)):
+            setattr(handler, name, timed(metrics, name, getattr(handler, name)))
+    handler.handlers.append(MetricsHandler(metrics))
+    return handler
@@ -0,0 +1,166 @@
+#
+# Licensed to the Apache Software Foundation (ASF) under one
+# or more contributor license agreements.  See the NOTICE file
+# distributed with this work for additional information
+# regarding copyright ownership.  The ASF licenses this file
+# to you under the Apache License, Version 2.0 (the
+# "License"); you may not use this file except in compliance
+# with the License.  You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing,
+# software distributed under the License is distributed on an
+# "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+# KIND, either express or implied.  See the License for the
+# specific language governing permissions and limitations
+# under the License.
+#
+
+from __future__ import print_function
+import random
+
+from metrics import Histogram, timer
+
+# helper functions
+def add_options(parser):
+    parser.add_option("--rate", type="float", default=0,
+                  help="offered load in messages per second, 0 sends as fast as credit allows (default %default)")
+    parser.add_option("--schedule", default="constant", choices=["constant", "poisson", "ramp", "bucket"],
+                  help="send times at the offered rate: constant, poisson, ramp or bucket (default %default)")
+    parser.add_option("--burst", type="int", default=1,
+                  help="token bucket size of the bucket schedule (default %default)")
+    parser.add_option("--ramp-to", type="float", default=None,
+                  help="rate the ramp schedule reaches at its end (default twice --rate)")
+    parser.add_option("--ramp-seconds", type="float", default=60.0,
+                  help="duration of the ramp, the rate stays at --ramp-to afterwards (default %default)")
+    parser.add_option("--seed", type="int", default=None,
+                  help="random seed of the poisson schedule (default %default)")
+
+def from_options(opts):
+    # returns None when no rate was requested
+    if not opts.rate:
+        return None
+    if opts.schedule == "poisson":
+        schedule = poisson(opts.rate, opts.seed)
+    elif opts.schedule == "ramp":
+        schedule = ramp(opts.rate, opts.ramp_to or 2 * opts.rate, opts.ramp_seconds)
+    elif opts.schedule == "bucket":
+        schedule = token_bucket(opts.rate, opts.burst)
+    else:
+        schedule = constant(opts.rate)
+    return Pacer(schedule)
+
+# schedules yield the intended send time of each message, in seconds from the start
+def constant(rate):
+    i = 0
+    while True:
+        yield i / rate
+        i += 1
+
+def poisson(rate, seed=None):
+    # exponential gaps give a poisson arrival process
+    rng = random.Random(seed)
+    t = 0.0
+    while True:
+        yield t
+        t += rng.expovariate(rate)
+
+def ramp(start_rate, end_rate, seconds):
+    # the rate changes linearly from start_rate to end_rate over seconds
+    t = 0.0
+    while True:
+        yield t
+        rate = end_rate if t >= seconds else start_rate + (end_rate - start_rate) * t / seconds
+        t += 1.0 / rate
+
+def token_bucket(rate, burst):
+    # a full bucket of burst tokens, refilled at rate tokens per second
+    i = 0
+    while True:
+        yield 0.0 if i < burst else (i - burst + 1) / rate
+        i += 1
+
+
+"""
+Latency of paced messages, corrected for coordinated omission: it is
+measured from the time the schedule meant a message to be sent, so time
+spent waiting for credit or for the in-flight window counts against the
+broker instead of silently lowering the offered load. The latency from
+the actual send is recorded as well for comparison.
+"""
+class LatencyRecorder(object):
+    def __init__(self):
+        self.corrected = Histogram()
+        self.service = Histogram()
+        # key -> (intended send time, actual send time)
+        self.pending = {}
+        self.first = None
+        self.last = None
+
+    def sent(self, key, intended):
+        self.pending[key] = (intended, timer())
+
+    def settled(self, key):
+        times = self.pending.pop(key, None)
+        if times is None:
+            return
+        now = timer()
+        if self.first is None:
+            self.first = times[0]
+        self.last = now
+        self.corrected.record((now - times[0]) * 1000000)
+        self.service.record((now - times[1]) * 1000000)
+
+    def report(self):
+        def line(name, h):
+            return "%s latency ms: p50 %.3f p99 %.3f p99.9 %.3f max %.3f" % (name,
+                h.percentile(0.5) / 1000.0, h.percentile(0.99) / 1000.0,
+                h.percentile(0.999) / 1000.0, h.max / 1000.0)
+        elapsed = (self.last - self.first) if self.first is not None else 0.0
+        rate = self.corrected.count / elapsed if elapsed else 0.0
+        return "\n".join(["%d messages confirmed at %.1f msgs/sec" % (self.corrected.count, rate),
+                          line("intended send to outcome", self.corrected),
+                          line("actual send to outcome", self.service)])
+
+
+"""
+Pacer releases messages at the times of a schedule. A sending handler asks
+due() before each message and take() when it sends one; when it has to
+stop early it calls wake() to be called back by a reactor timer at the
+next send time, so the reactor keeps serving other events meanwhile.
+"""
+class Pacer(object):
+    def __init__(self, schedule):
+        self.schedule = schedule
+        self.started = None
+        self.next = None
+        self.timer = None
+        self.callback = None
+        self.latency = LatencyRecorder()
+
+    def due(self):
+        if self.started is None:
+            self.started = timer()
+            self.next = self.started + next(self.schedule)
+        return timer() >= self.next
+
+    def take(self):
+        # returns the intended send time of the message being sent
+        intended = self.next
+        self.next = self.started + next(self.schedule)
+        return intended
+
+    def wake(self, container, callback):
+        if self.timer is None:
+            self.callback = callback
+            self.timer = container.schedule(max(0.0, self.next - timer()), self)
+
+    def cancel(self):
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+
+    def on_timer_task(self, event):
+        self.timer = None
+        self.callback()
@@ -0,0 +1,214 @@
+#
+# Licensed to the Apache Software Foundation (ASF) under one
+# or more contributor license agreements.  See the NOTICE file
+# distributed with this work for additional information
+# regarding copyright ownership.  The ASF licenses this file
+# to you under the Apache License, Version 2.0 (the
+# "License"); you may not use this file except in compliance
+# with the License.  You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing,
+# software distributed under the License is distributed on an
+# "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+# KIND, either express or implied.  See the License for the
+# specific language governing permissions and limitations
+# under the License.
+#
+
+from __future__ import print_function
+import json
+import struct
+from proton import Message
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+# data section descriptor, followed by vbin8 (0xa0) or vbin32 (0xb0) and the length
+DATA_SECTION = b"\x00\x53\x75"
+
+OCTET_STREAM = "application/octet-stream"
+TEXT = "text/plain;charset=utf-8"
+
+# encoded message prefixes kept per template, one per destination address when relaying
+PREFIX_CACHE = 16384
+
+# helper functions
+def view(data):
+    # flat byte view of any buffer, without copying it
+    data = memoryview(data)
+    if data.ndim != 1 or data.itemsize != 1:
+        data = data.cast("B")
+    return data
+
+def data_section(length):
+    if length < 256:
+        return DATA_SECTION + b"\xa0" + struct.pack(">B", length)
+    return DATA_SECTION + b"\xb0" + struct.pack(">I", length)
+
+def filler(size):
+    # one shared buffer is sent as the body of every message of a run
+    return view(bytearray(size))
+
+
+"""
+Codecs turn application values into body bytes and back. decode() is
+given a memoryview over the received body. RawCodec passes buffers
+through untouched.
+"""
+class RawCodec(object):
+    content_type = OCTET_STREAM
+
+    def encode(self, value):
+        return view(value)
+
+    def decode(self, data):
+        return data
+
+class TextCodec(object):
+    content_type = TEXT
+
+    def encode(self, value):
+        return value.encode("utf-8")
+
+    def decode(self, data):
+        return data.tobytes().decode("utf-8")
+
+class JSONCodec(object):
+    content_type = "application/json"
+
+    def encode(self, value):
+        return json.dumps(value, separators=(",", ":")).encode("utf-8")
+
+    def decode(self, data):
+        return json.loads(data.tobytes().decode("utf-8"))
+
+class MsgpackCodec(object):
+    content_type = "application/msgpack"
+
+    def encode(self, value):
+        return msgpack.packb(value, use_bin_type=True)
+
+    def decode(self, data):
+        return msgpack.unpackb(data, raw=False)
+
+class StructCodec(object):
+    def __init__(self, fmt):
+        self.struct = struct.Struct(fmt)
+        # the format travels in the content type, so receivers need no registration
+        self.content_type = "application/x-struct;format=" + fmt
+
+    def encode(self, value):
+        return self.struct.pack(*value)
+
+    def decode(self, data):
+        return self.struct.unpack_from(data)
+
+
+# codecs by content type
+CODECS = {}
+
+def register(codec):
+    CODECS[codec.content_type] = codec
+    return codec
+
+def codec_for(content_type):
+    """
+    Returns the codec registered for a content type, or None. Struct
+    formats given as a content type parameter get a codec on first use.
+    """
+    if not content_type:
+        return None
+    codec = CODECS.get(content_type)
+    if codec is None:
+        base, _, params = content_type.partition(";")
+        if base.strip() == "application/x-struct" and params.strip().startswith("format="):
+            codec = register(StructCodec(params.strip()[len("format="):]))
+            CODECS[content_type] = codec
+        else:
+            codec = CODECS.get(base.strip())
+    return codec
+
+register(RawCodec())
+register(TextCodec())
+CODECS["text/plain"] = CODECS[TEXT]
+register(JSONCodec())
+if msgpack is not None:
+    register(MsgpackCodec())
+
+
+"""
+BinaryMessage sends its body as an amqp data section. The header and
+properties are encoded by proton once, the body is streamed to the link
+straight from the caller's buffer instead of being copied into a proton
+Message first. It can be passed to Sender.send() like a Message. With a
+compressors.Compression the body is compressed once it reaches the
+threshold and marked with its content-encoding. Setting address sends
+it to that address, e.g. over an anonymous relay link.
+"""
+class BinaryMessage(object):
+    def __init__(self, body, content_type=OCTET_STREAM, compression=None, **kwargs):
+        self.body = body
+        self.content_type = content_type
+        self.codec = codec_for(content_type)
+        if self.codec is None:
+            raise ValueError("no codec registered for content type " + content_type)
+        self.compression = compression
+        self.kwargs = kwargs
+        self.address = None
+        # encoded header and properties by (address, content-encoding), built on first use
+        self.prefixes = {}
+
+    def prefix(self, encoding):
+        key = (self.address, encoding)
+        prefix = self.prefixes.get(key)
+        if prefix is None:
+            if len(self.prefixes) >= PREFIX_CACHE:
+                self.prefixes.clear()
+            prefix = self.prefixes[key] = bytes(Message(address=self.address, content_type=self.content_type,
+                                                        content_encoding=encoding, **self.kwargs).encode())
+        return prefix
+
+    def payload(self):
+        # the body to send and its content-encoding
+        data = view(self.codec.encode(self.body))
+        if self.compression:
+            return self.compression.apply(data)
+        return data, None
+
+    def send(self, sender, tag=None):
+        data, encoding = self.payload()
+        dlv = sender.delivery(tag or sender.delivery_tag())
+        sender.stream(self.prefix(encoding))
+        sender.stream(data_section(len(data)))
+        sender.stream(data)
+        sender.advance()
+        return dlv
+
+    def encode(self):
+        data, encoding = self.payload()
+        return self.prefix(encoding) + data_section(len(data)) + bytes(data)
+
+
+def decode(message):
+    """
+    Decodes a binary body with the codec of the message content type.
+    Bodies are only wrapped in a memoryview, so nothing is copied until a
+    codec needs it; text and other amqp-value bodies are returned as is.
+    """
+    body = message.body
+    if not isinstance(body, (bytes, bytearray, memoryview)):
+        return body
+    data = view(body)
+    codec = codec_for(message.content_type) or CODECS[OCTET_STREAM]
+    return codec.decode(data)
+
+def describe(message):
+    # printable form of a message body, binary data is summarised by its size
+    value = decode(message)
+    if isinstance(value, memoryview):
+        return "<%d bytes %s>" % (len(value), message.content_type or OCTET_STREAM)
+    return value
@@ -20,10 +20,17 @@
 
 from __future__ import print_function, unicode_literals
 import optparse
+import struct
 from proton import Message
 from proton.handlers import MessagingHandler
 from proton.reactor import Container
 
+import client
+import compressors
+import metrics
+import pacing
+import payload
+
 # Helper Functions
 def get_options():
     #parse cmd arguments
@@ -39,23 +46,103 @@ def get_options():
         help="username for authentication (default %default)")
     parser.add_option("-p", "--password", default=None,
         help="password for authentication (default %default)")
+    parser.add_option("-w", "--window", type="int", default=1000,
+        help="maximum number of unconfirmed messages in flight; 0 is bounded by credit only (default %default)")
+    parser.add_option("-s", "--size", type="int", default=0,
+        help="send binary bodies of this many bytes as amqp data sections instead of text (default %default)")
+    parser.add_option("-n", "--topics", type="int", default=1,
+        help="spread messages round robin over this many topics <topic>/0 .. <topic>/n-1; 1 sends to --topic (default %default)")
+    parser.add_option("-r", "--relay", action="store_true", default=False,
+        help="send every topic over one anonymous relay link, addressing each message (default %default)")
+    parser.add_option("--max-links", type="int", default=1000,
+        help="most sender links kept open, the least recently used are closed beyond it; 0 is unbounded (default %default)")
+    parser.add_option("--link-idle", type="float", default=60.0,
+        help="seconds after which an unused sender link is closed (default %default)")
+
+    compressors.add_options(parser)
+    pacing.add_options(parser)
+    metrics.add_options(parser)
 
     (options, args) = parser.parse_args()
     return options
 
+"""
+MessageTemplate class pre-encodes the message sections that are the same for
+every message (header and properties) so only the body is encoded per send.
+It can be passed to Sender.send() in place of a proton Message. Setting
+address encodes it into the properties, for sending over an anonymous relay.
+"""
+class MessageTemplate(object):
+
+    def __init__(self, compression=None, **kwargs):
+        self.kwargs = kwargs
+        self.body = None
+        self.address = None
+        self.compression = compression
+        # encoded header and properties sections by (address, content-encoding)
+        self.prefixes = {}
+
+    def prefix(self, encoding):
+        key = (self.address, encoding)
+        prefix = self.prefixes.get(key)
+        if prefix is None:
+            if len(self.prefixes) >= payload.PREFIX_CACHE:
+                self.prefixes.clear()
+            if encoding:
+                # compressed bodies are sent as a utf-8 data section marked with the content-encoding
+                message = Message(address=self.address, content_type=payload.TEXT, content_encoding=encoding,
+                                  **self.kwargs)
+            else:
+                message = Message(address=self.address, **self.kwargs)
+            prefix = self.prefixes[key] = bytes(message.encode())
+        return prefix
+
+    def encode_body(self, data):
+        # amqp-value section holding a utf-8 string (descriptor 0x77, str8 or str32)
+        if len(data) < 256:
+            return b"\x00\x53\x77\xa1" + struct.pack(">B", len(data)) + data
+        return b"\x00\x53\x77\xb1" + struct.pack(">I", len(data)) + data
+
+    def send(self, sender, tag=None):
+        # same contract as Message.send() so the template works with Sender.send()
+        dlv = sender.delivery(tag or sender.delivery_tag())
+        data = self.body.encode("utf-8")
+        encoding = None
+        if self.compression:
+            data, encoding = self.compression.apply(data)
+        if encoding:
+            sender.stream(self.prefix(encoding) + payload.data_section(len(data)) + data)
+        else:
+            sender.stream(self.prefix(None) + self.encode_body(data))
+        sender.advance()
+        return dlv
+
 """
 Proton event Handler class
-Establishes an amqp connection and creates an amqp sender link to transmit messages
+Establishes an amqp connection and creates an amqp sender link to transmit messages.
+With topics > 1 the messages go round robin to topics address/0 .. address/topics-1,
+each over its own cached sender link, or with relay over one anonymous relay link
+with the address set per message, which saves a link attach per topic.
 """
 class MessageProducer(MessagingHandler):
 
-    def __init__(self, url, address, count, username, password):
+    def __init__(self, url, address, count, username, password, window=1000, size=0, compression=None,
+                 pacer=None, topics=1, relay=False, max_links=1000, link_idle=60.0):
         super(MessageProducer, self).__init__()
 
         # the solace message broker amqp url
         self.url = url 
         # the prefix amqp address for a solace topic
         self.topic_address = address 
+
+        # destination addresses the messages are spread over
+        if topics > 1:
+            self.destinations = ["%s/%d" % (address, i) for i in range(topics)]
+        else:
+            self.destinations = [address]
+        self.relay = relay
+        self.max_links = max_links
+        self.link_idle = link_idle
         
         # authentication credentials
         self.username = username
@@ -65,54 +152,106 @@ class MessageProducer(MessagingHandler):
         self.sent = 0
         self.confirmed = 0
 
-    def on_start(self, event):
-        # select authentication from SASL PLAIN or SASL ANONYMOUS
-        if self.username:
-            # creates and establishes amqp connection using PLAIN authentication
-            conn = event.container.connect(url=self.url, 
-                                           user=self.username, 
-                                           password=self.password, 
-                                           allow_insecure_mechs=True)
+        # maximum number of unconfirmed messages, 0 leaves sending bounded by credit only
+        self.window = window
+
+        # the durable property on the message sends the message as a persistent message
+        if size:
+            # a binary body is the same for every message and streamed from one buffer
+            self.template = payload.BinaryMessage(payload.filler(size), compression=compression, durable=True)
         else:
-            # creates and establishes amqp connection using ANONYMOUS authentication
-            conn = event.container.connect(url=self.url)
-        if conn:
-            # creates sender link to transfer message to the broker
-            event.container.create_sender(conn, target=self.topic_address)
-   
+            self.template = MessageTemplate(compression=compression, durable=True)
+        self.size = size
+
+        # optional metrics registry, set by metrics.instrument()
+        self.metrics = None
+
+        # optional pacing.Pacer releasing messages at scheduled times
+        self.pacer = pacer
+
+    def on_start(self, event):
+        self.container = event.container
+        # sender links are created through a pool so all destinations share the connection
+        self.pool = client.ConnectionPool(event.container, self.url, self.username, self.password, handler=self,
+                                          idle_timeout=self.link_idle, max_links=self.max_links)
+        # creates sender link to transfer message to the broker
+        self.sender_for(self.destinations[0])
+
+    def sender_for(self, address):
+        # the relay link addressing the template, or the cached link of the address
+        if self.relay:
+            self.template.address = address
+            return self.pool.relay()
+        return self.pool.sender(address)
+
     def on_sendable(self, event):
-        while event.sender.credit and self.sent < self.total:
-            # the durable property on the message sends the message as a persistent message
-            event.sender.send(Message(body="hello "+str(self.sent), durable=True))
+        self.send_messages()
+
+    def send_messages(self):
+        # stop at the in-flight window so slow confirmations apply backpressure
+        while self.sent < self.total and (not self.window or self.sent - self.confirmed < self.window):
+            sender = self.sender_for(self.destinations[self.sent % len(self.destinations)])
+            if not sender.credit:
+                # a new link waits for its first credit, on_sendable resumes sending
+                break
+            if self.pacer and not self.pacer.due():
+                # the next message is not due yet, a timer resumes sending then
+                self.pacer.wake(self.container, self.send_messages)
+                break
+            if not self.size:
+                self.template.body = "hello "+str(self.sent)
+            delivery = sender.send(self.template)
+            if self.metrics:
+                self.metrics.sent(delivery)
+            if self.pacer:
+                self.pacer.latency.sent(delivery, self.pacer.take())
             self.sent += 1
     
     def on_accepted(self, event):
         self.confirmed += 1
+        if self.pacer:
+            self.pacer.latency.settled(event.delivery)
         if self.confirmed == self.total:
             print('confirmed all messages')
-            event.connection.close()
+            self.pool.close()
+        else:
+            # a confirmation opens the window again
+            self.send_messages()
 
     def on_rejected(self, event):
         self.confirmed += 1
+        if self.pacer:
+            self.pacer.latency.settled(event.delivery)
         print("Broker", self.url, "Reject message:", event.delivery.tag, "Remote disposition:", event.delivery.remote.condition)
         if self.confirmed == self.total:
-            event.connection.close()
+            self.pool.close()
+        else:
+            self.send_messages()
     # receives socket or authentication failures
     def on_transport_error(self, event):
         print("Transport failure for amqp broker:", self.url, "Error:", event.transport.condition)
         MessagingHandler.on_transport_error(self, event)
 
-# get program options
-options = get_options()
-"""
-The amqp address can be a topic or a queue.
-Use 'topic://' prefix in the amqp address for the amqp sender
-target address to indicate which topic message are sent to.
-"""
-amqp_address = 'topic://' + options.topic
-
-try:
-    # starts the proton container event loop with the MessageProducer event handler
-    Container(MessageProducer(options.url, amqp_address, options.messages, options.username, options.password)).run()
-except KeyboardInterrupt: pass
+if __name__ == "__main__":
+    # get program options
+    options = get_options()
+    """
+    The amqp address can be a topic or a queue.
+    Use 'topic://' prefix in the amqp address for the amqp sender
+    target address to indicate which topic message are sent to.
+    """
+    amqp_address = 'topic://' + options.topic
 
+    try:
+        # starts the proton container event loop with the MessageProducer event handler
+        handler = MessageProducer(options.url, amqp_address, options.messages, options.username, options.password, options.window, options.size,
+                                  compressors.from_options(options), pacing.from_options(options),
+                                  options.topics, options.relay, options.max_links, options.link_idle)
+        Container(metrics.instrument(handler, metrics.from_options(options))).run()
+        if options.topics > 1:
+            print("sent to", options.topics, "topics,", handler.pool.evicted, "sender links closed to stay within --max-links")
+        if handler.pacer:
+            print(handler.pacer.latency.report())
+        if compressors.STATS:
+            print(compressors.report())
+    except KeyboardInterrupt: pass
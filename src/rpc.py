@@ -0,0 +1,348 @@
+#!/usr/bin/env python
+#
+# Licensed to the Apache Software Foundation (ASF) under one
+# or more contributor license agreements.  See the NOTICE file
+# distributed with this work for additional information
+# regarding copyright ownership.  The ASF licenses this file
+# to you under the Apache License, Version 2.0 (the
+# "License"); you may not use this file except in compliance
+# with the License.  You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing,
+# software distributed under the License is distributed on an
+# "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+# KIND, either express or implied.  See the License for the
+# specific language governing permissions and limitations
+# under the License.
+#
+
+from __future__ import print_function, unicode_literals
+import collections
+import optparse
+import threading
+from concurrent.futures import Future, TimeoutError
+from proton import Message
+from proton.reactor import ApplicationEvent, Container, EventInjector
+
+import client
+import metrics
+from metrics import Histogram, timer
+from simple_recv import Recv
+from simple_send import Send
+
+# helper function
+def get_options():
+    parser = optparse.OptionParser(usage="usage: %prog [options]",
+                               description="Request/reply over the broker: an echo service or a client calling it.")
+    parser.add_option("-u", "--url", default="localhost:5672",
+                  help="amqp message broker host url (default %default)")
+    parser.add_option("-a", "--address", default="service",
+                  help="queue the service receives requests from (default %default)")
+    parser.add_option("-m", "--messages", type="int", default=1000,
+                  help="number of requests the client makes; 0 serves indefinitely with --serve (default %default)")
+    parser.add_option("-o", "--username", default=None,
+                  help="username for authentication (default %default)")
+    parser.add_option("-p", "--password", default=None,
+                  help="password for authentication (default %default)")
+    parser.add_option("-S", "--serve", action="store_true", default=False,
+                  help="run the echo service instead of the client (default %default)")
+    parser.add_option("-n", "--outstanding", type="int", default=100,
+                  help="requests the client keeps in flight at once (default %default)")
+    parser.add_option("-t", "--timeout", type="float", default=5.0,
+                  help="seconds before a request without reply fails (default %default)")
+    metrics.add_options(parser)
+    opts, args = parser.parse_args()
+    return opts
+
+
+"""
+Hashed timer wheel: keys are placed in the slot of their deadline tick, so
+adding and cancelling are O(1) and expiring only visits the slots of the
+ticks that passed, however many keys are waiting. Deadlines more than a
+turn away stay in their slot until a later turn reaches them.
+"""
+class TimerWheel(object):
+    def __init__(self, tick=0.05, slots=512):
+        self.tick = tick
+        self.slots = [{} for i in range(slots)]
+        # key -> slot index
+        self.where = {}
+        self.current = int(timer() / tick)
+
+    def __len__(self):
+        return len(self.where)
+
+    def add(self, key, deadline):
+        due = max(int(deadline / self.tick), self.current + 1)
+        i = due % len(self.slots)
+        self.slots[i][key] = due
+        self.where[key] = i
+
+    def cancel(self, key):
+        i = self.where.pop(key, None)
+        if i is not None:
+            del self.slots[i][key]
+
+    def expire(self, now):
+        # returns the keys whose deadline passed
+        expired = []
+        now = int(now / self.tick)
+        for tick in range(self.current + 1, min(now, self.current + len(self.slots)) + 1):
+            slot = self.slots[tick % len(self.slots)]
+            for key, due in list(slot.items()):
+                if due <= now:
+                    del slot[key]
+                    del self.where[key]
+                    expired.append(key)
+        self.current = now
+        return expired
+
+
+"""
+Proton event handler class
+Request/reply client built on Send. Requests go to the service address over
+the one sender link; replies come back on a dynamic receiver whose address
+is set as reply-to. Pending requests are indexed by correlation id, so any
+number of them can be in flight at once on one connection, and expire
+through a timer wheel. request() may be called from any thread and returns
+a concurrent.futures.Future resolved with the reply message.
+"""
+class RpcClient(Send):
+    def __init__(self, url, address, username=None, password=None, timeout=5.0):
+        super(RpcClient, self).__init__(url, address, 0, username, password)
+        self.timeout = timeout
+
+        # requests waiting for the reply address or for credit
+        self.queued = collections.deque()
+        self.lock = threading.Lock()
+        self.woken = False
+        self.injector = EventInjector()
+
+        # correlation id -> future of a request sent and waiting for its reply
+        self.pending = {}
+        self.wheel = TimerWheel()
+        self.timer = None
+        self.next_id = 0
+        self.reply_to = None
+        self.sender = None
+        self.connection = None
+
+        # replies that came after their request expired
+        self.late = 0
+
+    def request(self, body, **properties):
+        # may be called from any thread
+        future = Future()
+        self.queued.append((Message(body=body, **properties), future))
+        self.wake("rpc_wakeup")
+        return future
+
+    def close(self):
+        # may be called from any thread, fails what is still waiting
+        self.wake("rpc_close")
+
+    def wake(self, name):
+        with self.lock:
+            if self.woken and name == "rpc_wakeup":
+                return
+            self.woken = True
+        self.injector.trigger(ApplicationEvent(name))
+
+    def on_start(self, event):
+        self.container = event.container
+        event.container.selectable(self.injector)
+        self.connection = client.connect(event.container, self.url, self.username, self.password, handler=self)
+        if self.connection:
+            self.sender = event.container.create_sender(self.connection, target=self.address)
+            # the broker names the dynamic reply queue
+            event.container.create_receiver(self.connection, None, dynamic=True)
+
+    def on_link_opened(self, event):
+        if event.receiver:
+            self.reply_to = event.receiver.remote_source.address
+            self.flush()
+
+    def on_sendable(self, event):
+        self.flush()
+
+    def on_rpc_wakeup(self, event):
+        with self.lock:
+            self.woken = False
+        self.flush()
+
+    def flush(self):
+        if self.reply_to is None or self.sender is None:
+            return
+        while self.sender.credit and self.queued:
+            message, future = self.queued.popleft()
+            if not future.set_running_or_notify_cancel():
+                continue
+            self.next_id += 1
+            message.id = self.next_id
+            message.reply_to = self.reply_to
+            self.pending[message.id] = future
+            self.wheel.add(message.id, timer() + self.timeout)
+            self.sender.send(message)
+        if self.pending and self.timer is None:
+            self.timer = self.container.schedule(self.wheel.tick, self)
+
+    def on_message(self, event):
+        key = event.message.correlation_id
+        future = self.pending.pop(key, None)
+        if future is None:
+            self.late += 1
+            return
+        self.wheel.cancel(key)
+        future.set_result(event.message)
+
+    def on_timer_task(self, event):
+        self.timer = None
+        for key in self.wheel.expire(timer()):
+            future = self.pending.pop(key)
+            future.set_exception(TimeoutError("no reply to request %s within %s seconds" % (key, self.timeout)))
+        if self.pending:
+            self.timer = self.container.schedule(self.wheel.tick, self)
+
+    def fail(self, error):
+        # sent requests are running already, queued ones may have been cancelled meanwhile
+        futures = list(self.pending.values())
+        self.pending.clear()
+        # popped one at a time like the sender does, callers may still be queueing requests
+        while self.queued:
+            message, future = self.queued.popleft()
+            if future.set_running_or_notify_cancel():
+                futures.append(future)
+        for key in list(self.wheel.where):
+            self.wheel.cancel(key)
+        for future in futures:
+            future.set_exception(error)
+
+    def on_rpc_close(self, event):
+        with self.lock:
+            self.woken = False
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+        self.fail(RuntimeError("client closed"))
+        self.injector.close()
+        if self.connection:
+            self.connection.close()
+
+    def on_accepted(self, event):
+        pass
+
+    def on_rejected(self, event):
+        print("Broker", self.url, "Reject request:", event.delivery.tag)
+
+    def on_released(self, event):
+        pass
+
+    def on_disconnected(self, event):
+        # replies to this connection's reply queue cannot arrive any more
+        self.reply_to = None
+        self.fail(ConnectionError("disconnected from " + self.url))
+
+
+"""
+Proton event handler class
+Request/reply service built on Recv. Each request is answered with the
+result of handler(request body), sent to the request's reply-to address
+over one anonymous relay link and correlated by the request id.
+"""
+class RpcServer(Recv):
+    def __init__(self, url, address, count=0, username=None, password=None, handler=lambda body: body, prefetch=100):
+        super(RpcServer, self).__init__(url, address, count, username, password, prefetch=prefetch, dedup_window=0,
+                                        process=self.answer)
+        self.handler = handler
+        self.relay = None
+        # replies waiting for credit on the relay link
+        self.replies = collections.deque()
+
+    def on_start(self, event):
+        conn = client.connect(event.container, self.url, self.username, self.password, handler=self)
+        if conn:
+            self.receiver = event.container.create_receiver(conn, source=self.address)
+            self.relay = event.container.create_sender(conn, target=None)
+
+    def answer(self, message, ack=None):
+        # the processing step of Recv
+        if message.reply_to:
+            self.replies.append(Message(address=message.reply_to, correlation_id=message.id,
+                                        body=self.handler(message.body)))
+            self.flush()
+
+    def on_sendable(self, event):
+        self.flush()
+
+    def flush(self):
+        while self.relay.credit and self.replies:
+            self.relay.send(self.replies.popleft())
+
+
+"""
+Keeps outstanding requests in flight until count replies or failures came
+back and records the round trip time of each.
+"""
+class Caller(object):
+    def __init__(self, rpc, count, outstanding):
+        self.rpc = rpc
+        self.count = count
+        self.outstanding = outstanding
+        self.latency = Histogram()
+        self.issued = 0
+        self.completed = 0
+        self.failed = 0
+        self.started = None
+        self.finished = None
+
+    def start(self):
+        self.started = timer()
+        for i in range(min(self.outstanding, self.count)):
+            self.call()
+
+    def call(self):
+        self.issued += 1
+        sent = timer()
+        future = self.rpc.request("request %d" % self.issued)
+        future.add_done_callback(lambda f: self.done(f, sent))
+
+    def done(self, future, sent):
+        # runs on the reactor thread, where replies and timeouts resolve the futures
+        self.completed += 1
+        if future.exception() is not None:
+            self.failed += 1
+        else:
+            self.latency.record(int((timer() - sent) * 1000000))
+        if self.issued < self.count:
+            self.call()
+        elif self.completed == self.count:
+            self.finished = timer()
+            self.rpc.close()
+
+    def report(self):
+        elapsed = (self.finished or timer()) - self.started
+        h = self.latency
+        return ("%d calls, %d failed, in %.3f seconds (%.1f calls/sec), round trip ms: p50 %.3f p99 %.3f max %.3f" %
+                (self.completed, self.failed, elapsed, self.completed / elapsed if elapsed else 0.0,
+                 h.percentile(0.5) / 1000.0, h.percentile(0.99) / 1000.0, h.max / 1000.0))
+
+if __name__ == "__main__":
+    # parse arguments and get options
+    opts = get_options()
+
+    try:
+        if opts.serve:
+            handler = RpcServer(opts.url, opts.address, opts.messages, opts.username, opts.password)
+            Container(metrics.instrument(handler, metrics.from_options(opts))).run()
+        else:
+            handler = RpcClient(opts.url, opts.address, opts.username, opts.password, opts.timeout)
+            caller = Caller(handler, opts.messages, opts.outstanding)
+            # the requests are queued until the reply queue is attached
+            caller.start()
+            Container(metrics.instrument(handler, metrics.from_options(opts))).run()
+            print(caller.report())
+            if handler.late:
+                print(handler.late, "replies arrived after their request timed out")
+    except KeyboardInterrupt: pass
@@ -19,10 +19,22 @@
 #
 
 from __future__ import print_function
+import collections
 import optparse
-from proton.handlers import MessagingHandler
+from proton import Delivery
+from proton.handlers import FlowController, MessagingHandler, Release
 from proton.reactor import Container
 
+import client
+import compressors
+import credit
+import filters
+import metrics
+import envelope
+import sinks
+import spill
+import startup
+
 # helper function
 
 def get_options():
@@ -37,19 +49,90 @@ def get_options():
                   help="username for authentication (default %default)")
     parser.add_option("-p", "--password", default=None,
                   help="password for authentication (default %default)")
+    parser.add_option("-d", "--dedup-window", type="int", default=10000,
+                  help="number of recent message ids remembered to drop redelivered duplicates; 0 disables (default %default)")
+    parser.add_option("--prefetch", type="int", default=10,
+                  help="link credit window granted to the broker (default %default)")
+    parser.add_option("-M", "--manual-ack", action="store_true", default=False,
+                  help="acknowledge messages after processing, applied in coalesced batches (default %default)")
+    parser.add_option("--ack-interval", type="float", default=0.05,
+                  help="seconds between applying queued acknowledgements in manual ack mode (default %default)")
+    parser.add_option("-b", "--batch-size", type="int", default=0,
+                  help="deliver messages in batches of this size and accept each batch at once; 0 disables batching (default %default)")
+    parser.add_option("-w", "--batch-wait", type="float", default=1.0,
+                  help="seconds to wait before delivering an incomplete batch (default %default)")
+    parser.add_option("-l", "--links", type="int", default=1,
+                  help="number of competing receiver links in each process (default %default)")
+    parser.add_option("-c", "--connections", type="int", default=1,
+                  help="number of connections per process the links are spread over (default %default)")
+    parser.add_option("-P", "--processes", type="int", default=1,
+                  help="number of consumer processes sharing the --messages count (default %default)")
+    parser.add_option("-W", "--workers", type="int", default=1,
+                  help="number of worker threads processing messages in each process (default %default)")
+
+    compressors.add_options(parser, sender=False)
+    credit.add_options(parser)
+    sinks.add_options(parser)
+    spill.add_options(parser)
+    filters.add_options(parser)
+    startup.add_options(parser)
+    metrics.add_options(parser)
 
     opts, args = parser.parse_args()
 
     return opts
 
+"""
+DedupWindow remembers the last size message ids seen. Lookups and
+insertions are O(1) and memory stays bounded by the window size.
+"""
+class DedupWindow(object):
+    def __init__(self, size):
+        self.size = size
+        self.ids = set()
+        self.order = collections.deque()
+
+    def seen(self, msg_id):
+        # returns True for a duplicate, otherwise records the id
+        if not self.size or msg_id is None:
+            return False
+        if msg_id in self.ids:
+            return True
+        self.ids.add(msg_id)
+        self.order.append(msg_id)
+        if len(self.order) > self.size:
+            self.ids.discard(self.order.popleft())
+        return False
+
 """
 Proton event handler class
 Creates an amqp connection using ANONYMOUS or PLAIN authentication.
 Then attaches a receiver link to conusme messages from the broker.
+Each message is handed to process(message, ack), which writes it to the
+sink by default. In manual ack mode ack is a handle to call, from any
+thread, once the message is processed; otherwise it is None. The handler
+only stops after the last expected message was acknowledged.
 """
 class Recv(MessagingHandler):
-    def __init__(self, url, address, count, username, password):
-        super(Recv, self).__init__()
+    def __init__(self, url, address, count, username, password, prefetch=10, auto_accept=True,
+                 dedup_window=10000, manual_ack=False, ack_interval=0.05, credit=None, sink=None,
+                 selector=None, selector_side="both", fast_start=False, buffer=None, process=None):
+        # where received messages are written, print() by default
+        self.sink = sink or sinks.PrintSink()
+        # a buffering sink is flushed before its messages are accepted, so acks are batched
+        manual_ack = manual_ack or (auto_accept and self.sink.flush_on_settle)
+
+        # a bounded buffer wrapping the sink writes on its own thread and accepts the
+        # deliveries once written, granting credit itself while it has room
+        self.buffer = buffer
+        if buffer:
+            self.sink = buffer
+            manual_ack = True
+
+        # prefetch sets the link credit window granted to the broker, it is topped up
+        # as messages arrive whether or not they have been acknowledged yet
+        super(Recv, self).__init__(prefetch=0 if credit or buffer else prefetch,
+                                   auto_accept=auto_accept and not manual_ack)
 
         # amqp broker host url
         self.url = url
@@ -60,37 +143,150 @@ class Recv(MessagingHandler):
         # authentication credentials
         self.username = username
         self.password = password
+
+        # connect by the broker address cached by an earlier run
+        self.fast_start = fast_start
         
-        # messaging counters
+        # processing step of each message
+        self.process = process or self.write
+
+        # messaging counters, handed counts the deliveries given an ack handle
         self.expected = count
         self.received = 0
+        self.handed = 0
+        self.finished = False
+        self.receiver = None
+
+        # ids of recently received messages, to drop redelivered duplicates
+        self.dedup = DedupWindow(dedup_window)
+
+        # applies acknowledgements made with ack() in batches, None when messages are auto accepted
+        self.acks = None
+        if manual_ack:
+            # imported here, runs accepting messages on arrival do not need it
+            from acks import Acknowledger
+            self.acks = Acknowledger(ack_interval, before=self.sink.flush, queued=self.check_done)
+            self.handlers.append(self.acks)
+        if buffer:
+            buffer.settled = self.ack
+            self.handlers.append(buffer)
+
+        # adaptive credit window replacing prefetch, None keeps the fixed window
+        self.credit = credit
+        if credit:
+            # first, so it sees each delivery before the message is read
+            self.handlers.insert(0, credit)
+            if self.acks:
+                # a delivery is processed once its acknowledgement is applied
+                self.acks.settled = credit.processed
+
+        # a selector evaluated on the headers, before the body is decoded
+        self.selector = filters.receiver_options(selector, selector_side)
+        self.filter = None
+        if selector and selector_side in ("client", "both"):
+            self.filter = filters.install(self, selector)
+
+    def ack(self, delivery, outcome=Delivery.ACCEPTED):
+        # manual ack mode: acknowledges a delivery, from any thread
+        self.acks.ack(delivery, outcome)
 
     def on_start(self, event):
-        # select authentication options for connection
-        if self.username:
-            # basic username and password authentication
-            conn = event.container.connect(url=self.url, 
-                                           user=self.username, 
-                                           password=self.password, 
-                                           allow_insecure_mechs=True)
-        else:
-            # Anonymous authentication
-            conn = event.container.connect(url=self.url)
+        if self.acks:
+            self.acks.start(event.container)
+        if self.buffer:
+            self.buffer.start(event.container)
+        # plain authentication with a username, anonymous otherwise
+        conn = client.connect(event.container, self.url, self.username, self.password, handler=self,
+                              fast_start=self.fast_start)
         # create receiver link to consume messages
         if conn:
-            event.container.create_receiver(conn, source=self.address)
+            self.receiver = event.container.create_receiver(conn, source=self.address, options=self.selector)
 
     def on_message(self, event):
-        if event.message.id and event.message.id < self.received:
-            # ignore duplicate message
+        if self.expected and self.received >= self.expected:
+            # in flight while the last acknowledgements are awaited, the broker keeps it;
+            # without manual acks the link was closed at the count and proton releases it
+            self.release(event.delivery, delivered=False)
             return
-        if self.expected == 0 or self.received < self.expected:
-            print(event.message.body)
-            self.received += 1
-            if self.received == self.expected:
-                print('received all', self.expected, 'messages')
-                event.receiver.close()
-                event.connection.close()
+        compressors.decompress(event.message)
+        if envelope.is_envelope(event.message):
+            # the messages packed into one delivery are handled one by one
+            messages = list(envelope.unpack(event.message))
+        else:
+            messages = [event.message]
+        ack = None
+        if self.acks and not self.buffer:
+            # the delivery is acknowledged once all of its messages are processed
+            ack = self.acks.handle(event.delivery, len(messages), self.ack)
+            self.handed += 1
+        partial = False
+        for i, message in enumerate(messages):
+            if self.expected and self.received >= self.expected:
+                # the count was reached in the middle of an envelope, its tail is not lost:
+                # the delivery is modified rather than accepted and comes back whole
+                partial = True
+                if ack:
+                    ack.modify(len(messages) - i)
+                break
+            self.receive(message, ack)
+        if self.buffer:
+            # acknowledged by the writer once all of its messages are written
+            self.buffer.settle(event.delivery, Delivery.MODIFIED if partial else Delivery.ACCEPTED)
+        if self.credit and not self.acks:
+            # auto accept mode: the message was processed in this call
+            self.credit.processed(event.delivery)
+        if self.expected and self.received >= self.expected:
+            self.stop_credit()
+        self.check_done()
+        if partial and not self.acks:
+            # auto accept mode: proton settles the delivery as modified instead
+            raise Release()
+
+    def stop_credit(self):
+        # the count is reached, no more credit is granted while the last messages are processed
+        if self.credit:
+            self.credit.stop()
+        self.handlers = [h for h in self.handlers
+                         if not isinstance(h, FlowController) and h is not self.credit and h is not self.buffer]
+
+    def check_done(self):
+        # reactor thread, once the expected count was received and acknowledged
+        if self.finished or not self.expected or self.received < self.expected:
+            return
+        if self.acks and self.acks.count() < self.handed:
+            # the processing step has not acknowledged the last messages yet
+            return
+        self.finished = True
+        if self.buffer:
+            # drains the buffer, queueing the last acknowledgements
+            self.buffer.close()
+        if self.acks:
+            self.acks.close()
+        if not self.buffer:
+            self.sink.close()
+        print('received all', self.expected, 'messages')
+        self.receiver.close()
+        self.receiver.connection.close()
+
+    def on_filtered(self, event):
+        # the delivery was settled without decoding the body
+        if self.credit:
+            self.credit.processed(event.delivery)
+
+    def receive(self, message, ack=None):
+        if self.dedup.seen(message.id):
+            # ignore duplicate messages
+            if ack:
+                ack()
+            return
+        self.received += 1
+        self.process(message, ack)
+
+    def write(self, message, ack=None):
+        # the default processing step
+        self.sink.write(message)
+        if ack:
+            ack()
 
     # the on_transport_error event catches socket and authentication failures
     def on_transport_error(self, event):
@@ -100,18 +296,136 @@ class Recv(MessagingHandler):
     def on_disconnected(self, event):
         print("Disconnected")
 
-# parse arguments and get options
-opts = get_options()
-
 """
-The amqp address can be a topic or a queue.
-Do not use a prefix or use 'queue://' in the amqp address for
-the amqp receiver source address to receiver messages from a queue.
+Proton event handler class
+Receives like Recv but hands messages to a callback in lists of batch_size
+(or whatever arrived within batch_wait seconds) and accepts the whole batch
+in one pass once the callback returns and the sink is flushed. Without a
+callback the messages are written to the sink.
 """
+class BatchRecv(Recv):
+    def __init__(self, url, address, count, username, password,
+                 batch_size, batch_wait=1.0, prefetch=10, callback=None, dedup_window=10000, sink=None,
+                 fast_start=False, selector=None, selector_side="both"):
+        # messages are accepted by the batch rather than automatically
+        super(BatchRecv, self).__init__(url, address, count, username, password,
+                                        prefetch=prefetch, auto_accept=False, dedup_window=dedup_window, sink=sink,
+                                        fast_start=fast_start, selector=selector, selector_side=selector_side)
 
-try:
-    Container(Recv(opts.url, opts.address, opts.messages, opts.username, opts.password)).run()
-except KeyboardInterrupt: pass
+        # batch limits and the callback invoked with each list of messages
+        self.batch_size = batch_size
+        self.batch_wait = batch_wait
+        self.callback = callback or self.write_batch
 
+        # pending batch and the deliveries to accept once it is processed
+        self.messages = []
+        self.deliveries = []
+        self.timer = None
 
+    def on_message(self, event):
+        compressors.decompress(event.message)
+        if envelope.is_envelope(event.message):
+            messages = envelope.unpack(event.message)
+        else:
+            messages = [event.message]
+        # an envelope is accepted with the batch holding the last of its messages
+        fresh = [m for m in messages if not self.dedup.seen(m.id)]
+        if self.expected:
+            fresh = fresh[:self.expected - self.received]
+        if not fresh:
+            # ignore duplicate messages and any beyond the expected count
+            self.accept(event.delivery)
+            return
+        self.messages.extend(fresh)
+        self.deliveries.append(event.delivery)
+        self.received += len(fresh)
+        if len(self.messages) >= self.batch_size or self.received == self.expected:
+            self.flush()
+        elif self.timer is None:
+            # deliver an incomplete batch after batch_wait seconds
+            self.timer = event.container.schedule(self.batch_wait, self)
+        if self.received == self.expected:
+            self.sink.close()
+            print('received all', self.expected, 'messages')
+            event.receiver.close()
+            event.connection.close()
+
+    def on_timer_task(self, event):
+        self.timer = None
+        self.flush()
+
+    def flush(self):
+        if self.timer:
+            self.timer.cancel()
+            self.timer = None
+        if not self.messages:
+            return
+        self.callback(self.messages)
+        self.sink.flush()
+        # settle the whole batch in one pass
+        for delivery in self.deliveries:
+            self.accept(delivery)
+        self.messages = []
+        self.deliveries = []
+
+    def write_batch(self, messages):
+        for message in messages:
+            self.sink.write(message)
+
+if __name__ == "__main__":
+    # created first, the time until now was spent starting python and importing
+    profiler = startup.StartupProfiler()
+
+    # parse arguments and get options
+    opts = get_options()
+    # loads the preset dictionary used to inflate compressed bodies
+    compressors.from_options(opts)
+
+    """
+    The amqp address can be a topic or a queue.
+    Do not use a prefix or use 'queue://' in the amqp address for
+    the amqp receiver source address to receiver messages from a queue.
+    """
+
+    if opts.links > 1 or opts.connections > 1 or opts.processes > 1 or opts.workers > 1:
+        # imported here, single consumers do not need it
+        from consumer_pool import check_pool_options, run_pool
+        check_pool_options(opts)
+        try:
+            summary = run_pool(opts.url, opts.address, opts.messages, opts.username, opts.password,
+                               links=opts.links, connections=opts.connections, processes=opts.processes,
+                               workers=opts.workers, prefetch=opts.prefetch)
+            print("processed", summary["processed"], "messages, failed", summary["failed"],
+                  "in %.3f seconds (%.1f msgs/sec)" % (summary["elapsed"], summary["throughput"]))
+        except KeyboardInterrupt: pass
+    else:
+        if opts.buffer_bytes and (opts.batch_size > 0 or opts.adaptive_credit or opts.sink_async):
+            raise SystemExit("--buffer-bytes is not supported with --batch-size, --adaptive-credit or --sink-async")
+        if opts.batch_size > 0:
+            handler = BatchRecv(opts.url, opts.address, opts.messages, opts.username, opts.password,
+                                opts.batch_size, opts.batch_wait, opts.prefetch, dedup_window=opts.dedup_window,
+                                sink=sinks.from_options(opts), fast_start=opts.fast_start,
+                                selector=opts.selector, selector_side=opts.selector_side)
+        else:
+            sink = sinks.from_options(opts)
+            handler = Recv(opts.url, opts.address, opts.messages, opts.username, opts.password, opts.prefetch,
+                           dedup_window=opts.dedup_window, manual_ack=opts.manual_ack, ack_interval=opts.ack_interval,
+                           credit=credit.from_options(opts, initial=opts.prefetch), sink=sink,
+                           selector=opts.selector, selector_side=opts.selector_side, fast_start=opts.fast_start,
+                           buffer=spill.from_options(opts, sink, opts.prefetch))
+        startup.profile(handler, profiler if opts.profile_startup else None)
 
+        try:
+            Container(metrics.instrument(handler, metrics.from_options(opts))).run()
+            if opts.profile_startup:
+                print(profiler.report())
+            if getattr(handler, "credit", None):
+                print(handler.credit.report())
+            if getattr(handler, "buffer", None):
+                print(handler.buffer.report())
+            if handler.filter:
+                print("selector passed", handler.filter.matched, "messages and filtered out", handler.filter.dropped)
+            if compressors.STATS:
+                print(compressors.report())
+            compressors.write_dictionary(opts)
+        except KeyboardInterrupt: pass
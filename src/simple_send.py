@@ -19,11 +19,20 @@
 #
 
 from __future__ import print_function, unicode_literals
+import collections
 import optparse
+import time
 from proton import Message
 from proton.handlers import MessagingHandler
 from proton.reactor import Container
 
+import client
+import metrics
+import pacing
+import payload
+import startup
+from journal import EncodedMessage, PublishJournal
+
 # helper function
 def get_options():
     parser = optparse.OptionParser(usage="usage: %prog [options]",
@@ -40,21 +49,68 @@ def get_options():
                   help="password for authentication (default %default)")
     parser.add_option("-q", "--qos", default="non-persistent",
                   help="Selects the message QoS for published messages. Valid values are [persistent or 2] for persistent messages. Valid values are [non-persistent or 1] for non-persistent messages. (default %default)" )
+    parser.add_option("-f", "--failover", default=None,
+                  help="comma separated list of further broker urls tried in turn on reconnect (default %default)")
+    parser.add_option("-r", "--reconnect-tries", type="int", default=10,
+                  help="reconnect attempts over all urls after a disconnect before giving up (default %default)")
+    parser.add_option("-j", "--journal", default=None,
+                  help="file journaling unconfirmed persistent messages so a restarted run resumes where it stopped (default %default)")
+    parser.add_option("-s", "--size", type="int", default=0,
+                  help="send binary bodies of this many bytes as amqp data sections instead of text (default %default)")
+    parser.add_option("-e", "--envelope", type="int", default=0,
+                  help="pack up to this many messages into one delivery, 0 sends one delivery per message (default %default)")
+    parser.add_option("--envelope-bytes", type="int", default=64 * 1024,
+                  help="send an envelope once it holds this many bytes (default %default)")
+    parser.add_option("--envelope-linger", type="float", default=0.01,
+                  help="send an envelope once its first message has waited this many seconds (default %default)")
+    parser.add_option("-c", "--connections", type="int", default=1,
+                  help="number of connections per process the messages are shared across (default %default)")
+    parser.add_option("-P", "--processes", type="int", default=1,
+                  help="number of worker processes the connections are started in (default %default)")
+    pacing.add_options(parser)
+    startup.add_options(parser)
+    metrics.add_options(parser)
     opts, args = parser.parse_args()
     return opts
 
 
 
+"""
+Reconnect strategy passed to Container.connect(). The delays are restarted
+for every outage, so each disconnect gets max_tries attempts over the urls.
+"""
+class RetryBackoff(object):
+    def __init__(self, max_tries, initial=0.1, factor=2.0, max_delay=10.0):
+        self.max_tries = max_tries
+        self.initial = initial
+        self.factor = factor
+        self.max_delay = max_delay
+
+    def __iter__(self):
+        # the first attempt is immediate, later ones back off up to max_delay
+        yield 0.0
+        delay = self.initial
+        for i in range(1, self.max_tries):
+            yield delay
+            delay = min(self.max_delay, delay * self.factor)
+
+
 """
 Proton event handler class
 Demonstrates how to create an amqp connection and a sender to publish messages.
+Messages are kept by id until the broker settles them, so after a reconnect
+only the unconfirmed messages are sent again.
 """
 class Send(MessagingHandler):
-    def __init__(self, url, address, messages, username, password, QoS=1):
+    def __init__(self, url, address, messages, username, password, QoS=1, first_id=1,
+                 failover=None, reconnect_tries=10, journal=None, size=0,
+                 envelope=0, envelope_bytes=64 * 1024, linger=0.01, pacer=None, fast_start=False, early=10):
         super(Send, self).__init__()
     
-        # amqp broker host url
+        # amqp broker host url and the failover urls tried after it on reconnect
         self.url = url
+        self.urls = [url] + list(failover or [])
+        self.reconnect = RetryBackoff(reconnect_tries)
 
         # target amqp node address
         self.address = address
@@ -66,47 +122,213 @@ class Send(MessagingHandler):
         # the message durability flag must be set to True for persistent messages
         self.message_durability = True if QoS==2 else False
 
+        # binary body shared by all messages, None sends text bodies
+        self.body = payload.filler(size) if size else None
+
+        # packs several messages into each delivery when envelope is above 1
+        self.envelope = None
+        if envelope > 1:
+            # imported here, most runs send one delivery per message
+            from envelope import Envelope
+            self.envelope = Envelope(envelope, envelope_bytes, linger, self.message_durability)
+        self.linger_timer = None
+        self.sender = None
+
+        # optional pacing.Pacer releasing new messages at scheduled times
+        self.pacer = pacer
+
+        # connect by a cached address and queue up to early messages on the link
+        # before it is attached, so they go out as soon as the broker grants credit
+        self.fast_start = fast_start
+        self.early = early if fast_start and not pacer else 0
+
         # messaging counters        
         self.sent = 0
         self.confirmed = 0
+        self.rejected = 0
         self.total = messages
 
+        # message id of the first message, so several senders can share one sequence
+        self.first_id = first_id
+
+        # unconfirmed messages by id, the ids carried by each outstanding delivery
+        # and the ids waiting to be sent again after a reconnect
+        self.unsettled = collections.OrderedDict()
+        self.deliveries = {}
+        self.replay = collections.deque()
+
+        # optional metrics registry, set by metrics.instrument()
+        self.metrics = None
+
+        # optional PublishJournal holding the unconfirmed messages on disk instead of in memory
+        self.journal = journal
+        if journal:
+            self.resume()
+
+    def resume(self):
+        # continue from the unconfirmed tail left in the journal by a previous run
+        ids = self.journal.unsettled()
+        for msg_id in ids:
+            self.unsettled[msg_id] = None
+        self.replay.extend(ids)
+        if self.journal.last_id is not None:
+            self.sent = self.journal.last_id - self.first_id + 1
+            self.confirmed = self.sent - len(ids)
+
     def on_start(self, event):
-        # select connection authenticate
-        if self.username:
-            # creates and establishes an amqp connection with the user credentials
-            conn = event.container.connect(url=self.url, 
-                                           user=self.username, 
-                                           password = self.password, 
-                                           allow_insecure_mechs=True)
-        else:
-            # creates and establishes an amqp connection with anonymous credentials
-            conn = event.container.connect(url=self.url)
+        self.container = event.container
+        # creates and establishes an amqp connection, with the user credentials when given
+        conn = client.connect(event.container, None, self.username, self.password,
+                              urls=self.urls, reconnect=self.reconnect, handler=self, fast_start=self.fast_start)
         if conn:
             # attaches sender link to transmit messages
-            event.container.create_sender(conn, target=self.address)
+            sender = event.container.create_sender(conn, target=self.address)
+            if self.early and not self.replay:
+                self.send_early(sender)
+
+    def send_early(self, sender):
+        # proton holds deliveries made without credit on the link, the first ones are
+        # encoded while the connection is being set up instead of after the first flow
+        for i in range(min(self.early, self.total - self.sent)):
+            self.send_next(sender)
+        if self.journal:
+            self.journal.flush()
 
     def on_sendable(self, event):
-        while event.sender.credit and self.sent < self.total:
-            # creates message to send
-            msg = Message(id=(self.sent+1), 
-                          body='sequence'+str(self.sent+1), 
+        if self.journal and self.confirmed == self.total:
+            # a resumed journal had nothing left to confirm
+            self.finish(event)
+            return
+        self.send_messages(event.sender)
+
+    def send_messages(self, sender):
+        # messages left unconfirmed by a previous connection go first
+        while sender.credit and self.replay:
+            msg_id = self.replay.popleft()
+            if msg_id in self.unsettled:
+                msg = self.unsettled[msg_id]
+                if msg is None:
+                    # journaled messages are read back from disk
+                    msg = self.journal.read(msg_id)
+                if self.envelope is not None:
+                    self.pack(sender, msg_id, msg)
+                    continue
+                if not hasattr(msg, "send"):
+                    msg = EncodedMessage(msg)
+                self.delivered(sender.send(msg), (msg_id,))
+        while sender.credit and self.sent < self.total:
+            if self.pacer and not self.pacer.due():
+                # the next message is not due yet, a timer resumes sending then
+                self.pacer.wake(self.container, lambda: self.send_messages(self.sender))
+                break
+            self.send_next(sender)
+        if self.envelope is not None and self.envelope.ids:
+            if self.sent == self.total and not self.replay:
+                # nothing else will join the envelope
+                if sender.credit:
+                    self.delivered(*self.envelope.send(sender))
+            elif self.linger_timer is None:
+                self.linger_timer = self.container.schedule(self.envelope.linger, self)
+        if self.journal:
+            self.journal.flush()
+
+    def send_next(self, sender):
+        msg_id = self.first_id + self.sent
+        # creates message to send
+        if self.body is not None:
+            # the binary body is streamed from the shared buffer without copies
+            msg = payload.BinaryMessage(self.body, id=msg_id, durable=self.message_durability)
+        else:
+            msg = Message(id=msg_id, 
+                          body='sequence'+str(msg_id), 
                           durable=self.message_durability)
-            # sends message
-            event.sender.send(msg)
-            self.sent += 1
+        if self.journal:
+            # the message is journaled before it is sent and only kept on disk
+            data = bytes(msg.encode())
+            self.journal.append(msg_id, data)
+            self.unsettled[msg_id] = None
+            msg = EncodedMessage(data)
+        elif self.envelope is not None:
+            # enveloped messages are kept encoded, ready to be packed again
+            data = bytes(msg.encode())
+            self.unsettled[msg_id] = data
+        else:
+            self.unsettled[msg_id] = msg
+        self.sent += 1
+        if self.pacer:
+            self.pacer.latency.sent(msg_id, self.pacer.take())
+        # sends message
+        if self.envelope is not None:
+            self.pack(sender, msg_id, data)
+        else:
+            self.delivered(sender.send(msg), (msg_id,))
+
+    def pack(self, sender, msg_id, data):
+        self.envelope.add(msg_id, data)
+        if self.envelope.full():
+            self.delivered(*self.envelope.send(sender))
+
+    def on_timer_task(self, event):
+        # the linger time of a partly filled envelope is up
+        self.linger_timer = None
+        sender = self.sender
+        if self.envelope.ids and sender and sender.credit:
+            self.delivered(*self.envelope.send(sender))
+
+    def on_link_opened(self, event):
+        self.sender = event.sender
+
+    def delivered(self, delivery, ids):
+        self.deliveries[delivery] = ids
+        if self.metrics:
+            self.metrics.sent(delivery)
+
+    def settle(self, event):
+        # returns the number of messages the outcome confirms, 0 when they already were
+        settled = 0
+        for msg_id in self.deliveries.pop(event.delivery, ()):
+            if msg_id in self.unsettled:
+                del self.unsettled[msg_id]
+                if self.journal:
+                    self.journal.settle(msg_id)
+                if self.pacer:
+                    self.pacer.latency.settled(msg_id)
+                settled += 1
+        return settled
+
+    def finish(self, event):
+        if self.journal:
+            # the batch is complete, a later run starts from an empty journal
+            self.journal.reset()
+        if self.pacer:
+            self.pacer.cancel()
+        event.connection.close()
 
     def on_accepted(self, event):
-        self.confirmed += 1
+        settled = self.settle(event)
+        if not settled:
+            return
+        self.confirmed += settled
         if self.confirmed == self.total:
             print("all messages confirmed")
-            event.connection.close()
+            self.finish(event)
 
     def on_rejected(self, event):
-        self.confirmed += 1
+        settled = self.settle(event)
+        if not settled:
+            return
+        self.confirmed += settled
+        self.rejected += settled
         print("Broker", self.url, "Reject message:", event.delivery.tag)
         if self.confirmed == self.total:
-            event.connection.close()
+            self.finish(event)
+
+    def on_released(self, event):
+        # the broker did not take the messages, send them again
+        for msg_id in self.deliveries.pop(event.delivery, ()):
+            if msg_id in self.unsettled:
+                self.replay.append(msg_id)
+        self.send_messages(event.sender)
 
     # catches event for socket and authentication failures
     def on_transport_error(self, event):
@@ -116,32 +338,146 @@ class Send(MessagingHandler):
     def on_disconnected(self, event):
         if event.transport and event.transport.condition :
             print('disconnected with error : ', event.transport.condition)
-            event.connection.close()
 
-        self.sent = self.confirmed
+        # deliveries of the lost connection will never be settled by the broker,
+        # queue their messages to be sent again once the link is reattached
+        self.deliveries.clear()
+        if self.envelope is not None:
+            # the packed messages are unsettled too and are packed again from the replay
+            self.envelope.clear()
+        self.replay = collections.deque(self.unsettled)
 
-# get application options
-opts = get_options()
+# options of a single Send that fan-out mode does not apply, with their defaults
+FAN_OUT_IGNORED = (("metrics_port", None), ("metrics_file", None), ("fast_start", False),
+                   ("profile_startup", False))
 
-# determine Quality of Service for sending messages
-if str(opts.qos) == "non-persistent" or  opts.qos==1:
-    QoS=1 # non-persistent
-elif str(opts.qos) == "persistent" or  opts.qos==2:
-    QoS=2 # persistent
-else:
-    # TODO add QOS for direct (0)
-    # default to non-persistent
-    QoS=1
+def check_fan_out_options(opts):
+    # fan-out mode runs plain Send handlers, refuse options it would silently ignore
+    used = ["--" + name.replace("_", "-") for name, default in FAN_OUT_IGNORED
+            if getattr(opts, name, default) != default]
+    if used:
+        raise SystemExit("%s not supported with several connections or processes" % ", ".join(used))
 
+def send_worker(url, address, shares, username, password, QoS, failover=None, reconnect_tries=10, size=0,
+                envelope=0, envelope_bytes=64 * 1024, linger=0.01):
+    """
+    Runs one Send handler per (first_id, messages) share on a single container.
+    Each handler passes itself as its connection handler so the links of the
+    different connections only see their own events.
+    """
+    senders = [Send(url, address, messages, username, password, QoS, first_id, failover, reconnect_tries,
+                    size=size, envelope=envelope, envelope_bytes=envelope_bytes, linger=linger)
+               for first_id, messages in shares if messages > 0]
+    started = time.time()
+    Container(*senders).run()
+    return {
+        "sent": sum(s.sent for s in senders),
+        "confirmed": sum(s.confirmed for s in senders),
+        "rejected": sum(s.rejected for s in senders),
+        "elapsed": time.time() - started,
+    }
 
-"""
-The amqp address can be a topic or a queue.
-Do not use a prefix or use 'queue://' in the amqp address for 
-the amqp sender link target address to indicate which queue 
-messages are sent to.
-"""
+def send_worker_args(args):
+    return send_worker(*args)
+
+def fan_out(url, address, messages, username, password, QoS, connections, processes,
+            failover=None, reconnect_tries=10, size=0, envelope=0, envelope_bytes=64 * 1024, linger=0.01):
+    """
+    Shards messages across connections * processes Send handlers, runs each
+    process's share in a worker process and aggregates the results.
+    """
+    count = connections * processes
+    shares = []
+    first_id = 1
+    for i in range(count):
+        # spread the remainder over the first shards
+        n = messages // count + (1 if i < messages % count else 0)
+        shares.append((first_id, n))
+        first_id += n
+    work = [(url, address, shares[p::processes], username, password, QoS, failover, reconnect_tries, size,
+             envelope, envelope_bytes, linger)
+            for p in range(processes)]
 
-try:
-    # start proton event reactor
-    Container(Send(opts.url, opts.address, opts.messages, opts.username, opts.password, QoS)).run()
-except KeyboardInterrupt: pass
+    started = time.time()
+    if processes > 1:
+        # imported here, it is not needed by single process runs and slows their startup
+        import multiprocessing
+        pool = multiprocessing.Pool(processes)
+        try:
+            results = pool.map(send_worker_args, work)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        results = [send_worker_args(work[0])]
+    elapsed = time.time() - started
+
+    summary = {
+        "sent": sum(r["sent"] for r in results),
+        "confirmed": sum(r["confirmed"] for r in results),
+        "rejected": sum(r["rejected"] for r in results),
+        "elapsed": elapsed,
+    }
+    summary["throughput"] = summary["confirmed"] / elapsed if elapsed else 0.0
+    return summary
+
+if __name__ == "__main__":
+    # created first, the time until now was spent starting python and importing
+    profiler = startup.StartupProfiler()
+
+    # get application options
+    opts = get_options()
+
+    # determine Quality of Service for sending messages
+    if str(opts.qos) == "non-persistent" or  opts.qos==1:
+        QoS=1 # non-persistent
+    elif str(opts.qos) == "persistent" or  opts.qos==2:
+        QoS=2 # persistent
+    else:
+        # TODO add QOS for direct (0)
+        # default to non-persistent
+        QoS=1
+
+
+    """
+    The amqp address can be a topic or a queue.
+    Do not use a prefix or use 'queue://' in the amqp address for 
+    the amqp sender link target address to indicate which queue 
+    messages are sent to.
+    """
+
+    failover = opts.failover.split(",") if opts.failover else None
+
+    if opts.journal and QoS != 2:
+        raise SystemExit("--journal is only used with --qos persistent")
+    if opts.journal and (opts.connections > 1 or opts.processes > 1):
+        raise SystemExit("--journal is only supported with a single connection")
+    if opts.rate and (opts.connections > 1 or opts.processes > 1):
+        raise SystemExit("--rate is only supported with a single connection")
+    if opts.connections > 1 or opts.processes > 1:
+        check_fan_out_options(opts)
+
+    try:
+        if opts.connections > 1 or opts.processes > 1:
+            summary = fan_out(opts.url, opts.address, opts.messages, opts.username, opts.password, QoS,
+                              opts.connections, opts.processes, failover, opts.reconnect_tries, opts.size,
+                              opts.envelope, opts.envelope_bytes, opts.envelope_linger)
+            print("sent", summary["sent"], "confirmed", summary["confirmed"], "rejected", summary["rejected"],
+                  "in %.3f seconds (%.1f msgs/sec)" % (summary["elapsed"], summary["throughput"]))
+        else:
+            # start proton event reactor
+            journal = PublishJournal(opts.journal) if opts.journal else None
+            handler = Send(opts.url, opts.address, opts.messages, opts.username, opts.password, QoS,
+                           failover=failover, reconnect_tries=opts.reconnect_tries, journal=journal,
+                           size=opts.size, envelope=opts.envelope, envelope_bytes=opts.envelope_bytes,
+                           linger=opts.envelope_linger, pacer=pacing.from_options(opts),
+                           fast_start=opts.fast_start)
+            startup.profile(handler, profiler if opts.profile_startup else None)
+            Container(metrics.instrument(handler, metrics.from_options(opts))).run()
+            if opts.profile_startup:
+                print(profiler.report())
+            if handler.pacer:
+                print(handler.pacer.latency.report())
+            if journal:
+                journal.close()
+    except KeyboardInterrupt: pass
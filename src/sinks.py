@@ -0,0 +1,231 @@
+#
+# Licensed to the Apache Software Foundation (ASF) under one
+# or more contributor license agreements.  See the NOTICE file
+# distributed with this work for additional information
+# regarding copyright ownership.  The ASF licenses this file
+# to you under the Apache License, Version 2.0 (the
+# "License"); you may not use this file except in compliance
+# with the License.  You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing,
+# software distributed under the License is distributed on an
+# "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+# KIND, either express or implied.  See the License for the
+# specific language governing permissions and limitations
+# under the License.
+#
+
+from __future__ import print_function
+import base64
+import io
+import json
+import os
+import sys
+import threading
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+import payload
+
+# helper functions
+def add_options(parser):
+    parser.add_option("--sink", default="print", choices=sorted(SINKS),
+                  help="where received messages go: %s (default %%default)" % ", ".join(sorted(SINKS)))
+    parser.add_option("--sink-path", default="messages.out",
+                  help="file written by the file and ndjson sinks (default %default)")
+    parser.add_option("--sink-buffer", type="int", default=1024 * 1024,
+                  help="write buffer size in bytes of the stdout, file and ndjson sinks (default %default)")
+    parser.add_option("--sink-rotate", type="float", default=64.0,
+                  help="megabytes after which the ndjson sink starts a new file; 0 never rotates (default %default)")
+    parser.add_option("--sink-async", type="int", default=0,
+                  help="write on a separate thread through a queue of this many messages; 0 writes inline (default %default)")
+
+def from_options(opts):
+    if opts.sink == "file":
+        sink = FileSink(opts.sink_path, opts.sink_buffer)
+    elif opts.sink == "ndjson":
+        sink = NdjsonSink(opts.sink_path, int(opts.sink_rotate * 1024 * 1024), opts.sink_buffer)
+    elif opts.sink == "stdout":
+        sink = StdoutSink(opts.sink_buffer)
+    else:
+        sink = SINKS[opts.sink]()
+    if opts.sink_async:
+        sink = AsyncSink(sink, opts.sink_async)
+    return sink
+
+def record(message):
+    # json serialisable form of a message, binary bodies are base64 encoded
+    body = payload.decode(message)
+    rec = {"id": message.id, "subject": message.subject}
+    # proton returns an unset content type as the symbol "None"
+    if message.content_type and message.content_type != "None":
+        rec["content_type"] = message.content_type
+    if message.correlation_id is not None:
+        rec["correlation_id"] = message.correlation_id
+    if message.properties:
+        rec["properties"] = message.properties
+    if isinstance(body, memoryview):
+        rec["body"] = base64.b64encode(body).decode("ascii")
+        rec["encoding"] = "base64"
+    else:
+        rec["body"] = body
+    return rec
+
+
+"""
+Sinks receive the messages a consumer is done with. write() may be
+called from worker threads. Sinks with flush_on_settle set buffer what
+they write, so the consumer calls flush() before settling deliveries and
+a message is never accepted before it reached the operating system.
+"""
+class PrintSink(object):
+    flush_on_settle = False
+
+    def write(self, message):
+        print(payload.describe(message))
+
+    def flush(self):
+        pass
+
+    def close(self):
+        pass
+
+class NullSink(PrintSink):
+    def write(self, message):
+        pass
+
+"""
+Writes one line per message through a large buffer instead of a print
+call, and a system call, per message. stdout is often redirected to a
+file, so the buffer is flushed before the messages are settled.
+"""
+class StdoutSink(PrintSink):
+    flush_on_settle = True
+
+    def __init__(self, buffer_size=1024 * 1024):
+        self.lock = threading.Lock()
+        self.out = self.open(buffer_size)
+
+    def open(self, buffer_size):
+        sys.stdout.flush()
+        return io.open(sys.stdout.fileno(), "wb", buffering=buffer_size, closefd=False)
+
+    def format(self, message):
+        return (u"%s\n" % (payload.describe(message),)).encode("utf-8")
+
+    def write(self, message):
+        line = self.format(message)
+        with self.lock:
+            self.out.write(line)
+
+    def flush(self):
+        with self.lock:
+            self.out.flush()
+
+    def close(self):
+        self.flush()
+
+class FileSink(StdoutSink):
+    def __init__(self, path, buffer_size=1024 * 1024):
+        self.path = path
+        super(FileSink, self).__init__(buffer_size)
+
+    def open(self, buffer_size):
+        return io.open(self.path, "ab", buffering=buffer_size)
+
+    def close(self):
+        with self.lock:
+            self.out.close()
+
+"""
+Writes each message as a line of json and moves on to a new file once
+rotate_bytes were written: path is renamed to path.1, path.1 to path.2
+and so on, keeping at most keep old files.
+"""
+class NdjsonSink(FileSink):
+    def __init__(self, path, rotate_bytes=64 * 1024 * 1024, buffer_size=1024 * 1024, keep=10):
+        self.rotate_bytes = rotate_bytes
+        self.keep = keep
+        self.buffer_size = buffer_size
+        super(NdjsonSink, self).__init__(path, buffer_size)
+        self.size = self.out.tell()
+
+    def format(self, message):
+        return (json.dumps(record(message), separators=(",", ":"), default=str) + "\n").encode("utf-8")
+
+    def write(self, message):
+        line = self.format(message)
+        with self.lock:
+            if self.rotate_bytes and self.size and self.size + len(line) > self.rotate_bytes:
+                self.rotate()
+            self.out.write(line)
+            self.size += len(line)
+
+    def rotate(self):
+        # lock held
+        self.out.close()
+        for i in range(self.keep - 1, 0, -1):
+            older = "%s.%d" % (self.path, i)
+            if os.path.exists(older):
+                os.rename(older, "%s.%d" % (self.path, i + 1))
+        os.rename(self.path, self.path + ".1")
+        self.out = self.open(self.buffer_size)
+        self.size = 0
+
+"""
+Hands messages to a writer thread through a queue of at most maxsize
+messages, so formatting and writing overlap with receiving. write()
+blocks while the queue is full; flush() waits until the writer has
+caught up and flushed the wrapped sink.
+"""
+class AsyncSink(object):
+    def __init__(self, sink, maxsize=10000):
+        self.sink = sink
+        self.flush_on_settle = sink.flush_on_settle
+        self.queue = queue.Queue(maxsize)
+        self.error = None
+        self.thread = threading.Thread(target=self.run, name="sink-writer")
+        self.thread.daemon = True
+        self.thread.start()
+
+    def run(self):
+        while True:
+            item = self.queue.get()
+            try:
+                if item is None:
+                    return
+                if isinstance(item, threading.Event):
+                    self.sink.flush()
+                    item.set()
+                elif self.error is None:
+                    self.sink.write(item)
+            except Exception as e:
+                # reported by the next flush, the writer keeps draining the queue
+                self.error = e
+                if isinstance(item, threading.Event):
+                    item.set()
+            finally:
+                self.queue.task_done()
+
+    def write(self, message):
+        self.queue.put(message)
+
+    def flush(self):
+        done = threading.Event()
+        self.queue.put(done)
+        done.wait()
+        if self.error is not None:
+            raise self.error
+
+    def close(self):
+        self.flush()
+        self.queue.put(None)
+        self.thread.join()
+        self.sink.close()
+
+SINKS = {"print": PrintSink, "null": NullSink, "stdout": StdoutSink, "file": FileSink, "ndjson": NdjsonSink}
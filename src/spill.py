@@ -0,0 +1,332 @@
+#
+# Licensed to the Apache Software Foundation (ASF) under one
+# or more contributor license agreements.  See the NOTICE file
+# distributed with this work for additional information
+# regarding copyright ownership.  The ASF licenses this file
+# to you under the Apache License, Version 2.0 (the
+# "License"); you may not use this file except in compliance
+# with the License.  You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing,
+# software distributed under the License is distributed on an
+# "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+# KIND, either express or implied.  See the License for the
+# specific language governing permissions and limitations
+# under the License.
+#
+
+from __future__ import print_function
+import collections
+import mmap
+import struct
+import threading
+from proton import Delivery, Handler, Message
+from proton.reactor import ApplicationEvent, EventInjector
+
+# ring record header: length of the encoded message that follows
+LENGTH = struct.Struct(">I")
+# length marking the rest of the file as unused
+WRAP = 0xffffffff
+
+# buffer entry of a message that was spilled to the ring
+SPILLED = ("spilled",)
+
+# estimated bytes a decoded message takes besides its body
+OVERHEAD = 256
+
+# pages of the ring are dropped from the process once this many bytes behind the writer or reader
+RELEASE = 1024 * 1024
+
+# helper functions
+def add_options(parser):
+    parser.add_option("--buffer-bytes", type="float", default=0.0,
+                  help="megabytes of received messages buffered for the sink, written on a separate thread; "
+                       "credit is paused while it is full. 0 writes inline (default %default)")
+    parser.add_option("--spill", default=None,
+                  help="ring file overflow messages are spilled to once the buffer is full, "
+                       "credit is only paused once the ring is half full too (default %default)")
+    parser.add_option("--spill-bytes", type="float", default=256.0,
+                  help="megabytes of the spill ring file (default %default)")
+
+def from_options(opts, sink, window):
+    # returns None when messages are written inline
+    if not opts.buffer_bytes:
+        return None
+    ring = SpillRing(opts.spill, int(opts.spill_bytes * 1024 * 1024)) if opts.spill else None
+    return BoundedBuffer(sink, int(opts.buffer_bytes * 1024 * 1024), ring, window)
+
+def size(message):
+    # estimated memory of a decoded message
+    body = message.body
+    try:
+        return OVERHEAD + len(body)
+    except TypeError:
+        return OVERHEAD
+
+
+"""
+SpillRing is a fixed size file used as a ring of length prefixed records
+through a memory map. put() returns False when a record does not fit in
+the free space; a record that does not fit before the end of the file
+starts over at the front. Pages the writer or the reader has moved past
+are dropped from the process, so the ring adds to the page cache but not
+to the resident memory of the consumer.
+"""
+class SpillRing(object):
+    def __init__(self, path, size):
+        self.path = path
+        self.size = size
+        self.file = open(path, "w+b")
+        self.file.truncate(size)
+        self.map = mmap.mmap(self.file.fileno(), size)
+        # read and write offsets, and the bytes between them including skipped ends
+        self.head = 0
+        self.tail = 0
+        self.used = 0
+        self.count = 0
+        self.released = [0, 0]
+        # counters reported at the end
+        self.spilled = 0
+        self.peak_used = 0
+
+    def __len__(self):
+        return self.count
+
+    def put(self, data):
+        need = LENGTH.size + len(data)
+        tail = self.tail
+        skip = 0
+        if tail + need > self.size:
+            skip = self.size - tail
+            tail = 0
+        if self.used + skip + need > self.size:
+            return False
+        if skip >= LENGTH.size:
+            LENGTH.pack_into(self.map, self.tail, WRAP)
+        LENGTH.pack_into(self.map, tail, len(data))
+        self.map[tail + LENGTH.size:tail + need] = data
+        self.tail = tail + need
+        self.used += skip + need
+        self.count += 1
+        self.peak_used = max(self.peak_used, self.used)
+        self.spilled += 1
+        self.release(0, self.tail)
+        return True
+
+    def get(self):
+        # returns the oldest record
+        if not self.count:
+            return None
+        head = self.head
+        length = LENGTH.unpack_from(self.map, head)[0] if self.size - head >= LENGTH.size else WRAP
+        if length == WRAP:
+            self.used -= self.size - head
+            head = 0
+            length = LENGTH.unpack_from(self.map, head)[0]
+        data = self.map[head + LENGTH.size:head + LENGTH.size + length]
+        self.head = head + LENGTH.size + length
+        self.used -= LENGTH.size + length
+        self.count -= 1
+        if not self.count:
+            # start over at the front while the ring is empty
+            self.head = self.tail = self.used = 0
+        self.release(1, self.head)
+        return data
+
+    def release(self, which, offset):
+        # drops the pages between the last release and offset from the process
+        start = self.released[which]
+        if offset < start:
+            start = self.released[which] = 0
+        if offset - start < RELEASE or not hasattr(self.map, "madvise"):
+            return
+        end = offset - offset % mmap.PAGESIZE
+        self.map.madvise(mmap.MADV_DONTNEED, start, end - start)
+        self.released[which] = end
+
+    def close(self):
+        self.map.close()
+        self.file.close()
+
+
+"""
+Proton event handler added as a child of a receiving handler created
+with prefetch=0, and a sink wrapper. Messages written to it are handed to
+the wrapped sink on a writer thread, in order, through a buffer of at
+most budget bytes of decoded messages. Beyond that messages are spilled
+encoded to the ring when there is one, leaving a placeholder in the
+buffer, and credit is no longer granted while the buffer is full and the
+ring half full; the writer resumes it once they have drained. settle()
+queues the acknowledgement of a delivery behind its messages, and the
+writer calls settled(delivery, outcome) once they were written and flushed.
+"""
+class BoundedBuffer(Handler):
+    flush_on_settle = False
+
+    def __init__(self, sink, budget, ring=None, window=10, settled=None, batch=256):
+        self.sink = sink
+        self.budget = budget
+        self.ring = ring
+        self.window = window
+        self.settled = settled
+        self.batch = batch
+
+        # ("message", message, size), SPILLED and ("settle", delivery, outcome) in arrival order
+        self.items = collections.deque()
+        self.bytes = 0
+        self.condition = threading.Condition()
+        self.closing = False
+        self.error = None
+
+        # credit is paused while full, the writer wakes the reactor to resume it
+        self.link = None
+        self.paused = False
+        self.injector = EventInjector()
+
+        # counters reported at the end
+        self.pauses = 0
+        self.peak_bytes = 0
+
+        self.thread = threading.Thread(target=self.run, name="buffer-writer")
+        self.thread.daemon = True
+        self.thread.start()
+
+    def start(self, container):
+        container.selectable(self.injector)
+
+    # sink interface, reactor thread
+    def write(self, message):
+        with self.condition:
+            if self.ring is not None and self.bytes >= self.budget and self.ring.put(bytes(message.encode())):
+                self.items.append(SPILLED)
+                self.condition.notify()
+                return
+            # over the budget only by what was in flight when credit was paused
+            n = size(message)
+            self.items.append(("message", message, n))
+            self.bytes += n
+            self.peak_bytes = max(self.peak_bytes, self.bytes)
+            self.condition.notify()
+
+    def settle(self, delivery, outcome=Delivery.ACCEPTED):
+        with self.condition:
+            self.items.append(("settle", delivery, outcome))
+            self.condition.notify()
+
+    def full(self):
+        with self.condition:
+            if self.bytes < self.budget:
+                return False
+            return self.ring is None or self.ring.used >= self.ring.size // 2
+
+    def flush(self):
+        # the writer flushes the wrapped sink before settling
+        if self.error is not None:
+            raise self.error
+
+    def close(self):
+        # waits until everything buffered was written
+        with self.condition:
+            self.closing = True
+            self.condition.notify()
+        self.thread.join()
+        self.injector.close()
+        self.sink.close()
+        if self.ring is not None:
+            self.ring.close()
+        if self.error is not None:
+            raise self.error
+
+    # writer thread
+    def take(self):
+        with self.condition:
+            while not self.items:
+                if self.closing:
+                    return None
+                self.condition.wait()
+            item = self.items.popleft()
+            if item is SPILLED:
+                data = self.ring.get()
+            elif item[0] == "message":
+                self.bytes -= item[2]
+            idle = not self.items
+            resume = self.paused and self.bytes < self.budget // 2 and (
+                self.ring is None or self.ring.used < self.ring.size // 4)
+            if resume:
+                self.paused = False
+        if resume:
+            self.injector.trigger(ApplicationEvent("buffer_resume"))
+        if item is SPILLED:
+            # decoded outside the lock
+            message = Message()
+            message.decode(data)
+            item = ("message", message, 0)
+        return item, idle
+
+    def run(self):
+        pending = []
+        while True:
+            taken = self.take()
+            if taken is None:
+                break
+            item, idle = taken
+            try:
+                if item[0] == "message":
+                    if self.error is None:
+                        self.sink.write(item[1])
+                else:
+                    pending.append(item[1:])
+                if pending and (idle or len(pending) >= self.batch) and self.error is None:
+                    # the messages reach the sink's file before they are accepted
+                    self.sink.flush()
+                    for delivery, outcome in pending:
+                        self.settled(delivery, outcome)
+                    pending = []
+            except Exception as e:
+                # reported by close, the writer keeps draining the buffer and
+                # leaves the deliveries unsettled for the broker to redeliver
+                self.error = e
+        if self.error is None:
+            # flushed first here too, so the last messages reach the file before they are accepted
+            self.sink.flush()
+            for delivery, outcome in pending:
+                self.settled(delivery, outcome)
+
+    # credit, reactor thread
+    def on_link_local_open(self, event):
+        self.flow(event.link)
+
+    def on_link_remote_open(self, event):
+        self.flow(event.link)
+
+    def on_link_flow(self, event):
+        self.flow(event.link)
+
+    def on_delivery(self, event):
+        self.flow(event.link)
+
+    def on_buffer_resume(self, event):
+        if self.link is not None:
+            self.flow(self.link)
+
+    def flow(self, link):
+        if not link.is_receiver or link.drain_mode:
+            return
+        self.link = link
+        if self.full():
+            with self.condition:
+                if not self.paused:
+                    self.paused = True
+                    self.pauses += 1
+            return
+        delta = self.window - link.credit
+        if delta > 0:
+            link.flow(delta)
+
+    def report(self):
+        line = "buffer peak %d bytes, credit paused %d times" % (self.peak_bytes, self.pauses)
+        if self.ring is not None:
+            line += ", %d messages spilled, ring peak %d bytes" % (self.ring.spilled, self.ring.peak_used)
+        return line
@@ -0,0 +1,108 @@
+#
+# Licensed to the Apache Software Foundation (ASF) under one
+# or more contributor license agreements.  See the NOTICE file
+# distributed with this work for additional information
+# regarding copyright ownership.  The ASF licenses this file
+# to you under the Apache License, Version 2.0 (the
+# "License"); you may not use this file except in compliance
+# with the License.  You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing,
+# software distributed under the License is distributed on an
+# "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+# KIND, either express or implied.  See the License for the
+# specific language governing permissions and limitations
+# under the License.
+#
+
+from __future__ import print_function
+import os
+import time
+from proton import Handler
+
+# wall clock time this module was imported, the start time when /proc is not available
+IMPORTED = time.time()
+
+# helper functions
+def add_options(parser):
+    parser.add_option("--profile-startup", action="store_true", default=False,
+                  help="print the time spent in each startup phase up to the first message (default %default)")
+    parser.add_option("--fast-start", action="store_true", default=False,
+                  help="connect to a cached address of the broker host and queue the first messages "
+                       "before the link is attached (default %default)")
+
+def process_started():
+    # wall clock time the interpreter started, from the process start tick on linux
+    try:
+        with open("/proc/self/stat") as f:
+            # fields after the command name, the start time is field 22 of the whole line
+            ticks = float(f.read().rsplit(")", 1)[1].split()[19])
+        with open("/proc/uptime") as f:
+            uptime = float(f.read().split()[0])
+        return time.time() - (uptime - ticks / os.sysconf("SC_CLK_TCK"))
+    except (IOError, OSError, ValueError, IndexError, AttributeError):
+        return IMPORTED
+
+
+"""
+Proton event handler added as a child of a sending or receiving handler.
+It records when each startup phase ends, the first time its event is
+seen: imports (when the handler is created, first thing in the main
+block), setup (options, handlers and reactor, up to the endpoints being
+created), connect (name lookup, tcp connect and the first bytes from the
+broker), sasl, open, attach, credit (a sender was granted credit) and the
+first message received or the first outcome of a sent message. The
+reactor tick between two phases is part of the later one.
+"""
+class StartupProfiler(Handler):
+    def __init__(self, started=None):
+        self.started = started or process_started()
+        # (phase, wall clock time its end was seen), in order
+        self.phases = []
+        self.mark("imports")
+
+    def mark(self, phase):
+        # only the first occurrence of a phase counts
+        if phase not in dict(self.phases):
+            self.phases.append((phase, time.time()))
+
+    def on_reactor_init(self, event):
+        self.mark("setup")
+
+    def on_transport(self, event):
+        self.mark("connect")
+        if event.transport.authenticated:
+            self.mark("sasl")
+
+    def on_connection_remote_open(self, event):
+        self.mark("open")
+
+    def on_link_remote_open(self, event):
+        self.mark("attach")
+
+    def on_link_flow(self, event):
+        if event.link.is_sender:
+            self.mark("credit")
+
+    def on_delivery(self, event):
+        if event.link.is_receiver:
+            self.mark("first message")
+        elif event.delivery.updated:
+            self.mark("first settle")
+
+    def report(self):
+        lines = ["startup phase      ms  total ms"]
+        last = self.started
+        for phase, at in self.phases:
+            lines.append("%-13s %7.1f %9.1f" % (phase, (at - last) * 1000.0, (at - self.started) * 1000.0))
+            last = at
+        return "\n".join(lines)
+
+def profile(handler, profiler):
+    # adds the profiler as a child handler, the handler itself is returned either way
+    if profiler is not None:
+        # first, so it sees the credit before the sender uses it up
+        handler.handlers.insert(0, profiler)
+    return handler